@@ -39,8 +39,6 @@ setuptools.setup(
     install_requires=[
         'Click>=7.1.2',
         'six>=1.11.0',
-        'ring>=0.7.3',
-        'moment>=0.0.10',
         'google-auth>=0.11.0',
         'google-api-python-client>=1.7.11',
         'cachier>=1.5.0',
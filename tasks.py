@@ -6,3 +6,31 @@ def list_tpus(c, zone="europe-west4-a"):
   for tpu in tpunicorn.get_tpus(zone=zone):
     print(tpu['name'], tpu['state'], tpu['acceleratorType'])
 
+@task(name="bench-startup")
+def bench_startup(c, runs=10, output="benchmarks/startup.tsv"):
+  """Times `import tpunicorn` and `pu --help`, and appends the medians to
+  OUTPUT so that startup time can be tracked from release to release."""
+  import os
+  import sys
+  import time
+  import platform
+  import statistics
+  import subprocess
+  def timeit(*args):
+    samples = []
+    for _ in range(int(runs)):
+      start = time.perf_counter()
+      subprocess.run([sys.executable, *args], check=True, stdout=subprocess.DEVNULL)
+      samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+  import_ms = timeit('-c', 'import tpunicorn')
+  help_ms = timeit('-m', 'tpunicorn', '--help')
+  row = [tpunicorn._version.__version__, time.strftime('%Y-%m-%d'), platform.python_version(),
+         '{:.1f}'.format(import_ms), '{:.1f}'.format(help_ms)]
+  print('import tpunicorn: {:.1f}ms, pu --help: {:.1f}ms'.format(import_ms, help_ms))
+  exists = os.path.exists(output)
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'a') as f:
+    if not exists:
+      f.write('\t'.join(['version', 'date', 'python', 'import_ms', 'help_ms']) + '\n')
+    f.write('\t'.join(row) + '\n')
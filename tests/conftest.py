@@ -0,0 +1,98 @@
+import threading
+from urllib.parse import urlparse
+
+import pytest
+
+import tpunicorn.tpu
+
+zones = ['asia-east1-c', 'europe-west4-a', 'us-central1-a', 'us-central1-b', 'us-central1-f']
+
+
+def make_node(zone, name, state='READY', health='HEALTHY', version='v2-alpha',
+              accelerator_type='v3-8', preemptible=True, workers=1, cidr=None,
+              project='proj', network='default'):
+  # a node as the TPU API lists it.
+  return {
+    'name': 'projects/{}/locations/{}/nodes/{}'.format(project, zone, name),
+    'acceleratorType': accelerator_type,
+    'state': state,
+    'health': health,
+    'runtimeVersion': version,
+    'createTime': '2026-10-18T01:02:03.123456789Z',
+    'cidrBlock': cidr,
+    'networkConfig': {'network': 'projects/{}/global/networks/{}'.format(project, network)},
+    'networkEndpoints': [{'ipAddress': '10.0.0.{}'.format(w), 'port': 8470,
+                          'accessConfig': {'externalIp': '192.0.2.{}'.format(w)}}
+                         for w in range(workers)],
+    'schedulingConfig': {'preemptible': preemptible},
+  }
+
+
+@pytest.fixture(autouse=True)
+def offline(tmp_path, monkeypatch):
+  # keep the cache dir and default project away from the real ones.
+  monkeypatch.setenv('TPUNICORN_CACHE_DIR', str(tmp_path / 'cache'))
+  monkeypatch.delenv('TPUNICORN_BACKEND', raising=False)
+  monkeypatch.setattr(tpunicorn.tpu, 'get_default_project', lambda project=None: project or 'proj')
+  monkeypatch.setattr(tpunicorn.tpu, 'get_tpu_zones', lambda project=None: zones)
+  tpunicorn.tpu.reset_caches()
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+  """Serve get_fleet from a list of nodes; returns that list."""
+  nodes = []
+  def get_fleet(zone=None, project=None, cached=False, filter=None, fresh=False):
+    fleet = tpunicorn.tpu.Fleet(nodes)
+    if zone is not None:
+      fleet = tpunicorn.tpu.Fleet(fleet.select(zone=zone))
+    if filter is not None:
+      fleet = tpunicorn.tpu.Fleet(tpunicorn.tpu.TpuFilter.wrap(filter).apply(fleet))
+    return fleet
+  monkeypatch.setattr(tpunicorn.tpu, 'get_fleet', get_fleet)
+  return nodes
+
+
+class FakeResponse:
+  def __init__(self, body):
+    self.body = body
+
+  def raise_for_status(self):
+    pass
+
+  def json(self):
+    return self.body
+
+
+class FakeSession:
+  """Serves the TPU API's node listings from `pages`, a dict of zone to
+  list of pages of nodes, following pageToken like the real thing. Each
+  get waits for `gate` to be set, if there is one."""
+
+  def __init__(self):
+    self.pages = {}
+    self.calls = []
+    self.gate = None
+    self.lock = threading.Lock()
+
+  def get(self, url, headers=None, params=None):
+    if self.gate is not None:
+      self.gate.wait(5)
+    zone = urlparse(url).path.split('/')[-2]
+    page = int((params or {}).get('pageToken', 0))
+    with self.lock:
+      self.calls.append((zone, page))
+    pages = self.pages.get(zone, [[]])
+    body = {'nodes': pages[page]}
+    if page + 1 < len(pages):
+      body['nextPageToken'] = str(page + 1)
+    return FakeResponse(body)
+
+
+@pytest.fixture
+def api(monkeypatch):
+  """Answer TPU API requests from a FakeSession; returns it."""
+  session = FakeSession()
+  monkeypatch.setattr(tpunicorn.tpu, 'get_requests_session', lambda *args, **kws: session)
+  monkeypatch.setattr(tpunicorn.tpu, 'get_headers', lambda headers=None, project=None: {})
+  return session
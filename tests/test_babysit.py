@@ -0,0 +1,66 @@
+import time
+from concurrent import futures
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def babysitter(targets=('*',), **kws):
+  kws.setdefault('interval', 0.01)
+  return tpunicorn.tpu.Babysitter(list(targets), **kws)
+
+
+def settle(babysitter):
+  futures.wait(list(babysitter.jobs.values()))
+
+
+def test_zone_limits_what_is_watched(fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='PREEMPTED'))
+  fleet.append(make_node('us-central1-f', 'tpu-v3-8-usc1f-2', state='PREEMPTED'))
+  recreated = []
+  b = babysitter(zone='europe-west4-a', recreate=lambda tpu: recreated.append(tpu.id))
+  watched = b.tick()
+  settle(b)
+  assert [tpu.id for tpu in watched] == ['tpu-v3-8-euw4a-1']
+  assert recreated == ['tpu-v3-8-euw4a-1']
+
+
+def test_failed_recreate_is_retried(fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='PREEMPTED'))
+  attempts = []
+  def recreate(tpu):
+    attempts.append(tpu.id)
+    fleet[:] = []
+    if len(attempts) == 1:
+      raise RuntimeError('There is no more capacity in the zone')
+    fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='CREATING'))
+  b = babysitter(recreate=recreate)
+  b.tick()
+  settle(b)
+  b.tick()
+  assert 'tpu-v3-8-euw4a-1' in b.failed
+  time.sleep(0.02)
+  b.tick()
+  settle(b)
+  assert attempts == ['tpu-v3-8-euw4a-1', 'tpu-v3-8-euw4a-1']
+  b.tick()
+  assert 'tpu-v3-8-euw4a-1' in b.recovering
+  assert not b.failed
+
+
+def test_preempted_again_while_recovering(fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='PREEMPTED'))
+  recreated = []
+  def recreate(tpu):
+    recreated.append(tpu.id)
+    fleet[0]['state'] = 'CREATING'
+  b = babysitter(recreate=recreate)
+  b.tick()
+  settle(b)
+  b.tick()
+  assert 'tpu-v3-8-euw4a-1' in b.recovering
+  fleet[0]['state'] = 'PREEMPTED'
+  b.tick()
+  settle(b)
+  assert recreated == ['tpu-v3-8-euw4a-1', 'tpu-v3-8-euw4a-1']
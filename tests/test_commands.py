@@ -0,0 +1,44 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def offline_fleet(monkeypatch):
+  # building a command from what's in hand must not look anything up.
+  def get_fleet(*args, **kws):
+    raise AssertionError('looked up the fleet')
+  monkeypatch.setattr(tpunicorn.tpu, 'get_fleet', get_fleet)
+
+
+vm = make_node('europe-west4-a', 'tpu-v3-8-euw4a-3')
+legacy = make_node('europe-west4-a', 'tpu-v3-8-euw4a-4', version='2.4.1')
+
+
+@pytest.mark.parametrize('verb', ['delete', 'start', 'stop'])
+def test_commands_from_nodes(offline_fleet, verb):
+  command = getattr(tpunicorn.tpu, verb + '_tpu_command')
+  assert command(vm) == 'gcloud alpha compute tpus tpu-vm {} tpu-v3-8-euw4a-3 --zone europe-west4-a --project proj --quiet --no-async'.format(verb)
+  assert command(legacy, async_=True) == 'gcloud compute tpus {} tpu-v3-8-euw4a-4 --zone europe-west4-a --project proj --quiet --async'.format(verb)
+
+
+def test_create_and_reimage_go_by_version(offline_fleet):
+  assert tpunicorn.tpu.create_tpu_command('tpu-v3-8-euw4a-5', zone='europe-west4-a', version='v2-alpha', accelerator_type='v3-8',
+                                          project='proj', range='10.0.0.0/29', network='default') == (
+    'gcloud alpha compute tpus tpu-vm create tpu-v3-8-euw4a-5 --zone europe-west4-a --project proj --network default'
+    ' --range 10.0.0.0/29 --version v2-alpha --accelerator-type v3-8 --no-async')
+  assert tpunicorn.tpu.reimage_tpu_command(legacy, version='2.5.0') == (
+    'gcloud compute tpus reimage tpu-v3-8-euw4a-4 --zone europe-west4-a --project proj --version 2.5.0 --quiet --no-async')
+
+
+def test_given_tpu_vm_skips_the_lookup(offline_fleet):
+  assert tpunicorn.tpu.build_commandline('gcloud compute tpus describe', 'tpu-9', tpu_vm=True, zone='us-central1-f') == (
+    'gcloud alpha compute tpus tpu-vm describe tpu-9 --zone us-central1-f')
+  assert tpunicorn.tpu.build_commandline('gcloud compute tpus describe', 'tpu-9', tpu_vm=False) == 'gcloud compute tpus describe tpu-9'
+
+
+def test_bare_names_are_looked_up(fleet):
+  fleet.append(vm)
+  assert tpunicorn.tpu.build_commandline('gcloud compute tpus describe', 'tpu-v3-8-euw4a-3').startswith('gcloud alpha compute tpus tpu-vm describe')
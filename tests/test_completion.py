@@ -0,0 +1,69 @@
+import os
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.snapshot as snapshot
+import tpunicorn.tpu
+
+from conftest import make_node, zones
+
+
+@pytest.fixture
+def words(monkeypatch):
+  # completion must come from the word lists, never from the fleet.
+  def get_fleet(*args, **kws):
+    raise AssertionError('completion fetched the fleet')
+  monkeypatch.setattr(tpunicorn.tpu, 'get_fleet', get_fleet)
+  nodes = [make_node('europe-west4-a', 'tpu-v3-8-euw4a-3'), make_node('us-central1-f', 'tpu-v3-8-usc1f-12'),
+           make_node('us-central1-f', 'grpc-box')]
+  snapshot.write_snapshot('proj', nodes)
+  return nodes
+
+
+def test_snapshot_writes_word_lists(words):
+  assert snapshot.read_completions('tpus') == ['12', '3', 'grpc-box', 'tpu-v3-8-euw4a-3', 'tpu-v3-8-usc1f-12']
+  assert snapshot.read_completions('zones') == zones + ['ase1c', 'euw4a', 'usc1a', 'usc1b', 'usc1f']
+
+
+def test_other_projects_leave_the_word_lists_alone():
+  snapshot.write_snapshot('elsewhere', [make_node('europe-west4-a', 'tpu-v3-8-euw4a-3', project='elsewhere')])
+  assert snapshot.read_completions('tpus') is None
+  assert snapshot.read_completions('zones') is None
+
+
+def test_click_completion_reads_the_word_lists(words):
+  assert tpunicorn.program.complete_tpu_id(None, [], 'tpu-v3-8-u') == ['tpu-v3-8-usc1f-12']
+  assert tpunicorn.program.complete_zone(None, [], 'us') == ['us-central1-a', 'us-central1-b', 'us-central1-f', 'usc1a', 'usc1b', 'usc1f']
+
+
+def test_refresh_cache_writes_word_lists(api):
+  api.pages['us-central1-f'] = [[make_node('us-central1-f', 'tpu-v3-8-usc1f-0')]]
+  result = CliRunner().invoke(tpunicorn.program.cli, ['refresh-cache'])
+  assert result.exit_code == 0, result.output
+  assert snapshot.read_completions('tpus') == ['0', 'tpu-v3-8-usc1f-0']
+
+
+def bash_complete(*words):
+  # run the installed bash snippet for `pu <words>`, with click's own
+  # completion stubbed out; returns the completions offered.
+  script = tpunicorn.program.get_fast_completion_script(tpunicorn.program.fast_completion_bash, 'pu')
+  code = '\n'.join([
+    '_pu_completion() { COMPREPLY=(click); }',
+    script,
+    'COMP_WORDS=(pu {}); COMP_CWORD={}'.format(' '.join("'{}'".format(word) for word in words), len(words)),
+    '_pu_fast_completion',
+    'printf "%s\\n" "${COMPREPLY[@]}"',
+  ])
+  out = subprocess.run(['bash', '-c', code], check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                       env=dict(os.environ, PATH='/usr/bin:/bin')).stdout
+  return out.split()
+
+
+@pytest.mark.skipif(not os.path.exists('/bin/bash'), reason='needs bash')
+def test_bash_snippet_answers_from_the_word_lists(words):
+  assert bash_complete('delete', 'tpu-v3-8-e') == ['tpu-v3-8-euw4a-3']
+  assert bash_complete('list', '-z', 'euw') == ['euw4a']
+  assert bash_complete('list', '--fo') == ['click']
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def loads(monkeypatch):
+  """Serve load_fleet from a fixed fleet, noting each (project, zone)
+  fetched."""
+  nodes = [make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'),
+           make_node('us-central1-f', 'tpu-v3-8-usc1f-2')]
+  calls = []
+  def load_fleet(zone=None, project=None, cached=False, fresh=False):
+    calls.append((project, zone))
+    fleet = tpunicorn.tpu.Fleet(nodes)
+    return fleet if zone is None else tpunicorn.tpu.Fleet(fleet.select(zone=zone))
+  monkeypatch.setattr(tpunicorn.tpu, 'load_fleet', load_fleet)
+  return calls
+
+
+def test_fleets_are_fetched_once_per_zone(loads):
+  context = tpunicorn.tpu.FleetContext()
+  token = context.activate()
+  try:
+    assert [tpu.id for tpu in tpunicorn.tpu.get_tpus(zone='europe-west4-a')] == ['tpu-v3-8-euw4a-1']
+    tpunicorn.tpu.get_tpu('tpu-v3-8-euw4a-1', zone='europe-west4-a')
+    assert loads == [('proj', 'europe-west4-a')]
+    assert len(tpunicorn.tpu.get_tpus()) == 2
+    # the full fleet answers for every zone from then on.
+    assert [tpu.id for tpu in tpunicorn.tpu.get_tpus(zone='us-central1-f')] == ['tpu-v3-8-usc1f-2']
+    assert loads == [('proj', 'europe-west4-a'), ('proj', None)]
+    tpunicorn.tpu.get_tpus(fresh=True)
+    assert len(loads) == 3
+  finally:
+    context.deactivate(token)
+
+
+def test_widths_come_from_what_has_been_fetched(loads):
+  context = tpunicorn.tpu.FleetContext()
+  token = context.activate()
+  try:
+    tpu = tpunicorn.tpu.get_tpu('tpu-v3-8-euw4a-1', zone='europe-west4-a')
+    assert 'tpu-v3-8-euw4a-1' in tpunicorn.tpu.format(tpu)
+    assert loads == [('proj', 'europe-west4-a')]
+  finally:
+    context.deactivate(token)
+
+
+def test_delete_in_a_zone_fetches_once(loads, monkeypatch):
+  monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+  result = CliRunner().invoke(tpunicorn.program.cli, ['delete', 'tpu-v3-8-euw4a-1', '-z', 'europe-west4-a', '--dry-run', '-y'])
+  assert result.exit_code == 0, result.output
+  assert 'TPU tpu-v3-8-euw4a-1 would be deleted.' in result.output
+  assert loads == [('proj', 'europe-west4-a')]
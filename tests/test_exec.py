@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+
+from conftest import make_node
+
+# stands in for ssh: runs the command locally with $HOST set, and notes
+# its arguments. Worker 2 exits 3, and ssh to worker 3 fails.
+fake_ssh = '''
+import os, subprocess, sys
+args = sys.argv[1:]
+host, command = args[args.index('--') + 1:]
+with open(os.path.join(os.environ['FAKE_SSH_LOG'], host), 'w') as f:
+  f.write(' '.join(args))
+if host.endswith('.3'):
+  sys.exit(255)
+env = dict(os.environ, HOST=host)
+sys.exit(subprocess.call(command, shell=True, env=env))
+'''
+
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch, fleet):
+  script = tmp_path / 'fake_ssh.py'
+  script.write_text(fake_ssh)
+  log = tmp_path / 'ssh'
+  log.mkdir()
+  monkeypatch.setenv('TPUNICORN_SSH', '{} {}'.format(sys.executable, script))
+  monkeypatch.setenv('FAKE_SSH_LOG', str(log))
+  monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+  node = make_node('europe-west4-a', 'tpu-v3-32-euw4a-1', accelerator_type='v3-32', workers=4)
+  node['id'] = '1234'
+  fleet.append(node)
+  return log
+
+
+def pu_exec(*args):
+  return CliRunner(mix_stderr=False).invoke(tpunicorn.program.cli, ['exec', 'tpu-v3-32-euw4a-1', '-y'] + list(args))
+
+
+def test_exec_runs_on_every_worker(ssh):
+  result = pu_exec('--all-workers', '--', 'echo hi from $HOST; [ $HOST != 192.0.2.2 ] || exit 3')
+  assert sorted(result.stdout.splitlines()) == ['[0] hi from 192.0.2.0', '[1] hi from 192.0.2.1', '[2] hi from 192.0.2.2']
+  assert 'Worker 2 exited with status 3.' in result.stderr
+  assert 'Worker 3 exited with status 255 (ssh failed).' in result.stderr
+  assert '2 of 4 workers succeeded.' in result.stderr
+  assert result.exit_code == 255
+
+
+def test_exec_on_some_workers(ssh):
+  result = pu_exec('-w', '1', '-w', '2', '--', 'exit 0')
+  assert result.exit_code == 0
+  assert sorted(os.listdir(ssh)) == ['192.0.2.1', '192.0.2.2']
+  args = (ssh / '192.0.2.1').read_text().split()
+  assert 'HostKeyAlias=tpu.1234-1' in args
+  assert 'StrictHostKeyChecking=accept-new' in args
+  assert 'UserKnownHostsFile={}'.format(os.path.join(os.environ['HOME'], '.ssh', 'google_compute_known_hosts')) in args
+
+
+def test_exec_rejects_missing_workers(ssh):
+  result = pu_exec('-w', '9', '--', 'true')
+  assert result.exit_code != 0
+  assert 'has no worker 9' in result.stderr
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def nodes(zone, abbrev, *indices):
+  return [make_node(zone, 'tpu-v3-8-{}-{}'.format(abbrev, i)) for i in indices]
+
+
+def test_every_page_of_every_zone_is_listed(api):
+  api.pages['europe-west4-a'] = [nodes('europe-west4-a', 'euw4a', 0, 1), nodes('europe-west4-a', 'euw4a', 2), nodes('europe-west4-a', 'euw4a', 3)]
+  api.pages['us-central1-f'] = [nodes('us-central1-f', 'usc1f', 4)]
+  ids = sorted(tpunicorn.tpu.parse_tpu_id(node) for node in tpunicorn.tpu.iter_tpus(zone='europe-west4-a,us-central1-f'))
+  assert ids == ['tpu-v3-8-euw4a-0', 'tpu-v3-8-euw4a-1', 'tpu-v3-8-euw4a-2', 'tpu-v3-8-euw4a-3', 'tpu-v3-8-usc1f-4']
+  assert sorted(api.calls) == [('europe-west4-a', 0), ('europe-west4-a', 1), ('europe-west4-a', 2), ('us-central1-f', 0)]
+  assert [tpunicorn.tpu.parse_tpu_index(tpu) for tpu in tpunicorn.tpu.list_tpus()] == [0, 1, 2, 3, 4]
+
+
+def test_pages_async_follows_next_page_token(api):
+  api.pages['us-central1-a'] = [nodes('us-central1-a', 'usc1a', 0), [], nodes('us-central1-a', 'usc1a', 1)]
+  url = tpunicorn.tpu.api_list_nodes_url('us-central1-a')
+  async def pages():
+    return [page async for page in tpunicorn.tpu.iter_pages_async(url, 'nodes')]
+  assert [len(page) for page in asyncio.run(pages())] == [1, 0, 1]
+
+
+def counting(produced, closed, count=10000, pause=None):
+  async def agen():
+    try:
+      for i in range(count):
+        if pause is not None and i == 1:
+          await asyncio.sleep(pause)
+        produced.append(i)
+        yield i
+    finally:
+      closed.set()
+  return agen()
+
+
+def test_iter_sync_waits_for_a_slow_consumer():
+  produced = []
+  closed = threading.Event()
+  items = tpunicorn.tpu.iter_sync(counting(produced, closed), maxsize=4)
+  assert next(items) == 0
+  time.sleep(0.3)
+  # the queue, plus one item on its way in.
+  assert len(produced) <= 4 + 2
+  assert list(items) == list(range(1, 10000))
+  assert closed.wait(1)
+
+
+def test_iter_sync_stops_the_producer_when_the_consumer_does():
+  produced = []
+  closed = threading.Event()
+  items = tpunicorn.tpu.iter_sync(counting(produced, closed, pause=30), maxsize=4)
+  assert next(items) == 0
+  items.close()
+  # the producer was waiting on its next item; it's cancelled rather than
+  # left running.
+  assert closed.wait(1)
+  assert produced == [0]
+
+
+def test_iter_sync_raises_what_the_producer_raises():
+  async def agen():
+    yield 1
+    raise ValueError('page fetch failed')
+  items = tpunicorn.tpu.iter_sync(agen())
+  assert next(items) == 1
+  with pytest.raises(ValueError, match='page fetch failed'):
+    next(items)
@@ -0,0 +1,51 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def records(*nodes):
+  return tpunicorn.tpu.Fleet(list(nodes))
+
+
+def test_terms_must_all_match():
+  fleet = records(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='PREEMPTED'),
+                  make_node('europe-west4-a', 'tpu-v3-32-euw4a-2', accelerator_type='v3-32', state='PREEMPTED'),
+                  make_node('us-central1-f', 'tpu-v3-8-usc1f-3'))
+  ids = lambda expr: [tpu.id for tpu in tpunicorn.tpu.TpuFilter(expr).apply(fleet)]
+  assert ids('state=preempted') == ['tpu-v3-8-euw4a-1', 'tpu-v3-32-euw4a-2']
+  assert ids('state=PREEMPTED type=v3-8') == ['tpu-v3-8-euw4a-1']
+  assert ids('zone=usc1f') == ['tpu-v3-8-usc1f-3']
+  assert ids('id!=*-32-*') == ['tpu-v3-8-euw4a-1', 'tpu-v3-8-usc1f-3']
+  assert ids('index=2..3') == ['tpu-v3-32-euw4a-2', 'tpu-v3-8-usc1f-3']
+  assert ids('index>=2 index<3') == ['tpu-v3-32-euw4a-2']
+  assert ids('preemptible=no') == []
+
+
+def test_literal_terms_narrow_the_candidates():
+  fleet = records(*[make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i)) for i in range(10)],
+                  make_node('us-central1-f', 'tpu-v3-8-usc1f-10', state='PREEMPTED'))
+  assert [tpu.id for tpu in tpunicorn.tpu.TpuFilter('state=PREEMPTED').candidates(fleet)] == ['tpu-v3-8-usc1f-10']
+  assert len(tpunicorn.tpu.TpuFilter('state=PREEMPT*').candidates(fleet)) == 11
+
+
+@pytest.mark.parametrize('expr', ['state', 'colour=red', 'state>READY', 'age>soon'])
+def test_bad_terms_are_rejected(expr):
+  with pytest.raises(ValueError):
+    tpunicorn.tpu.TpuFilter(expr)
+
+
+def test_zone_terms_are_pushed_down(monkeypatch):
+  loads = []
+  def load_fleet(zone=None, project=None, cached=False, fresh=False):
+    loads.append(zone)
+    return tpunicorn.tpu.Fleet([])
+  monkeypatch.setattr(tpunicorn.tpu, 'load_fleet', load_fleet)
+  assert tpunicorn.tpu.TpuFilter('zone=euw4a,usc1f').push_down() == ['europe-west4-a', 'us-central1-f']
+  assert tpunicorn.tpu.TpuFilter('zone!=us-*').push_down() == ['asia-east1-c', 'europe-west4-a']
+  assert tpunicorn.tpu.TpuFilter('state=READY').push_down(zone='us-central1-a') == 'us-central1-a'
+  tpunicorn.tpu.get_fleet(filter='zone=euw4a,usc1f state=READY')
+  tpunicorn.tpu.get_fleet(filter='zone=euw4a', zone='us-central1-f')
+  tpunicorn.tpu.get_fleet(filter='state=READY')
+  assert loads == ['europe-west4-a,us-central1-f', None]
@@ -0,0 +1,41 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def fleet_of(*indices):
+  return tpunicorn.tpu.Fleet([make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i)) for i in indices])
+
+
+def test_next_available_index_skips_runs_of_used_indices():
+  fleet = fleet_of(0, 1, 2, 5, 6, 9)
+  assert fleet.next_available_index(0) == 3
+  assert fleet.next_available_index(2) == 3
+  assert fleet.next_available_index(3) == 3
+  assert fleet.next_available_index(5) == 7
+  assert fleet.next_available_index(9) == 10
+  assert fleet_of().next_available_index(4) == 4
+
+
+def test_get_by_id_or_index():
+  fleet = tpunicorn.tpu.Fleet([make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'),
+                               make_node('us-central1-f', 'tpu-v3-8-usc1f-2'),
+                               make_node('us-central1-a', 'tpu-v2-8-usc1a-2', accelerator_type='v2-8')])
+  assert fleet.get('tpu-v3-8-euw4a-1').zone == 'europe-west4-a'
+  assert fleet.get(1).id == 'tpu-v3-8-euw4a-1'
+  assert fleet.get('1').id == 'tpu-v3-8-euw4a-1'
+  with pytest.raises(ValueError, match='Multiple TPUs'):
+    fleet.get(2)
+  with pytest.raises(ValueError, match='No TPUs'):
+    fleet.get('tpu-v3-8-euw4a-9')
+  assert fleet.get('tpu-v3-8-euw4a-9', silent=True) is None
+
+
+def test_match_and_select():
+  fleet = tpunicorn.tpu.Fleet([make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i), state='PREEMPTED' if i % 2 else 'READY')
+                               for i in range(6)])
+  assert [tpu.index for tpu in fleet.match(['1..3', 'tpu-v3-8-euw4a-5', '*-euw4a-2'])] == [1, 2, 3, 5]
+  assert [tpu.index for tpu in fleet.select(zone='europe-west4-a', state='PREEMPTED')] == [1, 3, 5]
+  assert fleet.select(zone='us-central1-f') == []
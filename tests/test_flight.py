@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def callers(f, count, *args):
+  with futures.ThreadPoolExecutor(max_workers=count) as executor:
+    jobs = [executor.submit(f, *args) for _ in range(count)]
+    return [job.result() for job in jobs]
+
+
+def test_concurrent_calls_share_one_call():
+  calls = []
+  gate = threading.Event()
+  @tpunicorn.tpu.single_flight
+  def fetch(key):
+    calls.append(key)
+    gate.wait(5)
+    return [key]
+  threading.Timer(0.2, gate.set).start()
+  results = callers(fetch, 8, 'a')
+  assert calls == ['a']
+  assert results == [['a']] * 8 and all(result is results[0] for result in results)
+  assert fetch.stats() == {'calls': 8, 'coalesced': 7, 'inflight': 0}
+  # once it's landed, the next call is a new flight.
+  assert fetch('a') == ['a'] and calls == ['a', 'a']
+
+
+def test_every_waiter_sees_the_error():
+  gate = threading.Event()
+  @tpunicorn.tpu.single_flight
+  def fetch():
+    gate.wait(5)
+    raise RuntimeError('quota exceeded')
+  threading.Timer(0.2, gate.set).start()
+  with futures.ThreadPoolExecutor(max_workers=4) as executor:
+    jobs = [executor.submit(fetch) for _ in range(4)]
+    for job in jobs:
+      with pytest.raises(RuntimeError, match='quota exceeded'):
+        job.result()
+
+
+def test_coroutines_share_one_call():
+  calls = []
+  @tpunicorn.tpu.single_flight
+  async def fetch(key):
+    calls.append(key)
+    await asyncio.sleep(0.05)
+    return key
+  async def main():
+    return await asyncio.gather(*[fetch('a') for _ in range(5)], fetch('b'))
+  assert asyncio.run(main()) == ['a'] * 5 + ['b']
+  assert calls == ['a', 'b']
+
+
+def test_memoize_expires_and_coalesces_misses():
+  calls = []
+  gate = threading.Event()
+  @tpunicorn.tpu.memoize(expire=0.5)
+  def fetch(key):
+    calls.append(key)
+    gate.wait(5)
+    return len(calls)
+  threading.Timer(0.1, gate.set).start()
+  assert callers(fetch, 4, 'a') == [1] * 4
+  assert fetch('a') == 1
+  time.sleep(0.5)
+  assert fetch('a') == 2
+  fetch.cache_clear()
+  assert fetch('a') == 3
+  assert fetch.stats()['coalesced'] == 3
+
+
+def test_concurrent_fleet_fetches_are_coalesced(api):
+  api.pages['europe-west4-a'] = [[make_node('europe-west4-a', 'tpu-v3-8-euw4a-1')], [make_node('europe-west4-a', 'tpu-v3-8-euw4a-2')]]
+  api.gate = threading.Event()
+  threading.Timer(0.2, api.gate.set).start()
+  fleets = callers(lambda: tpunicorn.tpu.fetch_tpus(zone='europe-west4-a'), 6)
+  assert [len(tpus) for tpus in fleets] == [2] * 6
+  assert sorted(api.calls) == [('europe-west4-a', 0), ('europe-west4-a', 1)]
@@ -0,0 +1,69 @@
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def test_spec_records_the_fields_it_references():
+  spec = tpunicorn.tpu.FormatSpec('{id:{id_w}} {zone} {status!s:>{health_w}} {{literal}}')
+  assert spec.fields == ['id', 'zone', 'status', 'health']
+
+
+def test_spec_compiles_widths_in():
+  render = tpunicorn.tpu.FormatSpec('{id:{id_w}}|{index:<{index_w}}|{{x}}').compile({'id_w': 6, 'index_w': 3})
+  assert render({'id': 'tpu', 'index': 7}) == 'tpu   |7  |{x}'
+
+
+def test_unknown_fields_are_rejected():
+  with pytest.raises(ValueError, match="'bogus'"):
+    tpunicorn.tpu.FormatSpec('{id} {bogus}')
+  with pytest.raises(ValueError, match="'bogus'"):
+    tpunicorn.tpu.FormatSpec('{id:{bogus_w}}')
+
+
+def test_delimited_rows_quote_as_needed():
+  tpus = [make_node('us-central1-f', 'tpu-v3-8-usc1f-0'), make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', network='a,b')]
+  assert list(tpunicorn.tpu.render_delimited(tpus, columns=['id', 'network'])) == [
+    'ID,NETWORK', 'tpu-v3-8-usc1f-0,default', 'tpu-v3-8-euw4a-1,"a,b"']
+  assert list(tpunicorn.tpu.render_delimited(tpus[:1], columns=['index', 'zone'], delimiter='\t', header=False)) == [
+    '0\tus-central1-f']
+
+
+@pytest.fixture
+def listing(fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-32-euw4a-1', accelerator_type='v3-32', state='PREEMPTED'))
+  fleet.append(make_node('us-central1-f', 'tpu-v3-8-usc1f-0'))
+  def run(*args):
+    return CliRunner().invoke(tpunicorn.program.cli, ['list', *args])
+  return run
+
+
+def test_list_csv_columns(listing):
+  result = listing('--format', 'csv', '--columns', 'id,type,status')
+  assert result.exit_code == 0, result.output
+  assert result.output.splitlines() == ['ID,TYPE,STATUS', 'tpu-v3-32-euw4a-1,v3-32,PREEMPTED', 'tpu-v3-8-usc1f-0,v3-8,READY']
+
+
+def test_list_template(listing):
+  result = listing('--format', 'template={id}@{zone}')
+  assert result.exit_code == 0, result.output
+  assert result.output.splitlines() == ['tpu-v3-32-euw4a-1@europe-west4-a', 'tpu-v3-8-usc1f-0@us-central1-f']
+
+
+def test_list_text_columns(listing):
+  result = listing('--columns', 'id,status', '--no-color')
+  assert result.exit_code == 0, result.output
+  assert [line.split() for line in result.output.splitlines()] == [
+    ['ID', 'STATUS'], ['tpu-v3-32-euw4a-1', 'PREEMPTED'], ['tpu-v3-8-usc1f-0', 'READY']]
+
+
+def test_list_rejects_unknown_fields(listing):
+  result = listing('--format', 'template={id} {bogus}')
+  assert result.exit_code == 2
+  assert "Unknown format field 'bogus'" in result.output
+  result = listing('--columns', 'id,bogus')
+  assert result.exit_code == 2
+  assert "Unknown column 'bogus'" in result.output
@@ -0,0 +1,96 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+hour = 3600.0
+
+
+def record(zone, name, **kws):
+  return tpunicorn.tpu.TpuRecord.wrap(make_node(zone, name, **kws))
+
+
+euw4a = record('europe-west4-a', 'tpu-v3-8-euw4a-1')
+usc1f = record('us-central1-f', 'tpu-v3-8-usc1f-2')
+
+
+def at(tpu, age):
+  # the time at which `tpu` is `age` seconds old.
+  return tpu.created_at + age
+
+
+@pytest.fixture
+def history():
+  """Ten hours of exposure in europe-west4-a's fourth hour of age, with
+  two preemptions there."""
+  history = tpunicorn.tpu.PreemptionHistory()
+  history.observe(euw4a, 10 * hour, now=at(euw4a, 3.5 * hour))
+  history.observe(record('us-central1-f', 'tpu-v3-8-usc1f-3', preemptible=False), 10 * hour, now=at(euw4a, 3.5 * hour))
+  history.preempted(euw4a, now=at(euw4a, 3.5 * hour))
+  history.preempted(euw4a, now=at(euw4a, 3.9 * hour))
+  return history
+
+
+def test_no_history_is_one_preemption_a_day():
+  history = tpunicorn.tpu.PreemptionHistory()
+  assert history.rate() == pytest.approx(1 / 24)
+  assert history.hazard('europe-west4-a', 3.5 * hour) == pytest.approx(1 / 24)
+
+
+def test_hazard_shrinks_towards_the_overall_rate(history):
+  rate = 3 / 34
+  assert history.rate() == pytest.approx(rate)
+  assert history.hazard('europe-west4-a', 3.5 * hour) == pytest.approx((2 + 2 * rate) / 12)
+  assert history.hazard('europe-west4-a', 5.5 * hour) == pytest.approx(rate)
+  assert history.hazard('us-central1-f', 3.5 * hour) == pytest.approx(rate)
+
+
+def test_history_is_kept_in_the_cache_dir(history):
+  history.save()
+  again = tpunicorn.tpu.PreemptionHistory()
+  assert again.path == history.path
+  assert again.hazard('europe-west4-a', 3.5 * hour) == pytest.approx(history.hazard('europe-west4-a', 3.5 * hour))
+
+
+@pytest.fixture
+def babysitter(history, monkeypatch):
+  monkeypatch.setattr(tpunicorn.tpu.random, 'uniform', lambda lo, hi: 1.0)
+  return tpunicorn.tpu.Babysitter(['*'], interval=60.0, min_interval=20.0, max_interval=240.0, history=history)
+
+
+def test_check_interval_follows_the_hazard(babysitter, history):
+  rate = history.rate()
+  assert babysitter.check_interval(euw4a, now=at(euw4a, 3.5 * hour)) == pytest.approx(60 * rate / history.hazard('europe-west4-a', 3.5 * hour))
+  assert babysitter.check_interval(usc1f, now=at(usc1f, 3.5 * hour)) == pytest.approx(60)
+  assert babysitter.check_interval(record('us-central1-f', 'tpu-v3-8-usc1f-3', preemptible=False)) == 240
+  babysitter.recovering[usc1f.id] = True
+  assert babysitter.check_interval(usc1f, now=at(usc1f, 3.5 * hour)) == 20
+
+
+def test_check_interval_looks_in_at_24_hours(babysitter):
+  assert babysitter.check_interval(usc1f, now=at(usc1f, 24 * hour - 30)) == pytest.approx(30)
+  assert babysitter.check_interval(usc1f, now=at(usc1f, 24 * hour - 5)) == pytest.approx(20)
+
+
+def test_tokens_pace_fetches(babysitter):
+  babysitter.tokens, babysitter.refilled = 3, 1000.0
+  assert [babysitter.take_token(1000.0) for _ in range(4)] == [0.0, 0.0, 0.0, 60.0]
+  assert babysitter.take_token(1030.0) == pytest.approx(30.0)
+  assert babysitter.take_token(1060.0) == 0.0
+  # a long quiet spell only banks a burst's worth.
+  babysitter.take_token(100000.0)
+  assert babysitter.tokens == 2
+
+
+def test_only_zones_due_soon_are_fetched(babysitter):
+  babysitter.next_full = 2000.0
+  babysitter.zones.update({euw4a.id: euw4a.zone, usc1f.id: usc1f.zone})
+  babysitter.schedule(euw4a.id, 1010.0)
+  babysitter.schedule(usc1f.id, 1500.0)
+  assert babysitter.due_zones(1000.0) == 'europe-west4-a'
+  assert babysitter.due_zones(1490.0) == 'europe-west4-a,us-central1-f'
+  assert babysitter.due_zones(2000.0) is None
+  # a rescheduled TPU's old slot is skipped.
+  babysitter.schedule(euw4a.id, 1100.0)
+  assert babysitter.next_due() == 1100.0
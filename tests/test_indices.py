@@ -0,0 +1,24 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def fleet_of(*indices):
+  return tpunicorn.tpu.Fleet([make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i)) for i in indices])
+
+
+def test_allocate_tpu_indices():
+  fleet = fleet_of(0, 1, 2, 5, 6, 9)
+  assert tpunicorn.tpu.allocate_tpu_indices('+', fleet) == [3]
+  assert tpunicorn.tpu.allocate_tpu_indices('20+', fleet) == [20]
+  assert tpunicorn.tpu.allocate_tpu_indices('4x+', fleet) == [3, 4, 7, 8]
+  assert tpunicorn.tpu.allocate_tpu_indices('3x5+', fleet) == [7, 8, 10]
+  assert tpunicorn.tpu.allocate_tpu_indices('4..6', fleet) == [4, 5, 6]
+
+
+@pytest.mark.parametrize('spec', ['x+', '3x', '6..4', 'a..b', ''])
+def test_allocate_tpu_indices_rejects_bad_specs(spec):
+  with pytest.raises(ValueError):
+    tpunicorn.tpu.allocate_tpu_indices(spec, fleet_of())
@@ -0,0 +1,62 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def offline_fleet(monkeypatch):
+  def get_fleet(*args, **kws):
+    raise AssertionError('looked up the fleet')
+  monkeypatch.setattr(tpunicorn.tpu, 'get_fleet', get_fleet)
+
+
+vm = make_node('europe-west4-a', 'tpu-v3-8-euw4a-3')
+legacy = make_node('europe-west4-a', 'tpu-v3-8-euw4a-4', version='2.4.1')
+
+
+class FakeOperation:
+  def __init__(self):
+    self.waited = False
+
+  def wait(self):
+    self.waited = True
+    return self
+
+
+@pytest.fixture
+def operations(monkeypatch):
+  """Record api_node_operation calls instead of making them."""
+  calls = []
+  def api_node_operation(method, tpu, **kws):
+    calls.append((method, tpunicorn.tpu.parse_tpu_id(tpu), kws.get('action')))
+    return FakeOperation()
+  monkeypatch.setattr(tpunicorn.tpu, 'api_node_operation', api_node_operation)
+  return calls
+
+
+def test_rest_is_the_default_backend(offline_fleet, operations):
+  call = tpunicorn.tpu.lifecycle_command('stop', vm)
+  assert isinstance(call, tpunicorn.tpu.LifecycleCall)
+  assert str(call) == tpunicorn.tpu.stop_tpu_command(vm)
+  assert operations == []
+  assert call().waited
+  assert operations == [('POST', 'tpu-v3-8-euw4a-3', 'stop')]
+  assert not tpunicorn.tpu.lifecycle_command('delete', legacy, async_=True)().waited
+  assert operations[-1] == ('DELETE', 'tpu-v3-8-euw4a-4', None)
+
+
+def test_gcloud_backend(offline_fleet, operations, monkeypatch):
+  assert tpunicorn.tpu.lifecycle_command('delete', vm, backend='gcloud') == tpunicorn.tpu.delete_tpu_command(vm)
+  monkeypatch.setenv('TPUNICORN_BACKEND', 'gcloud')
+  assert tpunicorn.tpu.lifecycle_command('start', legacy) == tpunicorn.tpu.start_tpu_command(legacy)
+  monkeypatch.setenv('TPUNICORN_BACKEND', 'carrier-pigeon')
+  with pytest.raises(ValueError, match='carrier-pigeon'):
+    tpunicorn.tpu.lifecycle_command('start', legacy)
+  assert operations == []
+
+
+def test_tpu_vms_are_reimaged_with_gcloud(offline_fleet):
+  assert tpunicorn.tpu.lifecycle_command('reimage', vm) == tpunicorn.tpu.reimage_tpu_command(vm)
+  assert isinstance(tpunicorn.tpu.lifecycle_command('reimage', legacy, version='2.5.0'), tpunicorn.tpu.LifecycleCall)
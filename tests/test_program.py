@@ -0,0 +1,87 @@
+import time
+
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+class FakeOperation:
+  def wait(self, *args, **kws):
+    return self
+
+
+def fake_lifecycle(monkeypatch, failures):
+  """Make lifecycle_command hand out LifecycleCalls whose create fails
+  `failures` times before succeeding; returns the list of create calls."""
+  creates = []
+  def create(tpu, **kws):
+    creates.append(tpu)
+    if len(creates) <= failures:
+      raise RuntimeError('There is no more capacity in the zone')
+    return FakeOperation()
+  def lifecycle_command(verb, tpu, async_=False, backend=None, **kws):
+    operation = create if verb == 'create' else (lambda tpu, **kws: FakeOperation())
+    return tpunicorn.tpu.LifecycleCall('gcloud compute tpus {} {}'.format(verb, tpunicorn.tpu.parse_tpu_id(tpu)),
+                                       operation, tpu, async_=async_)
+  monkeypatch.setattr(tpunicorn.tpu, 'lifecycle_command', lifecycle_command)
+  monkeypatch.setattr(tpunicorn.program, 'wait_healthy', lambda *args, **kws: None)
+  monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+  return creates
+
+
+def test_do_step_returns_status_of_failed_lifecycle_call(monkeypatch):
+  fake_lifecycle(monkeypatch, failures=1)
+  call = tpunicorn.tpu.lifecycle_command('create', 'tpu-v3-8-euw4a-3')
+  assert tpunicorn.program.do_step('create', call, check=False) == 1
+
+
+def test_recreate_retries_failed_create(monkeypatch, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-3', state='PREEMPTED'))
+  creates = fake_lifecycle(monkeypatch, failures=2)
+  result = CliRunner().invoke(tpunicorn.program.cli, ['recreate', 'tpu-v3-8-euw4a-3', '--yes', '--retry', '1'])
+  assert result.exit_code == 0, result.output
+  assert len(creates) == 3
+  assert 'trying again' in result.output
+
+
+def test_recreate_without_retry_gives_up(monkeypatch, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-3', state='PREEMPTED'))
+  creates = fake_lifecycle(monkeypatch, failures=1)
+  result = CliRunner().invoke(tpunicorn.program.cli, ['recreate', 'tpu-v3-8-euw4a-3', '--yes'])
+  assert result.exit_code == 1
+  assert len(creates) == 1
+
+
+def fake_race(monkeypatch, failures, leftovers=()):
+  """Make race_create_tpu fail `failures` times before the TPU comes up in
+  its first fallback zone; returns the list of races."""
+  races = []
+  def race_create_tpu(tpu, zones, **kws):
+    races.append(zones)
+    if len(races) <= failures:
+      raise RuntimeError('Could not create TPU {} in any of {}'.format(tpu.id, ', '.join(zones)))
+    return zones[1], list(leftovers)
+  monkeypatch.setattr(tpunicorn.tpu, 'race_create_tpu', race_create_tpu)
+  return races
+
+
+def test_recreate_retries_failed_race(monkeypatch, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-3', state='PREEMPTED'))
+  fake_lifecycle(monkeypatch, failures=0)
+  races = fake_race(monkeypatch, failures=2)
+  result = CliRunner().invoke(tpunicorn.program.cli, ['recreate', 'tpu-v3-8-euw4a-3', '--yes', '--retry', '1', '-fz', 'usc1f'])
+  assert result.exit_code == 0, result.output
+  assert races == [['europe-west4-a', 'us-central1-f']] * 3
+  assert 'came up in us-central1-f' in result.output
+
+
+def test_recreate_fails_when_a_raced_tpu_is_left_behind(monkeypatch, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-3', state='PREEMPTED'))
+  fake_lifecycle(monkeypatch, failures=0)
+  fake_race(monkeypatch, failures=0, leftovers=['europe-west4-a: Deleting failed'])
+  result = CliRunner(mix_stderr=False).invoke(tpunicorn.program.cli, ['recreate', 'tpu-v3-8-euw4a-3', '--yes', '-fz', 'usc1f'])
+  assert result.exit_code == 1
+  assert 'may still exist in europe-west4-a: Deleting failed' in result.stderr
@@ -0,0 +1,121 @@
+from concurrent import futures
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+class FakeOperation:
+  def __init__(self, events, kind, zone):
+    self.events = events
+    self.kind = kind
+    self.zone = zone
+    self.name = 'operations/{}-{}'.format(kind, zone)
+    self.range = None
+
+  def cancel(self):
+    self.events.append(('cancel', self.zone))
+
+
+class FakeTracker:
+  """Creates in `winners` come up as soon as the race is run, and the
+  rest only finish once they're waited out; with no winners, the race
+  times out. Deletes in `stuck` fail."""
+  winners = ()
+  stuck = ()
+
+  def __init__(self, project=None):
+    self.operations = []
+
+  def watch_operation(self, op):
+    future = futures.Future()
+    self.operations.append((op, future))
+    return future
+
+  def finish(self, op, future):
+    self.operations.remove((op, future))
+    op.events.append(('done', op.kind, op.zone))
+    if op.kind == 'delete' and op.zone in self.stuck:
+      future.set_exception(RuntimeError('Deleting failed'))
+    else:
+      future.set_result(True)
+
+  def run(self, timeout=None, until=None):
+    if until is None:
+      for op, future in list(self.operations):
+        self.finish(op, future)
+      return
+    if not self.winners:
+      raise TimeoutError('Still waiting')
+    for op, future in list(self.operations):
+      if op.zone in self.winners:
+        self.finish(op, future)
+
+
+@pytest.fixture
+def race(fleet, monkeypatch):
+  events = []
+  creates = {}
+  def create_tpu(tpu, zone=None, range=None, **kws):
+    op = creates[zone] = FakeOperation(events, 'create', zone)
+    op.range = range
+    return op
+  def api_node_operation(method, tpu, zone=None, **kws):
+    events.append((method, zone))
+    return FakeOperation(events, 'delete', zone)
+  monkeypatch.setattr(tpunicorn.tpu, 'create_tpu', create_tpu)
+  monkeypatch.setattr(tpunicorn.tpu, 'Tracker', FakeTracker)
+  monkeypatch.setattr(tpunicorn.tpu, 'api_node_operation', api_node_operation)
+  return fleet, creates, events
+
+
+def test_legacy_tpus_race_with_distinct_ranges(race, monkeypatch):
+  fleet, creates, events = race
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', version='1.15.5', cidr='10.48.1.0/29'))
+  fleet.append(make_node('us-central1-f', 'tpu-v3-8-usc1f-0', version='1.15.5', cidr='10.48.0.0/29'))
+  monkeypatch.setattr(FakeTracker, 'winners', ('us-central1-a',))
+  tpu = tpunicorn.tpu.get_fleet().get('tpu-v3-8-euw4a-1')
+  assert tpunicorn.tpu.race_create_tpu(tpu, ['europe-west4-a', 'us-central1-a', 'us-central1-f']) == ('us-central1-a', [])
+  ranges = [creates[zone].range for zone in ['europe-west4-a', 'us-central1-a', 'us-central1-f']]
+  assert ranges[0] is None
+  assert ranges[1:] == ['10.48.0.8/29', '10.48.0.16/29']
+
+
+def test_losers_are_waited_out_then_deleted(race, monkeypatch):
+  fleet, creates, events = race
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  monkeypatch.setattr(FakeTracker, 'winners', ('us-central1-a',))
+  tpu = tpunicorn.tpu.get_fleet().get('tpu-v3-8-euw4a-1')
+  tpunicorn.tpu.race_create_tpu(tpu, ['europe-west4-a', 'us-central1-a', 'us-central1-f'])
+  assert ('cancel', 'us-central1-a') not in events
+  assert ('DELETE', 'us-central1-a') not in events
+  for zone in ['europe-west4-a', 'us-central1-f']:
+    cancel = events.index(('cancel', zone))
+    created = events.index(('done', 'create', zone))
+    delete = events.index(('DELETE', zone))
+    deleted = events.index(('done', 'delete', zone))
+    assert cancel < created < delete < deleted
+
+
+def test_losers_that_could_not_be_deleted_are_reported(race, monkeypatch, caplog):
+  fleet, creates, events = race
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  monkeypatch.setattr(FakeTracker, 'winners', ('europe-west4-a',))
+  monkeypatch.setattr(FakeTracker, 'stuck', ('us-central1-f',))
+  tpu = tpunicorn.tpu.get_fleet().get('tpu-v3-8-euw4a-1')
+  winner, leftovers = tpunicorn.tpu.race_create_tpu(tpu, ['europe-west4-a', 'us-central1-f'])
+  assert winner == 'europe-west4-a'
+  assert leftovers == ['us-central1-f: Deleting failed']
+  assert [r.levelname for r in caplog.records if 'Could not delete' in r.getMessage()] == ['WARNING']
+
+
+def test_timed_out_race_cleans_up_every_create(race):
+  fleet, creates, events = race
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  tpu = tpunicorn.tpu.get_fleet().get('tpu-v3-8-euw4a-1')
+  with pytest.raises(TimeoutError):
+    tpunicorn.tpu.race_create_tpu(tpu, ['europe-west4-a', 'us-central1-a'], timeout=1)
+  for zone in ['europe-west4-a', 'us-central1-a']:
+    assert events.index(('done', 'create', zone)) < events.index(('DELETE', zone)) < events.index(('done', 'delete', zone))
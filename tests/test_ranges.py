@@ -0,0 +1,61 @@
+import ipaddress
+import random
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def test_reserve_merges_overlapping_and_adjacent_blocks():
+  ranges = tpunicorn.tpu.RangeIndex()
+  ranges.reserve('10.48.0.0/29')
+  ranges.reserve('10.48.0.16/29')
+  ranges.reserve('10.48.0.8/29')
+  assert len(ranges.starts['default']) == 1
+  assert not ranges.is_free('10.48.0.0/27')
+  assert ranges.is_free('10.48.0.24/29')
+  assert ranges.is_free('10.48.0.0/29', network='other')
+
+
+def test_allocate_prefers_the_conventional_block():
+  ranges = tpunicorn.tpu.RangeIndex()
+  assert ranges.allocate_tpu_range(3, 8) == '10.48.3.0/29'
+  assert ranges.allocate_tpu_range(3, 8) == '10.48.0.0/29'
+  assert ranges.allocate_tpu_range(3, 256) == '10.5.0.0/26'
+
+
+def test_allocate_skips_used_blocks():
+  tpus = [tpunicorn.tpu.TpuRecord(make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i), cidr=cidr))
+          for i, cidr in enumerate(['10.48.0.0/29', '10.48.0.8/29', '10.48.0.24/29'])]
+  ranges = tpunicorn.tpu.RangeIndex(tpus)
+  assert ranges.allocate(29, within='10.48.0.0/16') == '10.48.0.16/29'
+  assert ranges.allocate(29, within='10.48.0.0/16') == '10.48.0.32/29'
+  # pods stay out of the 8-core block.
+  assert ranges.allocate(16, exclude=['10.48.0.0/16'], preferred='10.48.0.0/16') == '10.0.0.0/16'
+
+
+def test_allocate_fails_when_full():
+  ranges = tpunicorn.tpu.RangeIndex()
+  ranges.reserve('10.48.0.0/28')
+  ranges.allocate(29, within='10.48.0.0/27')
+  ranges.allocate(29, within='10.48.0.0/27')
+  with pytest.raises(ValueError):
+    ranges.allocate(29, within='10.48.0.0/27')
+
+
+def test_allocate_finds_the_lowest_free_block():
+  rng = random.Random(0)
+  for _ in range(50):
+    ranges = tpunicorn.tpu.RangeIndex()
+    used = []
+    for _ in range(rng.randrange(1, 40)):
+      block = '10.48.{}.{}/{}'.format(rng.randrange(4), rng.randrange(0, 256, 8), rng.choice([29, 28, 27]))
+      ranges.reserve(block)
+      used.append(ipaddress.ip_network(block, strict=False))
+    prefixlen = rng.choice([29, 28, 26, 24])
+    # the slow way: every aligned block in order.
+    lowest = next((block for block in ipaddress.ip_network('10.48.0.0/16').subnets(new_prefix=prefixlen)
+                   if not any(block.overlaps(x) for x in used + [ipaddress.ip_network('10.48.1.0/24')])), None)
+    assert ranges.allocate(prefixlen, within='10.48.0.0/16', exclude=['10.48.1.0/24']) == str(lowest)
@@ -0,0 +1,42 @@
+import json
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def record(**kws):
+  node = make_node('europe-west4-a', 'tpu-v3-32-euw4a-7', accelerator_type='v3-32', workers=4, cidr='10.9.0.0/27', **kws)
+  node['id'] = '1234'
+  node['dataDisks'] = [{'sourceDisk': 'projects/proj/zones/europe-west4-a/disks/data', 'mode': 'READ_ONLY'}]
+  return node, tpunicorn.tpu.TpuRecord(node)
+
+
+def test_fields_are_parsed_once():
+  node, tpu = record()
+  assert (tpu.project, tpu.zone, tpu.id, tpu.index, tpu.type) == ('proj', 'europe-west4-a', 'tpu-v3-32-euw4a-7', 7, 'v3-32')
+  assert (tpu.state, tpu.health, tpu.preemptible, tpu.range, tpu.network) == ('READY', 'HEALTHY', True, '10.9.0.0/27', 'default')
+  assert tpu.master == '10.0.0.0:8470'
+  assert tpu.created_at == 1792285323
+  assert json.loads(tpunicorn.tpu.as_json(tpu)) == node
+
+
+def test_helpers_do_not_decode_the_node():
+  node, tpu = record()
+  assert tpunicorn.tpu.parse_tpu_worker_ips(tpu) == ['192.0.2.{}'.format(w) for w in range(4)]
+  assert tpunicorn.tpu.parse_tpu_worker_ips(tpu, internal_only=True) == ['10.0.0.{}'.format(w) for w in range(4)]
+  assert tpunicorn.tpu.get_ssh_host_key_alias(tpu, 3) == 'tpu.1234-3'
+  assert tpunicorn.tpu.parse_tpu_data_disk(tpu) == 'source=projects/proj/zones/europe-west4-a/disks/data,mode=read-only'
+  assert tpu.node is None
+  # and they agree with the plain node.
+  assert tpunicorn.tpu.parse_tpu_worker_ips(node) == tpunicorn.tpu.parse_tpu_worker_ips(tpu)
+  assert tpunicorn.tpu.get_ssh_host_key_alias(node, 3) == 'tpu.1234-3'
+
+
+def test_node_is_decoded_once():
+  node, tpu = record()
+  assert tpu['acceleratorType'] == 'v3-32'
+  raw = tpu.raw
+  assert tpu.get('missing', 'default') == 'default'
+  assert 'cidrBlock' in tpu and tpu.raw is raw
+  assert tpu['name'] == node['name']
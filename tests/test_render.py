@@ -0,0 +1,47 @@
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def tpus(monkeypatch):
+  # rendering must not go back to the fleet for its column widths.
+  def format_widths(project=None):
+    raise AssertionError('render_table called format_widths')
+  monkeypatch.setattr(tpunicorn.tpu, 'format_widths', format_widths)
+  return [make_node('us-central1-f', 'tpu-v3-8-usc1f-0'),
+          make_node('europe-west4-a', 'tpu-v3-32-euw4a-12', accelerator_type='v3-32', state='CREATING')]
+
+
+def test_table_columns_line_up(tpus):
+  lines = [line for tpu, args, line in tpunicorn.tpu.render_table(tpus)]
+  assert len(lines) == 3
+  header = lines[0]
+  for column in ['INDEX', 'TYPE', 'ID', 'STATUS', 'HEALTH', 'VERSION']:
+    start = header.index(column)
+    # every row has a value starting in each header's column.
+    for line in lines[1:]:
+      assert line[start] != ' ' and line[start - 1] == ' '
+      assert len(line) == len(header)
+  assert lines[2].split()[:2] == ['europe-west4-a', '12']
+
+
+def test_widths_come_from_the_rows(tpus):
+  rows = list(tpunicorn.tpu.render_table(tpus, spec='{id:{id_w}}|{status:{status_w}}|'))
+  assert rows[0][2] == 'ID                 |STATUS   |'
+  assert rows[1][2] == 'tpu-v3-8-usc1f-0   |READY    |'
+  assert rows[2][2] == 'tpu-v3-32-euw4a-12 |CREATING |'
+
+
+def test_only_the_spec_fields_are_computed(tpus):
+  rows = list(tpunicorn.tpu.render_table(tpus, spec='{id} {status}', header=False))
+  assert [args for tpu, args, line in rows] == [{'id': 'tpu-v3-8-usc1f-0', 'status': 'READY'},
+                                                {'id': 'tpu-v3-32-euw4a-12', 'status': 'CREATING'}]
+  assert [line for tpu, args, line in rows] == ['tpu-v3-8-usc1f-0 READY', 'tpu-v3-32-euw4a-12 CREATING']
+
+
+def test_given_widths_are_used(tpus):
+  rows = list(tpunicorn.tpu.render_table(tpus[:1], spec='{id:{id_w}}|', header=False, widths={'id_w': 20}))
+  assert rows[0][2] == 'tpu-v3-8-usc1f-0    |'
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+import time
+
+import tpunicorn.tpu
+
+from conftest import FakeSession, make_node, zones
+
+
+class CountingSession(FakeSession):
+  """A FakeSession that records how many gets are in flight at once."""
+
+  def __init__(self, delay=0.05):
+    super().__init__()
+    self.delay = delay
+    self.inflight = 0
+    self.peak = 0
+
+  def get(self, url, headers=None, params=None):
+    with self.lock:
+      self.inflight += 1
+      self.peak = max(self.peak, self.inflight)
+    try:
+      time.sleep(self.delay)
+      return super().get(url, headers=headers, params=params)
+    finally:
+      with self.lock:
+        self.inflight -= 1
+
+
+def test_request_fans_out_every_zone_at_once(api):
+  # every zone's get must be in flight before any of them may answer.
+  barrier = threading.Barrier(len(zones), timeout=5)
+  get = api.get
+  def gated(url, headers=None, params=None):
+    barrier.wait()
+    return get(url, headers=headers, params=params)
+  api.get = gated
+  for zone in zones:
+    api.pages[zone] = [[make_node(zone, 'tpu-v3-8-{}-0'.format(zone))]]
+  bodies = tpunicorn.tpu.request('projects.locations.nodes', project='proj', zone=zones)
+  assert [body['nodes'][0]['name'].split('/')[3] for body in bodies] == zones
+  assert sorted(api.calls) == [(zone, 0) for zone in zones]
+
+
+def test_request_concurrency_is_bounded(monkeypatch):
+  session = CountingSession()
+  monkeypatch.setattr(tpunicorn.tpu, 'get_requests_session', lambda *args, **kws: session)
+  monkeypatch.setattr(tpunicorn.tpu, 'get_headers', lambda headers=None, project=None: {})
+  tpunicorn.tpu.request('projects.locations.nodes', project='proj', zone=zones, concurrency=2)
+  assert len(session.calls) == len(zones)
+  assert session.peak == 2
+
+
+def test_request_runs_inside_an_event_loop(api):
+  api.pages['us-central1-f'] = [[make_node('us-central1-f', 'tpu-v3-8-usc1f-0')]]
+  async def handler():
+    return tpunicorn.tpu.request('projects.locations.nodes', project='proj', zone='us-central1-f')
+  body = asyncio.run(handler())
+  assert [node['name'] for node in body['nodes']] == ['projects/proj/locations/us-central1-f/nodes/tpu-v3-8-usc1f-0']
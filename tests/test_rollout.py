@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def tpus(count, **kws):
+  return [tpunicorn.tpu.TpuRecord(make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(i), **kws)) for i in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def fast_polls(monkeypatch):
+  monkeypatch.setenv('TPUNICORN_POLL_MIN', '0.01')
+  monkeypatch.setenv('TPUNICORN_POLL_MAX', '0.01')
+
+
+class Begin:
+  """Stands in for the operation: takes a moment, and notes how many TPUs
+  were out of service at once."""
+
+  def __init__(self, fail=()):
+    self.fail = set(fail)
+    self.lock = threading.Lock()
+    self.busy = 0
+    self.most = 0
+
+  def __call__(self, tpu):
+    with self.lock:
+      self.busy += 1
+      self.most = max(self.most, self.busy)
+    time.sleep(0.05)
+    with self.lock:
+      self.busy -= 1
+    if tpu.id in self.fail:
+      raise RuntimeError('reimage failed')
+
+
+def test_max_unavailable_limits_healthy_tpus_in_flight():
+  begin = Begin()
+  results = tpunicorn.tpu.Rollout(tpus(6), begin, until=None, max_parallel=4, max_unavailable=2).run()
+  assert begin.most == 2
+  assert sorted(tpu.id for tpu, seconds, error in results) == ['tpu-v3-8-euw4a-{}'.format(i) for i in range(6)]
+  assert all(error is None for tpu, seconds, error in results)
+
+
+def test_unhealthy_tpus_do_not_use_up_the_budget():
+  begin = Begin()
+  tpunicorn.tpu.Rollout(tpus(4, state='STOPPED'), begin, until=None, max_parallel=4, max_unavailable=1).run()
+  assert begin.most == 4
+
+
+def test_failures_use_up_the_budget():
+  begin = Begin(fail=['tpu-v3-8-euw4a-0'])
+  results = tpunicorn.tpu.Rollout(tpus(4), begin, until=None, max_parallel=4, max_unavailable=1).run()
+  errors = {tpu.id: error for tpu, seconds, error in results}
+  assert errors == {
+    'tpu-v3-8-euw4a-0': 'reimage failed',
+    'tpu-v3-8-euw4a-1': 'skipped',
+    'tpu-v3-8-euw4a-2': 'skipped',
+    'tpu-v3-8-euw4a-3': 'skipped',
+  }
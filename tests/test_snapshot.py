@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+import tpunicorn.snapshot as snapshot
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def listing(monkeypatch):
+  """Count list_tpus calls, and don't really start background refreshes;
+  returns (fetches, refreshes)."""
+  fetches = []
+  refreshes = []
+  def list_tpus(zone=None, project=None, **kws):
+    fetches.append((project, zone))
+    return [make_node('europe-west4-a', 'tpu-v3-8-euw4a-{}'.format(len(fetches)))]
+  class Popen:
+    def __init__(self, args, env=None, **kws):
+      refreshes.append((args, env))
+  monkeypatch.setattr(tpunicorn.tpu, 'list_tpus', list_tpus)
+  monkeypatch.setattr(snapshot.subprocess, 'Popen', Popen)
+  return fetches, refreshes
+
+
+def ids(snap):
+  return [tpunicorn.tpu.parse_tpu_id(node) for node in snap['nodes']]
+
+
+def test_missing_snapshot_is_fetched_and_written(listing):
+  fetches, refreshes = listing
+  assert ids(snapshot.get_snapshot('proj')) == ['tpu-v3-8-euw4a-1']
+  assert fetches == [('proj', None)]
+  assert ids(snapshot.read_snapshot('proj')) == ['tpu-v3-8-euw4a-1']
+  assert snapshot.read_completions('tpus') == ['1', 'tpu-v3-8-euw4a-1']
+
+
+def test_young_snapshot_is_served_as_is(listing):
+  fetches, refreshes = listing
+  snapshot.write_snapshot('proj', [make_node('europe-west4-a', 'tpu-v3-8-euw4a-7')])
+  assert ids(snapshot.get_snapshot('proj', ttl=10)) == ['tpu-v3-8-euw4a-7']
+  assert fetches == [] and refreshes == []
+
+
+def test_stale_snapshot_is_served_while_it_refreshes(listing, monkeypatch):
+  fetches, refreshes = listing
+  snapshot.write_snapshot('proj', [make_node('europe-west4-a', 'tpu-v3-8-euw4a-7')], zone='europe-west4-a', timestamp=time.time() - 60)
+  assert ids(snapshot.get_snapshot('proj', zone='europe-west4-a', ttl=10, max_stale=300)) == ['tpu-v3-8-euw4a-7']
+  assert fetches == []
+  [(args, env)] = refreshes
+  assert args[-2:] == ['proj', 'europe-west4-a']
+  assert os.path.exists(env['TPUNICORN_REFRESH_LOCK'])
+  # one refresh at a time.
+  snapshot.get_snapshot('proj', zone='europe-west4-a', ttl=10, max_stale=300)
+  assert len(refreshes) == 1
+  # the refresh writes the snapshot and lets go of the lock.
+  monkeypatch.setenv('TPUNICORN_REFRESH_LOCK', env['TPUNICORN_REFRESH_LOCK'])
+  snapshot.main(['proj', 'europe-west4-a'])
+  assert not os.path.exists(env['TPUNICORN_REFRESH_LOCK'])
+  assert ids(snapshot.get_snapshot('proj', zone='europe-west4-a', ttl=10)) == ['tpu-v3-8-euw4a-1']
+
+
+def test_too_stale_or_fresh_snapshot_is_fetched(listing):
+  fetches, refreshes = listing
+  snapshot.write_snapshot('proj', [], timestamp=time.time() - 600)
+  assert ids(snapshot.get_snapshot('proj', ttl=10, max_stale=300)) == ['tpu-v3-8-euw4a-1']
+  assert ids(snapshot.get_snapshot('proj', fresh=True)) == ['tpu-v3-8-euw4a-2']
+  assert refreshes == []
+
+
+def test_refresh_lock():
+  lock = snapshot.acquire_refresh_lock('proj')
+  assert lock is not None
+  assert snapshot.acquire_refresh_lock('proj') is None
+  assert snapshot.acquire_refresh_lock('proj', zone='us-central1-f') is not None
+  # a lock left behind by a dead refresh is taken over.
+  os.utime(lock, (time.time() - 120, time.time() - 120))
+  assert snapshot.acquire_refresh_lock('proj', timeout=60) == lock
+  snapshot.release_refresh_lock(lock)
+  assert snapshot.acquire_refresh_lock('proj') == lock
+
+
+def test_cached_fleet_comes_from_the_snapshot(listing):
+  fetches, refreshes = listing
+  snapshot.write_snapshot('proj', [make_node('europe-west4-a', 'tpu-v3-8-euw4a-7')])
+  assert tpunicorn.tpu.get_fleet(cached=True).get(7).id == 'tpu-v3-8-euw4a-7'
+  assert fetches == []
@@ -0,0 +1,55 @@
+import time
+from concurrent import futures
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+def spare_pool(tmp_path, calls, **kws):
+  def run(label, command):
+    calls.append((label, command))
+    if command[0] == 'delete':
+      time.sleep(0.5)
+  return tpunicorn.tpu.SparePool(path=str(tmp_path / 'spares.json'), run=run, **kws)
+
+
+def test_swap_latency_leaves_out_the_delete(tmp_path, fleet, monkeypatch):
+  monkeypatch.setattr(tpunicorn.tpu, 'lifecycle_command',
+                      lambda verb, tpu, **kws: (verb, tpunicorn.tpu.parse_tpu_id(tpu), kws.get('async_')))
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state='PREEMPTED'))
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-900'))
+  calls = []
+  pool = spare_pool(tmp_path, calls, size=0)
+  swaps = []
+  b = tpunicorn.tpu.Babysitter(['tpu-v3-8-euw4a-1'], pool=pool, interval=0.01,
+                               on_swap=lambda tpu, spare: swaps.append((tpu.id, spare.id)))
+  b.tick()
+  futures.wait(list(b.jobs.values()))
+  assert swaps == [('tpu-v3-8-euw4a-1', 'tpu-v3-8-euw4a-900')]
+  assert pool.stats()['swap_latency']['last'] < 0.25
+  pool.executor.shutdown(wait=True)
+  assert [command for label, command in calls] == [('delete', 'tpu-v3-8-euw4a-1', True)]
+
+
+def test_claimed_spares_that_are_gone_are_forgotten(tmp_path, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  pool = spare_pool(tmp_path, [], size=1)
+  pool.claimed.add('tpu-v3-8-euw4a-900')
+  fleet_ = tpunicorn.tpu.get_fleet()
+  creates, deletes = pool.plan(fleet_, fleet_.tpus)
+  assert not pool.claimed
+  assert [name for name, template, block in creates] == ['tpu-v3-8-euw4a-900']
+  # a new spare reusing the name is a spare, not a working TPU.
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-900'))
+  fleet_ = tpunicorn.tpu.get_fleet()
+  assert pool.is_spare(fleet_.get('tpu-v3-8-euw4a-900'))
+  assert pool.plan(fleet_, fleet_.tpus) == ([], [])
+
+
+def test_claimed_spares_in_other_zones_are_kept(tmp_path, fleet):
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  pool = spare_pool(tmp_path, [], size=0)
+  pool.claimed.add('tpu-v3-8-usc1a-900')
+  pool.forget(tpunicorn.tpu.get_fleet(zone='europe-west4-a'), zone='europe-west4-a')
+  assert pool.claimed == {'tpu-v3-8-usc1a-900'}
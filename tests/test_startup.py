@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.tpu
+
+from conftest import make_node
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def no_zones(monkeypatch):
+  # fail any zone lookup; returns the zones that were asked for.
+  lookups = []
+  def get_tpu_zones(project=None):
+    lookups.append(project)
+    raise AssertionError('looked up the zones')
+  monkeypatch.setattr(tpunicorn.tpu, 'get_tpu_zones', get_tpu_zones)
+  return lookups
+
+
+@pytest.mark.parametrize('args', [['--help'], ['list', '--help'], ['create', '--help'], ['babysit', '--help']])
+def test_help_never_looks_up_zones(no_zones, args):
+  result = CliRunner().invoke(tpunicorn.program.cli, args)
+  assert result.exit_code == 0, result.output
+  assert '[full zone name or abbreviation]' in result.output or args == ['--help']
+  assert no_zones == []
+
+
+def test_zones_are_only_looked_up_for_a_given_zone(fleet):
+  fleet.append(make_node('us-central1-f', 'tpu-v3-8-usc1f-0'))
+  fleet.append(make_node('europe-west4-a', 'tpu-v3-8-euw4a-1'))
+  result = CliRunner().invoke(tpunicorn.program.cli, ['list', '-z', 'usc1f', '--format', 'template={id}'])
+  assert result.exit_code == 0, result.output
+  assert result.output.splitlines() == ['tpu-v3-8-usc1f-0']
+  result = CliRunner().invoke(tpunicorn.program.cli, ['list', '-z', 'mars1-a'])
+  assert result.exit_code == 2
+  assert "invalid zone 'mars1-a'" in result.output
+
+
+def test_import_leaves_heavy_modules_alone():
+  heavy = ['asyncio', 'braceexpand', 'cachier', 'googleapiclient', 'requests']
+  code = 'import sys, tpunicorn.program; print(" ".join(m for m in {!r} if m in sys.modules))'.format(heavy)
+  out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+  assert out.split() == []
+
+
+def test_bench_startup_appends_a_row(tmp_path, monkeypatch):
+  invoke = pytest.importorskip('invoke')
+  monkeypatch.syspath_prepend(root)
+  import tasks
+  output = tmp_path / 'benchmarks' / 'startup.tsv'
+  for _ in range(2):
+    tasks.bench_startup(invoke.Context(), runs=1, output=str(output))
+  lines = [line.split('\t') for line in output.read_text().splitlines()]
+  assert lines[0] == ['version', 'date', 'python', 'import_ms', 'help_ms']
+  assert len(lines) == 3
+  assert all(row[0] == tpunicorn._version.__version__ and float(row[3]) > 0 and float(row[4]) > 0 for row in lines[1:])
@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def pacific(monkeypatch):
+  monkeypatch.setenv('TZ', 'America/Los_Angeles')
+  time.tzset()
+  yield
+  monkeypatch.undo()
+  time.tzset()
+
+
+def test_timestamp_uses_the_offset_in_effect_then(pacific):
+  winter = 1767268800 # 2026-01-01 12:00 UTC
+  summer = 1782907200 # 2026-07-01 12:00 UTC
+  assert tpunicorn.tpu.get_timestamp(winter) == '01-01-2026 04:00:00AM PST'
+  assert tpunicorn.tpu.get_timestamp(summer) == '07-01-2026 05:00:00AM PDT'
+
+
+def test_age_filter_skips_tpus_without_create_time():
+  node = make_node('europe-west4-a', 'tpu-v3-8-euw4a-1')
+  del node['createTime']
+  tpu = tpunicorn.tpu.TpuRecord(node)
+  for expr in ['age>1h', 'age<1h', 'age!=1h', 'age=0..']:
+    assert not tpunicorn.tpu.TpuFilter(expr).matches(tpu)
+  assert tpunicorn.tpu.TpuFilter('age!=1h').matches(make_node('europe-west4-a', 'tpu-v3-8-euw4a-2'))
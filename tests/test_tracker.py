@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import tpunicorn.tpu
+
+from conftest import make_node
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+  """Don't really sleep; returns (delays slept, then), where each sleep
+  pops and calls the next function in `then`."""
+  delays = []
+  then = []
+  def sleep(seconds):
+    delays.append(seconds)
+    if then:
+      then.pop(0)()
+  monkeypatch.setattr(time, 'sleep', sleep)
+  monkeypatch.setenv('TPUNICORN_POLL_MIN', '2')
+  monkeypatch.setenv('TPUNICORN_POLL_MAX', '30')
+  return delays, then
+
+
+def test_backoff_intervals():
+  intervals = tpunicorn.tpu.backoff_intervals(2, 10, 2)
+  assert [next(intervals) for _ in range(5)] == [2, 4, 8, 10, 10]
+
+
+def test_polls_back_off_and_start_over_on_change(fleet, sleeps):
+  delays, then = sleeps
+  def state(state, health):
+    def set_state():
+      fleet[:] = [make_node('europe-west4-a', 'tpu-v3-8-euw4a-1', state=state, health=health)]
+    return set_state
+  state('CREATING', None)()
+  then.extend([state('CREATING', None), state('CREATING', None), state('READY', 'UNHEALTHY'), state('READY', 'HEALTHY')])
+  changes = []
+  tracker = tpunicorn.tpu.Tracker()
+  future = tracker.watch('tpu-v3-8-euw4a-1', zone='europe-west4-a', on_change=lambda tpu: changes.append(tpu.state))
+  tracker.run()
+  assert delays == [2, 3, 4.5, 2]
+  assert changes == ['CREATING', 'READY', 'READY']
+  assert future.result().health == 'HEALTHY'
+
+
+class FakeOperation:
+  def __init__(self, polls, error=None):
+    self.polls = polls
+    self.error = error
+    self.name = 'operations/op'
+
+  def poll(self):
+    self.polls -= 1
+    return self.polls <= 0
+
+  def check(self):
+    if self.error is not None:
+      raise RuntimeError(self.error)
+    return 'done'
+
+
+def test_operations_are_polled_until_done(sleeps):
+  delays, then = sleeps
+  tracker = tpunicorn.tpu.Tracker()
+  ok = tracker.watch_operation(FakeOperation(3))
+  failed = tracker.watch_operation(FakeOperation(1, error='no capacity'))
+  tracker.run()
+  assert ok.result() == 'done'
+  with pytest.raises(RuntimeError, match='no capacity'):
+    failed.result()
+  assert delays == [2, 3]
+
+
+def test_run_times_out(sleeps):
+  tracker = tpunicorn.tpu.Tracker()
+  tracker.watch_operation(FakeOperation(100))
+  with pytest.raises(TimeoutError):
+    tracker.run(timeout=4)
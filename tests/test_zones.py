@@ -0,0 +1,56 @@
+import pytest
+from click.testing import CliRunner
+
+import tpunicorn.program
+import tpunicorn.tpu
+
+from conftest import make_node, zones
+
+
+@pytest.mark.parametrize('abbrev, expected', [
+  ('euw4a', 'europe-west4-a'),
+  ('usc1f', 'us-central1-f'),
+  ('usc1', 'us-central1-a,us-central1-b,us-central1-f'),
+  ('west4', 'europe-west4-a'),
+  ('usc1f,euw4a', 'us-central1-f,europe-west4-a'),
+  ('usc1a,usc1', 'us-central1-a,us-central1-b,us-central1-f'),
+  ('europe-west4-a', 'europe-west4-a'),
+  ('mars1-a', 'mars1-a'),
+])
+def test_abbreviations_expand(abbrev, expected):
+  assert tpunicorn.tpu.expand_zone_abbreviations(abbrev) == expected
+
+
+def test_zones_abbreviate():
+  assert [tpunicorn.tpu.infer_zone_abbreviation(zone) for zone in zones] == ['ase1c', 'euw4a', 'usc1a', 'usc1b', 'usc1f']
+  assert sorted(tpunicorn.tpu.get_zone_abbreviations(only_unambiguous_results=True)) == ['ase1c', 'euw4a', 'usc1a', 'usc1b', 'usc1f']
+
+
+def test_zone_is_parsed_from_a_tpu_name():
+  assert tpunicorn.tpu.parse_tpu_zone('tpu-v3-8-euw4a-3') == 'europe-west4-a'
+  assert tpunicorn.tpu.parse_tpu_zone('usc1f-tpu-v3-8-0') == 'us-central1-f'
+  assert tpunicorn.tpu.parse_tpu_zone('tpu-v3-8-3') is None
+  # an abbreviation that's only part of a word doesn't count.
+  assert tpunicorn.tpu.parse_tpu_zone('tpu-xeuw4a-3') is None
+  assert tpunicorn.tpu.parse_tpu_zone(make_node('us-central1-b', 'tpu-v3-8-euw4a-3')) == 'us-central1-b'
+
+
+def test_index_is_built_once_per_zone_list():
+  index = tpunicorn.tpu.get_zone_index()
+  assert tpunicorn.tpu.get_zone_index() is index
+  assert tpunicorn.tpu.get_zone_index(','.join(zones)) is index
+  assert tpunicorn.tpu.get_zone_index(zones[:2]) is not index
+
+
+def test_choices_cover_zones_and_abbreviations():
+  choices = tpunicorn.tpu.get_tpu_zone_choices()
+  assert set(zones) <= set(choices)
+  assert {'euw4a', 'usc1', 'usc1f', 'west4'} <= set(choices)
+  assert len(choices) == len(set(choices))
+
+
+def test_zones_command():
+  result = CliRunner().invoke(tpunicorn.program.cli, ['zones'])
+  assert result.exit_code == 0, result.output
+  assert result.output.splitlines() == ['{} {}'.format(zone, abbrev) for zone, abbrev in
+                                        zip(zones, ['ase1c', 'euw4a', 'usc1a', 'usc1b', 'usc1f'])]
@@ -3,4 +3,5 @@ from .tpu import get_tpu, get_tpus, format, format_widths, format_headers, \
     start_tpu_command, stop_tpu_command, \
     logger
 from . import tpu
+from . import snapshot
 from . import program
@@ -18,9 +18,11 @@ import tpunicorn
 import json
 import sys
 import os
+import subprocess
+import threading
 import time
 import random
-import math
+from concurrent import futures
 from pprint import pprint as pp
 
 import logging as pylogging
@@ -29,24 +31,73 @@ logging.setLevel(pylogging.WARNING)
 
 from ._version import binary_names
 
-class ZoneChoice(click.Choice):
-  def __init__(self):
-    choices = []
-    choices.extend(tpunicorn.tpu.get_zone_abbreviations(only_unambiguous_results=True))
-    choices.extend(tpunicorn.tpu.get_tpu_zones())
-    super().__init__(choices)
+class ZoneChoice(click.ParamType):
+  # The zone list is only looked up when a --zone is actually given, so
+  # that building the CLI (and e.g. `pu --help`) never touches the network.
+  name = 'zone'
+  def get_choices(self):
+    index = tpunicorn.tpu.get_zone_index()
+    return list(index.unambiguous) + index.zones
   def convert(self, value, param, ctx):
     value = tpunicorn.tpu.expand_zone_abbreviations(value)
-    return super().convert(value, param, ctx)
+    choices = self.get_choices()
+    for zone in value.split(','):
+      if zone not in choices:
+        self.fail('invalid zone {!r}. (choose from {})'.format(zone, ', '.join(choices)), param, ctx)
+    return value
   def get_metavar(self, param):
     # return '[available zones: {' + ', '.join(tpunicorn.tpu.get_tpu_zones()) + '} or abbreviation: {' + ', '.join(tpunicorn.tpu.get_zone_abbreviations(only_unambiguous_results=True)) + '}]'
     return '[full zone name or abbreviation]'
 
 
+class FormatChoice(click.Choice):
+  def __init__(self):
+    super().__init__(['text', 'json', 'csv', 'tsv', 'template=<SPEC>'])
+  def convert(self, value, param, ctx):
+    if value.startswith('template='):
+      try:
+        tpunicorn.tpu.FormatSpec(value[len('template='):])
+      except ValueError as e:
+        self.fail(str(e), param, ctx)
+      return value
+    return super().convert(value, param, ctx)
+
+class FilterExpression(click.ParamType):
+  name = 'filter'
+  def convert(self, value, param, ctx):
+    try:
+      return tpunicorn.tpu.TpuFilter.wrap(value)
+    except ValueError as e:
+      self.fail(str(e), param, ctx)
+
+def tpu_filter_option():
+  return click.option('--filter', 'filter_', type=FilterExpression(), default=None, metavar='EXPR',
+    help="Only show TPUs matching every term of EXPR, e.g. 'state=PREEMPTED type=v3-* zone=euw4a age>2h index=0..31 id=tpu-*'."
+         " Fields: " + ', '.join(tpunicorn.tpu.filter_fields) + ".")
+
+class ColumnList(click.ParamType):
+  name = 'columns'
+  def convert(self, value, param, ctx):
+    if isinstance(value, list):
+      return value
+    columns = [x.strip() for x in value.split(',') if x.strip()]
+    try:
+      for column in columns:
+        tpunicorn.tpu.get_format_column_spec(column)
+    except ValueError as e:
+      self.fail(str(e), param, ctx)
+    return columns
+
+def complete_zone(ctx, args, incomplete):
+  words = tpunicorn.snapshot.read_completions('zones')
+  if words is None:
+    words = ZoneChoice().get_choices()
+  return [word for word in words if word.startswith(incomplete)]
+
 def tpu_zone_option():
-  return click.option('-z', '--zone', type=ZoneChoice(), help=''
-    'available zones: {' + ', '.join(tpunicorn.tpu.get_tpu_zones()) + '}\n'
-    'or use abbreviations: {' + ', '.join(tpunicorn.tpu.get_zone_abbreviations(only_unambiguous_results=True)) + '}')
+  return click.option('-z', '--zone', type=ZoneChoice(), autocompletion=complete_zone, help=''
+    'a TPU zone, e.g. europe-west4-a, or an abbreviation, e.g. euw4a.'
+    ' (Run `pu zones` to see them all.)')
 
 # https://stackoverflow.com/questions/58666831/how-to-implement-version-using-python-click/58666832#58666832
 
@@ -54,6 +105,8 @@ def tpu_zone_option():
 @click.version_option(tpunicorn._version.__version__)
 @click.option('-vv', '--verbose', is_flag=True)
 @click.option('-c', '--configuration', type=click.STRING, default=None)
+@click.option('--backend', type=click.Choice(['rest', 'gcloud']), default=None,
+              help="Make create/delete/start/stop/reimage calls directly over REST (the default), or by running gcloud.")
 @click.pass_context
 def cli(ctx, **kws):
   ctx.obj = kws
@@ -65,24 +118,33 @@ def cli(ctx, **kws):
   if configuration is not None:
     logging.info('Setting CLOUDSDK_ACTIVE_CONFIG_NAME=%s', configuration)
     os.environ['CLOUDSDK_ACTIVE_CONFIG_NAME'] = configuration
+  if ctx.obj['backend'] is not None:
+    os.environ['TPUNICORN_BACKEND'] = ctx.obj['backend']
+  # every helper below reads the fleet through this context, so a command
+  # fetches it once; see tpunicorn.tpu.FleetContext.
+  fleet = ctx.obj['fleet'] = tpunicorn.tpu.FleetContext()
+  token = fleet.activate()
+  ctx.call_on_close(lambda: fleet.deactivate(token))
 
-def print_tpu_status_headers(color=True, project=None):
-  message = tpunicorn.format(tpunicorn.format_headers(), project=project)
+def print_tpu_status_headers(color=True, project=None, widths=None):
+  message = tpunicorn.format(tpunicorn.format_headers(), project=project, widths=widths)
   if color:
     click.secho(message, bold=color)
   else:
     click.echo(message)
 
-def print_tpu_status(tpu, format='text', color=True, project=None):
+def print_tpu_status(tpu, format='text', color=True, project=None, widths=None):
   if format == 'json':
-    click.echo(json.dumps(tpu))
+    click.echo(tpunicorn.tpu.as_json(tpu))
     return
-  message = tpunicorn.format(tpu, project=project)
+  message = tpunicorn.format(tpu, project=project, widths=widths)
+  tpu = tpunicorn.tpu.TpuRecord.wrap(tpu)
+  return print_tpu_status_line(message, tpu.state, tpu.health, color=color)
+
+def print_tpu_status_line(message, status, health, color=True):
   if not color:
     click.echo(message)
   else:
-    status = tpunicorn.format(tpu, '{status}', project=project)
-    health = tpunicorn.format(tpu, '{health}', project=project)
     if status == 'READY' and health == 'HEALTHY':
       click.secho(message, fg='green')
       return 'HEALTHY'
@@ -91,49 +153,98 @@ def print_tpu_status(tpu, format='text', color=True, project=None):
     else:
       click.secho(message, fg='yellow')
 
-def print_tpus_status(zone=None, project=None, format='text', color=True):
-  tpus = tpunicorn.get_tpus(zone=zone, project=project)
+def print_tpu_table(tpus, color=True, widths=None, header=True, columns=None):
+  for tpu, args, message in tpunicorn.tpu.render_table(tpus, widths=widths, header=header, columns=columns):
+    if tpu is None:
+      if color:
+        click.secho(message, bold=color)
+      else:
+        click.echo(message)
+    else:
+      tpu = tpunicorn.tpu.TpuRecord.wrap(tpu)
+      print_tpu_status_line(message, tpu.state, tpu.health, color=color)
+
+def print_tpus(tpus, format='text', color=True, widths=None, columns=None):
   if format == 'json':
-    click.echo(json.dumps(tpus))
+    click.echo('[' + ', '.join(tpunicorn.tpu.as_json(tpu) for tpu in tpus) + ']')
+  elif format in ['csv', 'tsv']:
+    for line in tpunicorn.tpu.render_delimited(tpus, columns=columns, delimiter=',' if format == 'csv' else '\t'):
+      click.echo(line)
+  elif format.startswith('template='):
+    for tpu, args, line in tpunicorn.tpu.render_table(tpus, spec=format[len('template='):], header=False):
+      click.echo(line)
   else:
     assert format == 'text'
-    print_tpu_status_headers(color=color, project=project)
-    for tpu in tpus:
-      print_tpu_status(tpu, color=color, project=project)
+    print_tpu_table(tpus, color=color, widths=widths, columns=columns)
+
+def print_tpus_status(zone=None, project=None, format='text', color=True, fresh=True, columns=None, filter_=None):
+  if format == 'json' and fresh:
+    if filter_ is not None:
+      zone = filter_.push_down(zone=zone, project=project)
+    # stream nodes as their pages arrive, rather than buffering the fleet.
+    click.echo('[', nl=False)
+    i = 0
+    if zone is None or len(zone) > 0:
+      for tpu in tpunicorn.tpu.iter_tpus(zone=zone, project=project):
+        if filter_ is None or filter_.matches(tpu):
+          click.echo((', ' if i > 0 else '') + json.dumps(tpu), nl=False)
+          i += 1
+    click.echo(']')
+    return
+  tpus = tpunicorn.get_tpus(zone=zone, project=project, cached=not fresh, filter=filter_)
+  print_tpus(tpus, format=format, color=color, columns=columns)
 
 @cli.command()
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
-def top(zone, project):
+@click.option('--fresh', is_flag=True, help="Bypass the on-disk fleet snapshot and query the API directly.")
+@tpu_filter_option()
+@click.pass_context
+def top(ctx, zone, project, fresh, filter_):
   """Like `top` for TPUs; lists TPU status every 5 sec."""
   while True:
+    ctx.obj['fleet'].clear()
     click.clear()
-    print_tpus_status(zone=zone, project=project)
+    print_tpus_status(zone=zone, project=project, fresh=fresh, filter_=filter_)
     time.sleep(5.0)
 
 @cli.command("list")
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
-@click.option('-f', '--format', type=click.Choice(['text', 'json']), default='text')
+@click.option('-f', '--format', type=FormatChoice(), default='text',
+              help="template=<SPEC> formats each TPU with a spec like '{id} {status}'.")
+@click.option('--columns', type=ColumnList(), default=None, metavar='COLUMN,...',
+              help="Which columns to show for text, csv and tsv output, e.g. id,zone,status.")
 @click.option('-color/-nc', '--color/--no-color', default=True)
 @click.option('-t', '--tpu', type=click.STRING, help="List a specific TPU by id.", multiple=True)
 @click.option('-s', '--silent', is_flag=True, help="If listing a specific TPU by ID, and there is no such TPU, don't throw an error.")
-def list_tpus(zone, project, format, color, tpu, silent):
+@click.option('--fresh', is_flag=True, help="Bypass the on-disk fleet snapshot and query the API directly.")
+@tpu_filter_option()
+def list_tpus(zone, project, format, columns, color, tpu, silent, fresh, filter_):
   """List TPUs."""
   tpus = tpu
   if len(tpus) <= 0:
-    print_tpus_status(zone=zone, project=project, format=format, color=color)
+    print_tpus_status(zone=zone, project=project, format=format, color=color, fresh=fresh, columns=columns, filter_=filter_)
   else:
-    if format == 'text':
-      print_tpu_status_headers()
-    for tpu in tpus:
-      tpu = tpunicorn.get_tpu(tpu, zone=zone, project=project, silent=silent)
-      if tpu is not None:
-        print_tpu_status(tpu, format=format, color=color)
+    fleet = tpunicorn.tpu.get_fleet(project=project, cached=not fresh)
+    widths = tpunicorn.tpu.compute_format_widths(fleet)
+    if zone is not None:
+      fleet = tpunicorn.tpu.Fleet(fleet.select(zone=zone))
+    tpus = [fleet.get(tpu, silent=silent) for tpu in tpus]
+    tpus = [tpu for tpu in tpus if tpu is not None and (filter_ is None or filter_.matches(tpu))]
+    if format == 'json':
+      for tpu in tpus:
+        print_tpu_status(tpu, format=format)
+    else:
+      print_tpus(tpus, format=format, color=color, widths=widths, columns=columns)
 
 def complete_tpu_id(ctx, args, incomplete, zone=None, project=None):
-  tpus = tpunicorn.get_tpus(zone=zone, project=project)
-  return [tpunicorn.tpu.parse_tpu_id(tpu) for tpu in tpus]
+  # read the word list kept warm by normal commands (or `pu refresh-cache
+  # --watch`), so that completion never waits on a fleet fetch.
+  words = tpunicorn.snapshot.read_completions('tpus')
+  if words is None:
+    words = tpunicorn.tpu.get_fleet(zone=zone, project=project, cached=True).ids()
+  return [word for word in words if word.startswith(incomplete)]
 
 # @cli.command()
 # @click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
@@ -150,7 +261,7 @@ def is_preempted(tpu, zone=None, project=None):
   return status == 'PREEMPTED'
 
 def check_healthy(tpu, zone=None, project=None, color=True, noisy=True):
-  tpu = tpunicorn.get_tpu(tpu, zone=zone, project=project)
+  tpu = tpunicorn.get_tpu(tpu, zone=zone, project=project, fresh=True)
   if noisy:
     print_tpu_status(tpu, color=color)
   status = tpunicorn.format(tpu, '{status}')
@@ -161,21 +272,26 @@ def check_healthy(tpu, zone=None, project=None, color=True, noisy=True):
 
 def wait_healthy(tpu, zone=None, project=None, color=True):
   print_tpu_status_headers()
-  while True:
-    if check_healthy(tpu, zone=zone, project=project, color=color):
-      return
-    click.echo('TPU {} not yet healthy; waiting 30 seconds...'.format(tpunicorn.tpu.parse_tpu_id(tpu)))
-    time.sleep(30.0)
+  def on_change(node):
+    if node is None:
+      click.echo('TPU {} does not exist yet; waiting...'.format(tpunicorn.tpu.parse_tpu_id(tpu)))
+    else:
+      print_tpu_status(node, color=color)
+  tracker = tpunicorn.tpu.Tracker(project=project)
+  tracker.watch(tpu, zone=zone, on_change=on_change)
+  tracker.run()
 
 def print_step(label=None, command=None, args=(), kwargs={}):
   click.echo('')
   if label is not None:
     click.secho(label, bold=True)
-  if command is not None and not callable(command):
+  if command is not None and (not callable(command) or isinstance(command, tpunicorn.tpu.LifecycleCall)):
     click.echo('  $ ', nl=False)
-    click.secho(command, fg='blue', bold=True)
+    click.secho(str(command), fg='blue', bold=True)
 
-def do_step(label=None, command=None, dry_run=False, delay_after=1.0, args=(), kwargs={}):
+def do_step(label=None, command=None, dry_run=False, delay_after=1.0, args=(), kwargs={}, env=None, check=True):
+  # check: exit if the command fails; otherwise return its (non-zero) status.
+  # a callable command can return a non-zero status to say it failed.
   print_step(label=label, command=command, args=args, kwargs=kwargs)
   result = 0
   if command is not None:
@@ -183,12 +299,20 @@ def do_step(label=None, command=None, dry_run=False, delay_after=1.0, args=(), k
       click.echo('Dry run; command skipped.')
       time.sleep(3.0)
     else:
-      if callable(command):
-        command(*args, **kwargs)
+      if isinstance(command, tpunicorn.tpu.LifecycleCall):
+        try:
+          command()
+        except Exception as e:
+          click.secho(str(e), fg='red', err=True)
+          result = 1
+      elif callable(command):
+        result = command(*args, **kwargs) or 0
+      elif env is not None:
+        result = subprocess.call(command, shell=True, env=dict(os.environ, **env))
       else:
         result = os.system(command)
-        if result != 0:
-          sys.exit(result)
+      if result != 0 and check:
+        sys.exit(result)
       time.sleep(delay_after)
   return result
 
@@ -209,14 +333,26 @@ def do_step(label=None, command=None, dry_run=False, delay_after=1.0, args=(), k
 @click.option('-p', '--project', metavar="[PROJECT]", type=click.STRING, default=None)
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--dry-run', is_flag=True)
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='Create at most this many TPUs at once. (default: 4)')
 @click.pass_context
-def create(ctx, tpu, zone, version, accelerator_type, data_disk, async_, description, network, subnetwork, preemptible, range, project, yes, dry_run):
-  if tpu.endswith('+'):
-    index = int(tpu[:-1])
-    index = tpunicorn.tpu.get_next_available_tpu_index(index, project=project)
-    tpu = str(index)
+def create(ctx, tpu, zone, version, accelerator_type, data_disk, async_, description, network, subnetwork, preemptible, range, project, yes, dry_run, max_parallel):
+  """Creates a TPU, or many TPUs at once.
+
+  TPU can be a name, an index, or an index spec: '0+' is the next free
+  index from 0, '8x+' is the next 8 free indices from 0 ('8x20+' from
+  20), and '0..31' is indices 0 through 31. All the names and ranges are
+  worked out from one look at the fleet, then the TPUs are created
+  concurrently, up to --max-parallel at a time."""
+  fleet = None
+  if tpunicorn.tpu.is_index_spec(tpu):
+    fleet = tpunicorn.tpu.get_fleet(project=project)
+    indices = tpunicorn.tpu.allocate_tpu_indices(tpu, fleet)
   else:
-    index = tpunicorn.tpu.parse_tpu_index(tpu)
+    indices = [tpu]
+  tpu = str(indices[0])
+  if len(indices) > 1 and range is not None:
+    raise click.UsageError('--range can only be given when creating one TPU.')
   if accelerator_type is None:
     accelerator_type = tpunicorn.tpu.parse_tpu_accelerator_type(tpu)
   # parse the TPU type and core count.
@@ -238,37 +374,75 @@ def create(ctx, tpu, zone, version, accelerator_type, data_disk, async_, descrip
   is_v2 = (version is not None) and version.startswith('v2')
   if not is_v2 and data_disk is not None:
     raise ValueError("--data-disk can only be specified for TPU VMs; try --version v2-alpha")
-  if range is None and index >= 0 and not is_v2: # --range appears to be broken on TPU VMs for now; don't give a default
-    if cores == 8:
-      range = "10.48.{i}.0/29".format(i=index)
-    else:
-      i=index + 2
-      cidr=int(32 + 2 - math.log2(cores))
-      range="10.{i}.0.0/{cidr}".format(i=i, cidr=cidr)
-  if range is not None and range.startswith("10.48.") and cores > 8:
-    raise ValueError("The range {range!r} conflicts with the default 10.48.* range of v2-8's and v3-8's. I decided to raise an error rather than a warning, because we rely on this specific range for our own internal networking. If you're making a TPU pod, try a different index other than {index}. If you really, really wanted to use 10.48.* for you TPU pods, I'm very sorry; ping me on twitter (@theshawwn) and I'll change this.".format(range=range, index=index))
-  try:
-    index = int(tpu)
-    # the TPU name is just an integer, so try to build a new name
-    # automatically for convenience.
-    zone_abbrev = tpunicorn.tpu.infer_zone_abbreviation(zone)
-    tpu = "tpu-{accelerator_type}-{zone_abbrev}-{index}".format(
-        accelerator_type=accelerator_type,
-        zone_abbrev=zone_abbrev,
-        index=index)
-  except ValueError:
-    pass
   if project is None:
     project = tpunicorn.tpu.get_default_project()
-  create = tpunicorn.create_tpu_command(tpu, zone=zone, version=version, accelerator_type=accelerator_type, async_=async_, description=description, network=network, subnetwork=subnetwork, preemptible=preemptible, range=range, project=project, data_disk=data_disk)
+  ranges = None
+  if range is not None or not is_v2:
+    # ranges already in use, so that new ones don't clash with them.
+    if fleet is None:
+      fleet = tpunicorn.tpu.get_fleet(project=project)
+    ranges = tpunicorn.tpu.RangeIndex(fleet.tpus)
+  if range is not None and not ranges.is_free(range, network=network):
+    click.secho('Warning: the range {} overlaps a range already in use on network {}.'.format(range, network), fg='yellow', err=True)
+  def plan(tpu):
+    tpu = str(tpu)
+    index = tpunicorn.tpu.parse_tpu_index(tpu)
+    tpu_range = range
+    if tpu_range is None and not is_v2: # --range appears to be broken on TPU VMs for now; don't give a default
+      # the conventional range for the index if it's free, or else the
+      # first free one.
+      tpu_range = ranges.allocate_tpu_range(index, cores, network=network)
+    if tpu_range is not None and tpu_range.startswith("10.48.") and cores > 8:
+      raise ValueError("The range {range!r} conflicts with the default 10.48.* range of v2-8's and v3-8's. I decided to raise an error rather than a warning, because we rely on this specific range for our own internal networking. If you're making a TPU pod, try a different index other than {index}. If you really, really wanted to use 10.48.* for you TPU pods, I'm very sorry; ping me on twitter (@theshawwn) and I'll change this.".format(range=tpu_range, index=index))
+    try:
+      index = int(tpu)
+      # the TPU name is just an integer, so try to build a new name
+      # automatically for convenience.
+      zone_abbrev = tpunicorn.tpu.infer_zone_abbreviation(zone)
+      tpu = "tpu-{accelerator_type}-{zone_abbrev}-{index}".format(
+          accelerator_type=accelerator_type,
+          zone_abbrev=zone_abbrev,
+          index=index)
+    except ValueError:
+      pass
+    return tpu, tpunicorn.tpu.lifecycle_command('create', tpu, zone=zone, version=version, accelerator_type=accelerator_type, async_=async_, description=description, network=network, subnetwork=subnetwork, preemptible=preemptible, range=tpu_range, project=project, data_disk=data_disk)
+  plans = [plan(index) for index in indices]
+  if len(plans) == 1:
+    tpu, create = plans[0]
+    if not yes:
+      print_step('Step 1: create TPU.', create)
+      if not click.confirm('Proceed? {}'.format('(dry run)' if dry_run else '')):
+        return
+    do_step('Step 1: create TPU...', create, dry_run=dry_run)
+    click.echo('TPU {} {} created.'.format(
+      tpunicorn.tpu.parse_tpu_id(tpu),
+      'would be' if dry_run else 'is'))
+    return
+  existing = [tpu for tpu, create in plans if fleet.by_id.get(tpu)]
+  if existing:
+    raise click.UsageError('These TPUs already exist: {}'.format(', '.join(existing)))
   if not yes:
-    print_step('Step 1: create TPU.', create)
-    if not click.confirm('Proceed? {}'.format('(dry run)' if dry_run else '')):
+    for tpu, create in plans:
+      print_step('TPU {}: Step 1: create TPU.'.format(tpu), create)
+    if not click.confirm('Create {} TPUs? {}'.format(len(plans), '(dry run)' if dry_run else '')):
       return
-  do_step('Step 1: create TPU...', create, dry_run=dry_run)
-  click.echo('TPU {} {} created.'.format(
-    tpunicorn.tpu.parse_tpu_id(tpu),
-    'would be' if dry_run else 'is'))
+  def create_one(tpu, create):
+    start = time.time()
+    do_step('Creating TPU {}...'.format(tpu), create, dry_run=dry_run, delay_after=0.0)
+    return time.time() - start
+  failed = []
+  with futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+    jobs = {executor.submit(create_one, tpu, create): tpu for tpu, create in plans}
+    for n, job in enumerate(futures.as_completed(jobs), 1):
+      try:
+        seconds = job.result()
+        click.echo('[{}/{}] TPU {} {} created ({:.0f}s).'.format(n, len(jobs), jobs[job], 'would be' if dry_run else 'is', seconds))
+      except BaseException as e:
+        click.secho('[{}/{}] TPU {} failed to create: {}'.format(n, len(jobs), jobs[job], e), fg='red', err=True)
+        failed.append(jobs[job])
+  click.echo('{} of {} TPUs {} created.'.format(len(plans) - len(failed), len(plans), 'would be' if dry_run else 'are'))
+  if failed:
+    sys.exit(1)
 
 
 @cli.command()
@@ -284,7 +458,7 @@ def delete(tpu, zone, project, yes, dry_run, async_):
   print_tpu_status_headers()
   print_tpu_status(tpu)
   click.echo('')
-  delete = tpunicorn.delete_tpu_command(tpu, zone=zone, project=project, async_=async_)
+  delete = tpunicorn.tpu.lifecycle_command('delete', tpu, zone=zone, project=project, async_=async_)
   create = tpunicorn.create_tpu_command(tpu, zone=zone, project=project, async_=async_)
   if not yes:
     print_step('Step 1: delete TPU.', delete)
@@ -298,19 +472,28 @@ def delete(tpu, zone, project, yes, dry_run, async_):
     create)
 
 @cli.command()
-@click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
+@click.argument('tpus', nargs=-1, type=click.STRING, metavar='TPU...', autocompletion=complete_tpu_id)
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--dry-run', is_flag=True)
 @click.option('--async', 'async_', is_flag=True)
-def stop(tpu, zone, project, yes, dry_run, async_):
-  tpu = tpunicorn.get_tpu(tpu=tpu, zone=zone, project=project)
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='With many TPUs, work on at most this many at once. (default: 4)')
+@click.option('--max-unavailable', type=click.INT, default=1, metavar='<count>',
+              help='With many TPUs, take at most this many healthy TPUs out of service at once. (default: 1)')
+@tpu_filter_option()
+def stop(tpus, zone, project, yes, dry_run, async_, max_parallel, max_unavailable, filter_):
+  """Stops a TPU, or many TPUs (ids, indices, index ranges like 0..31, globs, or a --filter) a few at a time."""
+  if is_rollout(tpus, filter_, async_):
+    return rollout('stop', tpus, zone=zone, project=project, filter_=filter_, yes=yes, dry_run=dry_run,
+                   max_parallel=max_parallel, max_unavailable=max_unavailable, until=tpunicorn.tpu.is_tpu_stopped)
+  tpu = tpunicorn.get_tpu(tpu=tpus[0], zone=zone, project=project)
   click.echo('Current status of TPU:')
   print_tpu_status_headers()
   print_tpu_status(tpu)
   click.echo('')
-  stop = tpunicorn.stop_tpu_command(tpu, zone=zone, project=project, async_=async_)
+  stop = tpunicorn.tpu.lifecycle_command('stop', tpu, zone=zone, project=project, async_=async_)
   start = tpunicorn.start_tpu_command(tpu, zone=zone, project=project, async_=async_)
   if not yes:
     print_step('Step 1: stop TPU.', stop)
@@ -324,20 +507,29 @@ def stop(tpu, zone, project, yes, dry_run, async_):
     start)
 
 @cli.command()
-@click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
+@click.argument('tpus', nargs=-1, type=click.STRING, metavar='TPU...', autocompletion=complete_tpu_id)
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--dry-run', is_flag=True)
 @click.option('--async', 'async_', is_flag=True)
-def start(tpu, zone, project, yes, dry_run, async_):
-  tpu = tpunicorn.get_tpu(tpu=tpu, zone=zone, project=project)
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='With many TPUs, work on at most this many at once. (default: 4)')
+@click.option('--max-unavailable', type=click.INT, default=1, metavar='<count>',
+              help='With many TPUs, take at most this many healthy TPUs out of service at once. (default: 1)')
+@tpu_filter_option()
+def start(tpus, zone, project, yes, dry_run, async_, max_parallel, max_unavailable, filter_):
+  """Starts a TPU, or many TPUs (ids, indices, index ranges like 0..31, globs, or a --filter) a few at a time."""
+  if is_rollout(tpus, filter_, async_):
+    return rollout('start', tpus, zone=zone, project=project, filter_=filter_, yes=yes, dry_run=dry_run,
+                   max_parallel=max_parallel, max_unavailable=max_unavailable)
+  tpu = tpunicorn.get_tpu(tpu=tpus[0], zone=zone, project=project)
   click.echo('Current status of TPU:')
   print_tpu_status_headers()
   print_tpu_status(tpu)
   click.echo('')
   stop = tpunicorn.stop_tpu_command(tpu, zone=zone, project=project, async_=async_)
-  start = tpunicorn.start_tpu_command(tpu, zone=zone, project=project, async_=async_)
+  start = tpunicorn.tpu.lifecycle_command('start', tpu, zone=zone, project=project, async_=async_)
   if not yes:
     print_step('Step 1: start TPU.', start)
     if not click.confirm('Proceed? {}'.format('(dry run)' if dry_run else '')):
@@ -350,7 +542,7 @@ def start(tpu, zone, project, yes, dry_run, async_):
     stop)
 
 @cli.command()
-@click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
+@click.argument('tpus', nargs=-1, type=click.STRING, metavar='TPU...', autocompletion=complete_tpu_id)
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
 @click.option('--version', type=click.STRING, metavar="<TF_VERSION>",
@@ -360,10 +552,18 @@ def start(tpu, zone, project, yes, dry_run, async_):
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--dry-run', is_flag=True)
 @click.option('--async', 'async_', is_flag=True)
-def reimage(tpu, zone, project, version, yes, dry_run, async_):
-  """Reimages the OS on a TPU."""
-  tpu = tpunicorn.get_tpu(tpu=tpu, zone=zone, project=project)
-  reimage = tpunicorn.reimage_tpu_command(tpu, zone=zone, project=project, version=version, async_=async_)
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='With many TPUs, work on at most this many at once. (default: 4)')
+@click.option('--max-unavailable', type=click.INT, default=1, metavar='<count>',
+              help='With many TPUs, take at most this many healthy TPUs out of service at once. (default: 1)')
+@tpu_filter_option()
+def reimage(tpus, zone, project, version, yes, dry_run, async_, max_parallel, max_unavailable, filter_):
+  """Reimages the OS on a TPU, or on many TPUs (ids, indices, index ranges like 0..31, globs, or a --filter) a few at a time."""
+  if is_rollout(tpus, filter_, async_):
+    return rollout('reimage', tpus, zone=zone, project=project, filter_=filter_, yes=yes, dry_run=dry_run,
+                   max_parallel=max_parallel, max_unavailable=max_unavailable, version=version)
+  tpu = tpunicorn.get_tpu(tpu=tpus[0], zone=zone, project=project)
+  reimage = tpunicorn.tpu.lifecycle_command('reimage', tpu, zone=zone, project=project, version=version, async_=async_)
   def wait():
     wait_healthy(tpu, zone=zone, project=project)
   if not yes:
@@ -379,8 +579,93 @@ def reimage(tpu, zone, project, version, yes, dry_run, async_):
       tpunicorn.tpu.parse_tpu_id(tpu),
       'would be' if dry_run else 'is'))
 
+def is_tpu_selector(pattern):
+  # a glob or an index range, which may match any number of TPUs.
+  return any(c in pattern for c in '*?[') or '..' in pattern
+
+def is_rollout(tpus, filter_, async_):
+  if len(tpus) <= 0 and filter_ is None:
+    raise click.UsageError('Specify at least one TPU, or a --filter.')
+  if len(tpus) == 1 and filter_ is None and not is_tpu_selector(tpus[0]):
+    return False
+  if async_:
+    raise click.UsageError('--async only works with a single TPU.')
+  return True
+
+def rollout(verb, tpus, zone=None, project=None, filter_=None, yes=False, dry_run=False, max_parallel=4, max_unavailable=1,
+            until=tpunicorn.tpu.is_tpu_healthy, **kws):
+  done = {'start': 'started', 'stop': 'stopped', 'reimage': 'reimaged'}.get(verb, verb + 'd')
+  # which TPUs are healthy decides how many can go at once, so look afresh.
+  fleet = tpunicorn.tpu.get_fleet(zone=zone, project=project, filter=filter_, fresh=True)
+  tpus = resolve_tpus(fleet, tpus) if tpus else fleet.tpus
+  if len(tpus) <= 0:
+    click.echo('No TPUs matched.')
+    return
+  click.echo('Current status of {} TPUs as of {}:'.format(len(tpus), tpunicorn.tpu.get_timestamp()))
+  print_tpu_status_headers()
+  for tpu in tpus:
+    print_tpu_status(tpu)
+  def command(tpu):
+    command = tpunicorn.tpu.lifecycle_command(verb, tpu, zone=tpu.zone, project=project, async_=True, **kws)
+    if not isinstance(command, tpunicorn.tpu.LifecycleCall):
+      # gcloud can't be polled; let it run to completion instead.
+      command = tpunicorn.tpu.lifecycle_command(verb, tpu, zone=tpu.zone, project=project, **kws)
+    return command
+  commands = {tpu.id: command(tpu) for tpu in tpus}
+  if not yes:
+    for tpu in tpus:
+      print_step('TPU {}: {} TPU.'.format(tpu.id, verb), commands[tpu.id])
+    click.echo('')
+    click.echo('At most {} TPUs at a time; at most {} healthy TPUs out of service at once.'.format(max_parallel, max_unavailable))
+    if not click.confirm('Proceed? {}'.format('(dry run)' if dry_run else '')):
+      return
+  def begin(tpu):
+    print_step('TPU {}: {} TPU...'.format(tpu.id, verb), commands[tpu.id])
+    if dry_run:
+      click.echo('Dry run; command skipped.')
+      return None
+    if isinstance(commands[tpu.id], tpunicorn.tpu.LifecycleCall):
+      return commands[tpu.id]()
+    result = os.system(commands[tpu.id])
+    if result != 0:
+      raise RuntimeError('Command exited with status {}'.format(result))
+  def on_change(tpu):
+    if tpu is not None:
+      print_tpu_status(tpu)
+  def on_done(tpu, seconds, error):
+    if error is None:
+      click.echo('TPU {} {} {} ({:.0f}s).'.format(tpu.id, 'would be' if dry_run else 'is', done, seconds))
+    elif error == 'skipped':
+      click.secho('TPU {} skipped.'.format(tpu.id), fg='red', err=True)
+    else:
+      click.secho('TPU {} failed: {}'.format(tpu.id, error), fg='red', err=True)
+  results = tpunicorn.tpu.Rollout(tpus, begin, until=None if dry_run else until,
+                                  max_parallel=max_parallel, max_unavailable=max_unavailable,
+                                  project=project, on_change=on_change, on_done=on_done).run()
+  click.echo('')
+  width = max(len(tpu.id) for tpu, seconds, error in results)
+  click.secho('{:<{width}}  {:>8}  {}'.format('TPU', 'DURATION', 'RESULT', width=width), bold=True)
+  for tpu, seconds, error in sorted(results, key=lambda result: tpunicorn.tpu.parse_tpu_index(result[0])):
+    click.echo('{:<{width}}  {:>7.0f}s  {}'.format(tpu.id, seconds, done if error is None else error, width=width))
+  durations = [seconds for tpu, seconds, error in results if error is None]
+  click.echo('{} of {} TPUs {}{}.'.format(len(durations), len(results), done,
+    '; {:.0f}s on average, {:.0f}s at most'.format(sum(durations) / len(durations), max(durations)) if durations else ''))
+  if len(durations) < len(results):
+    sys.exit(1)
+
+def resolve_tpus(fleet, patterns):
+  # like fleet.match, but a TPU given by id or index has to exist.
+  tpus = []
+  for pattern in patterns:
+    if is_tpu_selector(pattern):
+      matches = fleet.match([pattern])
+    else:
+      matches = [fleet.get(pattern)]
+    tpus.extend(tpu for tpu in matches if tpu not in tpus)
+  return tpus
+
 @cli.command()
-@click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
+@click.argument('tpus', nargs=-1, required=True, type=click.STRING, metavar='TPU...', autocompletion=complete_tpu_id)
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
 @click.option('--version', type=click.STRING, metavar="<TF_VERSION>",
@@ -397,46 +682,102 @@ def reimage(tpu, zone, project, version, yes, dry_run, async_):
 @click.option('--retry', type=int, help="if the TPU creation fails (due to capacity errors or otherwise), "
                                         "retry the creation command after this many seconds")
 @click.option('--retry-randomness', type=float, default=1.0, help="multiply retry time by a float between 1 and retry_randomness")
-def recreate(tpu, zone, project, version, yes, dry_run, preempted, command, retry, retry_randomness, **kws):
+@click.option('-fz', '--fallback-zone', type=ZoneChoice(), default=None, autocompletion=complete_zone,
+              help="Also try to create the TPU in these zones (e.g. euw4a,usc1f) at the same time,"
+                   " keeping whichever comes up first and deleting the rest.")
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='Recreate at most this many TPUs at once. (default: 4)')
+def recreate(tpus, zone, project, version, yes, dry_run, preempted, command, retry, retry_randomness, fallback_zone, max_parallel, **kws):
   """
-  Recreates a TPU, optionally switching the system software to the specified TF_VERSION.
+  Recreates TPUs, optionally switching the system software to the specified TF_VERSION.
+
+  Each TPU can be an id, an index, or a glob like 'tpu-v3-8-*'.
   """
-  tpu = tpunicorn.get_tpu(tpu=tpu, zone=zone, project=project)
-  click.echo('Current status of TPU {} as of {}:'.format(tpunicorn.tpu.parse_tpu_id(tpu), tpunicorn.tpu.get_timestamp()))
+  fleet = tpunicorn.tpu.get_fleet(zone=zone, project=project)
+  tpus = resolve_tpus(fleet, tpus)
+  click.echo('Current status of {} as of {}:'.format(
+    'TPU {}'.format(tpus[0].id) if len(tpus) == 1 else '{} TPUs'.format(len(tpus)),
+    tpunicorn.tpu.get_timestamp()))
   print_tpu_status_headers()
-  print_tpu_status(tpu)
-  if preempted and not is_preempted(tpu, zone=zone, project=project):
-    return
+  for tpu in tpus:
+    print_tpu_status(tpu)
+  if preempted:
+    tpus = [tpu for tpu in tpus if tpu.state == 'PREEMPTED']
+    if len(tpus) <= 0:
+      return
+  if fallback_zone is not None and tpunicorn.tpu.get_lifecycle_backend() == 'gcloud':
+    raise click.UsageError('--fallback-zone needs the rest backend.')
   click.echo('')
-  delete = tpunicorn.delete_tpu_command(tpu, zone=zone, project=project)
-  create = tpunicorn.create_tpu_command(tpu, zone=zone, project=project, version=version)
-  def wait():
-    wait_healthy(tpu, zone=zone, project=project)
+  def plan(tpu):
+    zones = [tpu.zone] + [z for z in (fallback_zone or '').split(',') if z and z != tpu.zone]
+    delete = tpunicorn.tpu.lifecycle_command('delete', tpu, zone=tpu.zone, project=project)
+    create = tpunicorn.tpu.lifecycle_command('create', tpu, zone=tpu.zone, project=project, version=version)
+    winner = [tpu.zone]
+    def race():
+      try:
+        winner[0], remains = tpunicorn.tpu.race_create_tpu(tpu, zones, project=project, version=version)
+      except RuntimeError as e:
+        click.secho(str(e), fg='red', err=True)
+        return 1
+      click.echo('TPU {} came up in {}.'.format(tpu.id, winner[0]))
+      for remain in remains:
+        click.secho('TPU {} may still exist in {}; delete it by hand.'.format(tpu.id, remain), fg='red', err=True)
+      leftovers.extend(remains)
+    def wait():
+      wait_healthy(tpu, zone=winner[0], project=project)
+    return zones, delete, create, race, wait
+  plans = [(tpu, plan(tpu)) for tpu in tpus]
   if not yes:
-    print_step('Step 1: delete TPU.', delete)
-    print_step('Step 2: create TPU.', create)
-    print_step('Step 3: wait until TPU is HEALTHY.', wait)
-    if len(command) > 0:
-      for i, cmd in enumerate(command):
-        print_step('Step {}: run this command:'.format(i+4), cmd)
+    for tpu, (zones, delete, create, race, wait) in plans:
+      prefix = '' if len(plans) == 1 else 'TPU {}: '.format(tpu.id)
+      print_step(prefix + 'Step 1: delete TPU.', delete)
+      if len(zones) > 1:
+        print_step(prefix + 'Step 2: create TPU in whichever of {} has capacity first, like:'.format(', '.join(zones)), create)
+      else:
+        print_step(prefix + 'Step 2: create TPU.', create)
+      print_step(prefix + 'Step 3: wait until TPU is HEALTHY.', wait)
+      if len(command) > 0:
+        for i, cmd in enumerate(command):
+          print_step(prefix + 'Step {}: run this command:'.format(i+4), cmd)
     if not click.confirm('Proceed? {}'.format('(dry run)' if dry_run else '')):
       return
-  do_step('Step 1: delete TPU...', delete, dry_run=dry_run)
-  while do_step('Step 2: create TPU...', create, dry_run=dry_run) != 0:
-    if retry is None:
-      click.echo('TPU {} failed to create (is the region out of capacity?)'.format(tpunicorn.tpu.parse_tpu_id(tpu)), err=True)
-      break
-    n = random.uniform(1, retry_randomness)
-    click.echo('TPU {} failed to create; trying again in {} minutes...'.format(tpunicorn.tpu.parse_tpu_id(tpu),
-                                                                               int((retry * n)//60)), err=True)
-    time.sleep(retry * n)
-  do_step('Step 3: wait for TPU to become HEALTHY...', wait, dry_run=dry_run)
-  if len(command) > 0:
-    for i, cmd in enumerate(command):
-      do_step('Step {}: running command...'.format(i+4), cmd, dry_run=dry_run)
-  click.echo('TPU {} {} ready for training.'.format(
-    tpunicorn.tpu.parse_tpu_id(tpu),
-    'would be' if dry_run else 'is'))
+  leftovers = []
+  def recreate_one(tpu, zones, delete, create, race, wait):
+    do_step('Step 1: delete TPU {}...'.format(tpu.id), delete, dry_run=dry_run)
+    if len(zones) > 1:
+      label, step = 'Step 2: create TPU {} in {}...'.format(tpu.id, ', '.join(zones)), race
+    else:
+      label, step = 'Step 2: create TPU {}...'.format(tpu.id), create
+    while do_step(label, step, dry_run=dry_run, check=retry is None) != 0:
+      if retry is None:
+        click.echo('TPU {} failed to create (is the region out of capacity?)'.format(tpu.id), err=True)
+        break
+      n = random.uniform(1, retry_randomness)
+      click.echo('TPU {} failed to create; trying again in {} minutes...'.format(tpu.id,
+                                                                                 int((retry * n)//60)), err=True)
+      time.sleep(retry * n)
+    do_step('Step 3: wait for TPU {} to become HEALTHY...'.format(tpu.id), wait, dry_run=dry_run)
+    if len(command) > 0:
+      for i, cmd in enumerate(command):
+        do_step('Step {}: running command...'.format(i+4), cmd, dry_run=dry_run)
+    click.echo('TPU {} {} ready for training.'.format(
+      tpu.id,
+      'would be' if dry_run else 'is'))
+  failed = []
+  if len(plans) == 1:
+    tpu, steps = plans[0]
+    recreate_one(tpu, *steps)
+  else:
+    with futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+      jobs = {executor.submit(recreate_one, tpu, *steps): tpu for tpu, steps in plans}
+      for job in futures.as_completed(jobs):
+        try:
+          job.result()
+        except BaseException as e:
+          click.secho('TPU {} failed to recreate: {}'.format(jobs[job].id, e), fg='red', err=True)
+          failed.append(jobs[job])
+  if failed or leftovers:
+    sys.exit(1)
 
 
 @cli.command()
@@ -463,37 +804,229 @@ def ssh(tpu, zone, project, yes, dry_run, ssh_flag, worker):
   do_step('Step 1: ssh into TPU...', cmd, dry_run=dry_run)
 
 
-@cli.command()
+@cli.command('exec', context_settings=dict(ignore_unknown_options=True))
 @click.argument('tpu', type=click.STRING, autocompletion=complete_tpu_id)
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+@tpu_zone_option()
+@click.option('-p', '--project', type=click.STRING, default=None)
+@click.option('-a', '--all-workers', is_flag=True, help='Run the command on every worker of the TPU.')
+@click.option('-w', '--worker', type=click.INT, multiple=True,
+              help='Run the command on this worker (0-based). Can be given more than once. (default: 0)')
+@click.option('-j', '--max-parallel', type=click.INT, default=32, metavar='<count>',
+              help='Connect to at most this many workers at once. (default: 32)')
+@click.option('-u', '--user', type=click.STRING, default=None, help='SSH as this user. (default: your username)')
+@click.option('--ssh-port', type=click.INT, default=None, help='SSH to this port. (default: 22)')
+@click.option('-i', '--identity-file', type=click.STRING, default=None,
+              help='SSH with this key. (default: ~/.ssh/google_compute_engine, as set up by gcloud)')
+@click.option('-o', '--ssh-option', type=click.STRING, multiple=True, help='Pass this -o option to ssh.')
+@click.option('--internal-ip', is_flag=True, help="Connect to the workers' internal IPs.")
+@click.option('-y', '--yes', is_flag=True)
+@click.option('--dry-run', is_flag=True)
+def exec_(tpu, command, zone, project, all_workers, worker, max_parallel, user, ssh_port, identity_file, ssh_option, internal_ip, yes, dry_run):
+  """Runs a command on the workers of a TPU VM over ssh, e.g.
+
+    pu exec my-tpu --all-workers -- pkill -9 -f train.py
+
+  Every worker is connected to at once, and each line of output is
+  prefixed with its worker number. Connections are kept open for a
+  while afterwards and reused (ssh ControlMaster), so running another
+  command soon after skips the handshake. Exits with the highest exit
+  status of any worker."""
+  tpu = tpunicorn.get_tpu(tpu=tpu, zone=zone, project=project)
+  ips = tpunicorn.tpu.parse_tpu_worker_ips(tpu, internal_only=internal_ip)
+  workers = None if all_workers else (list(worker) or [0])
+  command = command[0] if len(command) == 1 else ' '.join(tpunicorn.tpu.shellquote(x) for x in command)
+  kws = dict(user=user, port=ssh_port, identity_file=identity_file, options=ssh_option)
+  if not yes or dry_run:
+    for i in (range(len(ips)) if workers is None else workers):
+      if i < len(ips):
+        print_step('Worker {}:'.format(i), ' '.join(tpunicorn.tpu.shellquote(x) for x in tpunicorn.tpu.ssh_worker_command(ips[i], command, host_key_alias=tpunicorn.tpu.get_ssh_host_key_alias(tpu, i), **kws)))
+    if dry_run:
+      click.echo('Dry run; command skipped.')
+      return
+    if not click.confirm('Proceed?'):
+      return
+  width = len(str(len(ips) - 1))
+  lock = threading.Lock()
+  def on_output(i, line):
+    with lock:
+      click.secho('[{:>{width}}] '.format(i, width=width), fg='blue', nl=False)
+      click.echo(line)
+  try:
+    codes = tpunicorn.tpu.exec_on_workers(tpu, command, workers=workers, max_parallel=max_parallel,
+                                          on_output=on_output, internal_only=internal_ip, **kws)
+  except ValueError as e:
+    raise click.ClickException(str(e))
+  failed = {i: code for i, code in codes.items() if code != 0}
+  for i, code in sorted(failed.items()):
+    click.secho('Worker {} exited with status {}{}.'.format(i, code, ' (ssh failed)' if code == 255 else ''), fg='red', err=True)
+  if len(codes) > 1:
+    click.echo('{} of {} workers succeeded.'.format(len(codes) - len(failed), len(codes)), err=True)
+  if failed:
+    # a worker killed by signal N exits 128+N, like in a shell.
+    sys.exit(max(code if code > 0 else 128 - code for code in failed.values()))
+
+
+@cli.command()
+@click.argument('tpus', nargs=-1, type=click.STRING, metavar='[TPU]...', autocompletion=complete_tpu_id)
 @tpu_zone_option()
 @click.option('-p', '--project', type=click.STRING, default=None)
 @click.option('--dry-run', is_flag=True)
 @click.option('-i', '--interval', type=click.INT, default=30, metavar='<seconds>',
-              help='How often to check the TPU. (default: 30 seconds)')
+              help='How often to check the TPUs, on average. (default: 30 seconds)')
+@click.option('--min-interval', type=click.FLOAT, default=None, metavar='<seconds>',
+              help='Check TPUs at most this often, even when they are likely to preempt. (default: INTERVAL/3)')
+@click.option('--max-interval', type=click.FLOAT, default=None, metavar='<seconds>',
+              help='Check TPUs at least this often, even when they are unlikely to preempt. (default: INTERVAL*4)')
 @click.option('-c', '--command', type=click.STRING, multiple=True,
-              help="After the TPU has been recreated and is HEALTHY, run this command."
+              help="After a TPU has been recreated and is HEALTHY, run this command."
                    " (Useful for killing a training session after the TPU has been recreated.)")
-@click.pass_context
-def babysit(ctx, tpu, zone, project, dry_run, interval, command):
-  """Checks TPU every INTERVAL seconds. Recreates the TPU if (and only if) the tpu has preempted."""
-  # cmd = cli.get_command(ctx, 'babysit')
-  # ctx = click.Context(cmd, parent=ctx, ignore_unknown_options=True)
-  ctx.forward(recreate, yes=True, preempted=True)
-  while True:
-    time.sleep(interval)
-    try:
-      ctx.forward(recreate, yes=True, preempted=True)
-    except:
-      import traceback
-      traceback.print_exc()
+@click.option('-j', '--max-parallel', type=click.INT, default=4, metavar='<count>',
+              help='Recreate at most this many TPUs at once. (default: 4)')
+@click.option('--spares', type=click.INT, default=0, metavar='<count>',
+              help='Keep this many healthy spare TPUs for each accelerator type and zone, and swap one in as soon as a TPU preempts. (default: 0)')
+@click.option('--spare-index', type=click.INT, default=900, metavar='<index>',
+              help='Spare TPUs are the ones with an index of at least this. (default: 900)')
+@click.option('--max-spares', type=click.INT, default=None, metavar='<count>',
+              help='Never keep more than this many spare TPUs altogether.')
+@tpu_filter_option()
+def babysit(tpus, zone, project, dry_run, interval, min_interval, max_interval, command, max_parallel, spares, spare_index, max_spares, filter_):
+  """Checks TPUs about every INTERVAL seconds. Recreates each TPU if (and only if) it has preempted.
+
+  Each TPU can be an id, an index, or a glob like 'tpu-v3-8-*'; or pick
+  TPUs with --filter. TPUs are checked more often at the ages and in the
+  zones where they have tended to preempt, and less often otherwise,
+  with no more fleet fetches overall than one per INTERVAL.
+
+  With --spares, a preempted TPU is replaced by a healthy spare instead:
+  the commands run against the spare (TPU_NAME is set to its id), the
+  preempted TPU is deleted, and a new spare is created in the background."""
+  if len(tpus) <= 0 and filter_ is None:
+    raise click.UsageError('Specify at least one TPU, or a --filter.')
+  def on_tick(watched):
+    if on_tick.first:
+      on_tick.first = False
+      click.echo('Babysitting {} TPUs as of {}:'.format(len(watched), tpunicorn.tpu.get_timestamp()))
+      print_tpus(watched)
+    if pool is not None:
+      stats = pool.stats()
+      if stats['swaps'] > on_tick.swaps:
+        on_tick.swaps = stats['swaps']
+        latency = stats['swap_latency']
+        click.echo('Spares: {swaps} swaps, {misses} misses, {refills} created; swap latency {last:.1f}s (mean {mean:.1f}s, max {max:.1f}s).'.format(
+          last=latency['last'], mean=latency['mean'], max=latency['max'], **stats))
+  on_tick.first = True
+  on_tick.swaps = 0
+  def recreate_tpu(tpu):
+    click.echo('TPU {} preempted as of {}; recreating.'.format(tpu.id, tpunicorn.tpu.get_timestamp()))
+    create = tpunicorn.tpu.lifecycle_command('create', tpu)
+    # when retrying a recreate that failed, the TPU may be gone already.
+    if tpunicorn.tpu.get_tpu(tpu.id, zone=tpu.zone, project=project, silent=True, fresh=True) is not None:
+      delete = tpunicorn.tpu.lifecycle_command('delete', tpu)
+      do_step('Step 1: delete TPU {}...'.format(tpu.id), delete, dry_run=dry_run)
+    do_step('Step 2: create TPU {}...'.format(tpu.id), create, dry_run=dry_run)
+  def on_healthy(tpu):
+    click.echo('TPU {} is HEALTHY again as of {}.'.format(tpu.id, tpunicorn.tpu.get_timestamp()))
+    for i, cmd in enumerate(command):
+      do_step('Step {}: running command for TPU {}...'.format(i+3, tpu.id), cmd, dry_run=dry_run, env={'TPU_NAME': tpu.id})
+  def on_swap(tpu, spare):
+    click.echo('TPU {} preempted as of {}; swapping in spare TPU {}.'.format(tpu.id, tpunicorn.tpu.get_timestamp(), spare.id))
+    for i, cmd in enumerate(command):
+      do_step('Step {}: running command for TPU {}...'.format(i+1, spare.id), cmd, dry_run=dry_run,
+              env={'TPU_NAME': spare.id, 'TPUNICORN_PREEMPTED_TPU': tpu.id})
+  pool = None
+  if spares > 0:
+    pool = tpunicorn.tpu.SparePool(spares, base_index=spare_index, max_total=max_spares, project=project,
+                                   run=lambda label, cmd: do_step(label, cmd, dry_run=dry_run))
+  babysitter = tpunicorn.tpu.Babysitter(tpus, zone=zone, project=project, filter=filter_,
+                                        recreate=recreate_tpu, on_healthy=on_healthy, on_tick=on_tick,
+                                        max_parallel=max_parallel, interval=interval,
+                                        min_interval=min_interval, max_interval=max_interval,
+                                        pool=pool, on_swap=on_swap)
+  babysitter.run()
+
+@cli.command()
+def zones():
+  """List the available TPU zones and their abbreviations."""
+  index = tpunicorn.tpu.get_zone_index()
+  for zone in index.zones:
+    click.echo('{} {}'.format(zone, index.by_zone.get(zone, '')).rstrip())
+
+@cli.command('refresh-cache')
+@click.option('-p', '--project', type=click.STRING, default=None)
+@click.option('-w', '--watch', type=click.FLOAT, default=None, metavar='<seconds>',
+              help="Keep running, refreshing every this many seconds.")
+def refresh_cache(project, watch):
+  """Refresh the fleet snapshot used by `pu list` and shell completion."""
+  project = tpunicorn.tpu.get_default_project(project=project)
+  if watch is None:
+    tpunicorn.snapshot.refresh_snapshot(project)
+  else:
+    tpunicorn.snapshot.watch(project, interval=watch)
+
+# Completion of TPU ids and zones is answered straight from the word lists
+# in the cache dir (see tpunicorn.snapshot.write_completions), without
+# starting python; anything else falls through to click's completion.
+# A word list older than a minute is refreshed in the background.
+
+fast_completion_words = {
+  'zones': ['-z', '--zone'],
+  'tpus': ['-t', '--tpu', 'create', 'delete', 'start', 'stop', 'reimage', 'recreate', 'ssh', 'exec', 'babysit'],
+}
+
+fast_completion_bash = """
+_{func}_fast_completion() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}" prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    local file="${{TPUNICORN_CACHE_DIR:-${{XDG_CACHE_HOME:-$HOME/.cache}}/tpunicorn}}/completions-${{CLOUDSDK_ACTIVE_CONFIG_NAME:-default}}"
+    case "$prev" in
+        {zones}) file="$file.zones" ;;
+        {tpus}) file="$file.tpus" ;;
+        *) file="" ;;
+    esac
+    if [[ -n "$file" && "$cur" != -* && -f "$file" ]]; then
+        local IFS=$'\\n'
+        COMPREPLY=( $(compgen -W "$(< "$file")" -- "$cur") )
+        [[ -n "$(find "$file" -mmin +1 2>/dev/null)" ]] && ( {name} refresh-cache >/dev/null 2>&1 & )
+        return 0
+    fi
+    _{func}_completion "$@"
+}}
+complete -o default -F _{func}_fast_completion {name}
+""".strip()
+
+fast_completion_zsh = """
+_{func}_fast_completion() {{
+    local file="${{TPUNICORN_CACHE_DIR:-${{XDG_CACHE_HOME:-$HOME/.cache}}/tpunicorn}}/completions-${{CLOUDSDK_ACTIVE_CONFIG_NAME:-default}}"
+    case "${{words[CURRENT-1]}}" in
+        {zones}) file="$file.zones" ;;
+        {tpus}) file="$file.tpus" ;;
+        *) file="" ;;
+    esac
+    if [[ -n "$file" && "${{words[CURRENT]}}" != -* && -f "$file" ]]; then
+        compadd -- ${{(f)"$(<$file)"}}
+        [[ -n "$(find "$file" -mmin +1 2>/dev/null)" ]] && ( {name} refresh-cache >/dev/null 2>&1 & )
+        return 0
+    fi
+    _{func}_completion "$@"
+}}
+compdef _{func}_fast_completion {name}
+""".strip()
+
+def get_fast_completion_script(template, name):
+  return template.format(
+    func=name.replace('-', '_'),
+    name=name,
+    **{kind: '|'.join(words) for kind, words in fast_completion_words.items()})
 
 completions = {
   'bash': {
     'script': 'eval "$(_{}_COMPLETE=source_bash {})"',
+    'fast': fast_completion_bash,
     'file': '~/.bash_profile' if sys.platform == 'darwin' else '~/.bashrc',
   },
   'zsh': {
     'script': 'eval "$(_{}_COMPLETE=source_zsh {})"',
+    'fast': fast_completion_zsh,
     'file': '~/.zshrc',
   },
   'fish': {
@@ -507,15 +1040,17 @@ completions = {
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--dry-run', is_flag=True)
 def install_completion(shell, yes, dry_run):
-  def install_completion(path, script, name):
+  def install_completion(path, scripts, name):
     try:
       with click.open_file(path) as f:
         contents = f.read()
     except FileNotFoundError:
       contents = ''
-    if script in contents:
+    scripts = [script for script in scripts if script not in contents]
+    if not scripts:
       click.echo('Completion script {} already installed; skipping'.format(name))
       return
+    script = '\n'.join(scripts)
     if len(contents) > 0 and not contents.endswith('\n'):
       contents += '\n'
     contents += script + '\n'
@@ -526,7 +1061,12 @@ def install_completion(shell, yes, dry_run):
       with click.open_file(path, 'w', atomic=True) as f:
         f.write(contents)
       click.secho('{} completion installed for `{}`'.format(shell, name), bold=True)
-  scripts = [completions[shell]['script'].format(binary.upper().replace('-', ''), binary) for binary in binary_names]
+  scripts = []
+  for binary in binary_names:
+    script = [completions[shell]['script'].format(binary.upper().replace('-', ''), binary)]
+    if 'fast' in completions[shell]:
+      script.append(get_fast_completion_script(completions[shell]['fast'], binary))
+    scripts.append(script)
   filename = os.path.expanduser(completions[shell]['file'])
   tasks = []
   for script, name in zip(scripts, binary_names):
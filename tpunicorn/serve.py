@@ -7,16 +7,23 @@ import tpunicorn
 
 app = Sanic()
 
+# both routes accept ?filter=<expr>, using the same syntax as `pu list --filter`.
+
 @app.route('/.json')
 async def tpus(request):
-    return json(tpunicorn.get_tpus())
+    tpus = tpunicorn.get_tpus(filter=request.args.get('filter'))
+    return json([tpunicorn.tpu.as_dict(tpu) for tpu in tpus])
 
 @app.route('/')
 async def tpus(request):
-  s = tpunicorn.format(tpunicorn.format_headers()) + '\n'
-  for tpu in tpunicorn.get_tpus():
-    s += tpunicorn.format(tpu) + '\n'
+  s = ''
+  for tpu, args, line in tpunicorn.tpu.render_table(tpunicorn.get_tpus(filter=request.args.get('filter'))):
+    s += line + '\n'
   return text(s)
+
+@app.route('/stats.json')
+async def stats(request):
+  return json(tpunicorn.tpu.get_flight_stats())
     
 if __name__ == '__main__':
   args = sys.argv[1:]
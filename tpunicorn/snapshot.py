@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+# A fleet snapshot is the node list for one (configuration, project, zone)
+# written to disk, so that separate `pu` processes can share one fetch.
+#
+# - younger than TPUNICORN_SNAPSHOT_TTL seconds: served as-is.
+# - younger than TPUNICORN_SNAPSHOT_MAX_STALE seconds: served as-is, while
+#   a detached `python -m tpunicorn.snapshot` process refreshes it.
+# - otherwise (or missing): fetched synchronously and written back.
+
+def get_snapshot_ttl():
+  return float(os.environ.get('TPUNICORN_SNAPSHOT_TTL', '10'))
+
+def get_snapshot_max_stale():
+  return float(os.environ.get('TPUNICORN_SNAPSHOT_MAX_STALE', '300'))
+
+def get_cache_dir():
+  path = os.environ.get('TPUNICORN_CACHE_DIR')
+  if path is None:
+    path = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tpunicorn')
+  return path
+
+def get_configuration():
+  return os.environ.get('CLOUDSDK_ACTIVE_CONFIG_NAME', 'default')
+
+def snapshot_path(project, zone=None, configuration=None, suffix='.json'):
+  if configuration is None:
+    configuration = get_configuration()
+  if zone is not None and not isinstance(zone, str):
+    zone = ','.join(zone)
+  key = '-'.join([configuration, project, zone or 'all'])
+  key = re.sub(r'[^A-Za-z0-9_.,-]', '_', key)
+  return os.path.join(get_cache_dir(), 'fleet-' + key + suffix)
+
+def write_atomic(path, data):
+  dirname = os.path.dirname(path)
+  os.makedirs(dirname, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+    os.replace(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+def read_snapshot(project, zone=None):
+  try:
+    with open(snapshot_path(project, zone=zone)) as f:
+      snapshot = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if not isinstance(snapshot, dict) or 'nodes' not in snapshot:
+    return None
+  return snapshot
+
+def write_snapshot(project, nodes, zone=None, timestamp=None):
+  if timestamp is None:
+    timestamp = time.time()
+  snapshot = {
+    'configuration': get_configuration(),
+    'project': project,
+    'zone': zone,
+    'time': timestamp,
+    'nodes': nodes,
+  }
+  write_atomic(snapshot_path(project, zone=zone), json.dumps(snapshot))
+  if zone is None:
+    write_completions(project, nodes)
+  return snapshot
+
+def snapshot_age(snapshot, now=None):
+  if now is None:
+    now = time.time()
+  return now - snapshot.get('time', 0)
+
+# Shell completion reads these plain word lists directly (see
+# `pu install-completion`), so a TAB never waits on python or the network.
+# They're only written for the default project, since that's the one the
+# shell will be asking about.
+
+def completions_path(kind, configuration=None):
+  if configuration is None:
+    configuration = get_configuration()
+  return os.path.join(get_cache_dir(), 'completions-{}.{}'.format(configuration, kind))
+
+def write_completions(project, nodes):
+  from . import tpu
+  if project != tpu.get_default_project():
+    return
+  words = []
+  for node in nodes:
+    words.append(tpu.parse_tpu_id(node))
+    index = tpu.parse_tpu_index(node)
+    if index >= 0:
+      words.append(str(index))
+  write_atomic(completions_path('tpus'), '\n'.join(sorted(set(words))) + '\n')
+  index = tpu.get_zone_index(tpu.get_tpu_zones(project=project))
+  words = index.zones + list(index.unambiguous)
+  write_atomic(completions_path('zones'), '\n'.join(words) + '\n')
+
+def read_completions(kind):
+  try:
+    with open(completions_path(kind)) as f:
+      return f.read().split()
+  except OSError:
+    return None
+
+def refresh_snapshot(project, zone=None):
+  from . import tpu
+  nodes = tpu.list_tpus(zone=zone, project=project)
+  return write_snapshot(project, nodes, zone=zone)
+
+def acquire_refresh_lock(project, zone=None, timeout=60.0):
+  # only one background refresh per snapshot at a time; a lock older
+  # than `timeout` seconds is assumed to belong to a dead process.
+  path = snapshot_path(project, zone=zone, suffix='.lock')
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  try:
+    if time.time() - os.path.getmtime(path) > timeout:
+      os.unlink(path)
+  except OSError:
+    pass
+  try:
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+  except FileExistsError:
+    return None
+  return path
+
+def release_refresh_lock(path):
+  try:
+    os.unlink(path)
+  except OSError:
+    pass
+
+def refresh_in_background(project, zone=None):
+  lock = acquire_refresh_lock(project, zone=zone)
+  if lock is None:
+    return False
+  args = [sys.executable, '-m', __name__, project]
+  if zone is not None:
+    args.append(zone if isinstance(zone, str) else ','.join(zone))
+  try:
+    subprocess.Popen(args,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True,
+                     env=dict(os.environ, TPUNICORN_REFRESH_LOCK=lock))
+  except OSError:
+    release_refresh_lock(lock)
+    return False
+  return True
+
+def get_snapshot(project, zone=None, fresh=False, ttl=None, max_stale=None):
+  if ttl is None:
+    ttl = get_snapshot_ttl()
+  if max_stale is None:
+    max_stale = get_snapshot_max_stale()
+  if not fresh:
+    snapshot = read_snapshot(project, zone=zone)
+    if snapshot is not None:
+      age = snapshot_age(snapshot)
+      if age < ttl:
+        return snapshot
+      if age < max_stale:
+        refresh_in_background(project, zone=zone)
+        return snapshot
+  return refresh_snapshot(project, zone=zone)
+
+def get_snapshot_nodes(project, zone=None, fresh=False, ttl=None, max_stale=None):
+  return get_snapshot(project, zone=zone, fresh=fresh, ttl=ttl, max_stale=max_stale)['nodes']
+
+def watch(project, zone=None, interval=60.0):
+  # keep the snapshot (and the completion word lists) warm.
+  while True:
+    try:
+      refresh_snapshot(project, zone=zone)
+    except Exception:
+      import traceback
+      traceback.print_exc()
+    time.sleep(interval)
+
+def main(args):
+  project = args[0]
+  zone = args[1] if len(args) > 1 and args[1] else None
+  try:
+    refresh_snapshot(project, zone=zone)
+  finally:
+    lock = os.environ.get('TPUNICORN_REFRESH_LOCK')
+    if lock is not None:
+      release_refresh_lock(lock)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
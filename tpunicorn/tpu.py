@@ -1,16 +1,20 @@
 from six.moves import shlex_quote as shellquote
 from subprocess import check_output
+import subprocess
 import json
 import re
-import ring
 import os
 import sys
+import time
 import logging
 import functools
 import threading
 
 import importlib
 import inspect
+import heapq
+import random
+from concurrent import futures
 
 def reload(*args):
   if not args:
@@ -35,15 +39,109 @@ def reload(*args):
       return {lib.__name__: lib for lib in libs}
     
 
-from cachier import cachier
+def single_flight(f):
+  """Concurrent calls to `f` with the same arguments share one call: the
+  first caller runs it, the rest wait for (and return) its result. Works
+  from threads and from coroutines alike, and for coroutine functions.
+  stats() reports how many calls were coalesced."""
+  inflight = {}
+  lock = threading.Lock()
+  stats = {'calls': 0, 'coalesced': 0, 'inflight': 0}
+  def join(key):
+    with lock:
+      stats['calls'] += 1
+      flight = inflight.get(key)
+      if flight is not None:
+        stats['coalesced'] += 1
+        return flight, False
+      flight = inflight[key] = futures.Future()
+      stats['inflight'] = len(inflight)
+      return flight, True
+  def land(key, flight, result=None, error=None):
+    with lock:
+      del inflight[key]
+      stats['inflight'] = len(inflight)
+    if error is not None:
+      flight.set_exception(error)
+    else:
+      flight.set_result(result)
+  if inspect.iscoroutinefunction(f):
+    @functools.wraps(f)
+    async def wrapper(*args, **kws):
+      import asyncio
+      key = (args, tuple(sorted(kws.items())))
+      flight, leader = join(key)
+      if not leader:
+        return await asyncio.wrap_future(flight)
+      try:
+        result = await f(*args, **kws)
+      except BaseException as e:
+        land(key, flight, error=e)
+        raise
+      land(key, flight, result)
+      return result
+  else:
+    @functools.wraps(f)
+    def wrapper(*args, **kws):
+      key = (args, tuple(sorted(kws.items())))
+      flight, leader = join(key)
+      if not leader:
+        return flight.result()
+      try:
+        result = f(*args, **kws)
+      except BaseException as e:
+        land(key, flight, error=e)
+        raise
+      land(key, flight, result)
+      return result
+  wrapper.stats = lambda: dict(stats)
+  return wrapper
+
+def memoize(expire=None):
+  """Like functools.lru_cache (unbounded), except that entries expire
+  after `expire` seconds. Supports cache_clear(), so reset_caches()
+  works on it. Misses are single-flight (see single_flight), so a burst
+  of callers for a cold key makes one call."""
+  def decorator(f):
+    cache = {}
+    lock = threading.Lock()
+    flight = single_flight(f)
+    stats = {'hits': 0, 'misses': 0}
+    @functools.wraps(f)
+    def wrapper(*args, **kws):
+      key = (args, tuple(sorted(kws.items())))
+      now = time.time()
+      with lock:
+        hit = cache.get(key)
+        fresh = hit is not None and (expire is None or now - hit[0] < expire)
+        stats['hits' if fresh else 'misses'] += 1
+      if fresh:
+        return hit[1]
+      value = flight(*args, **kws)
+      with lock:
+        cache[key] = (now, value)
+      return value
+    wrapper.cache_clear = cache.clear
+    wrapper.stats = lambda: dict(stats, **flight.stats())
+    return wrapper
+  return decorator
+
+def get_flight_stats(module=__name__):
+  """Hit/miss/coalescing counters for every memoized or single-flight
+  function in `module`."""
+  return {k: v.stats() for k, v in sys.modules[module].__dict__.items()
+          if callable(v) and not isinstance(v, type) and callable(getattr(v, 'stats', None)) and getattr(v, '__module__', None) == module}
+
+# Heavy dependencies (googleapiclient, cachier, requests, braceexpand) are
+# imported where they're used, so that `import tpunicorn` (and thus
+# `pu --help`, shell completion, etc) stays fast.
+
 import datetime
-import requests
 
 # https://github.com/googleapis/google-auth-library-python/issues/271#issuecomment-400186626
 import warnings
 warnings.filterwarnings("ignore", "Your application has authenticated using end user credentials")
 
-import googleapiclient.discovery
 #api = googleapiclient.discovery.build('tpu', 'v1alpha1')
 #api_v2 = googleapiclient.discovery.build('tpu', 'v2')
 #api = googleapiclient.discovery.build('tpu', 'v2alpha1', static_discovery=False, discoveryServiceUrl=googleapiclient.discovery.V2_DISCOVERY_URI)
@@ -54,6 +152,7 @@ api_http = None
 def get_api():
   global api
   if api is None:
+    import googleapiclient.discovery
     api = googleapiclient.discovery.build('tpu', 'v2alpha1', discoveryServiceUrl=googleapiclient.discovery.V2_DISCOVERY_URI)
   return api
 
@@ -82,10 +181,14 @@ def build_opt(k, v):
     return '--no-' + k
   return '--{} {}'.format(k, shellquote(v))
 
-def build_commandline(cmd, tpu_name, *args, **kws):
+def build_commandline(cmd, tpu_name, *args, tpu_vm=None, **kws):
   # if 'zone' in kws:
   #   kws['zone'] = expand_zone_abbreviations(kws['zone'])
-  if is_tpu_vm(tpu_name, project=kws.get('project')) and 'tpu-vm' not in cmd or kws.get('version', '').startswith('v2'):
+  # pass tpu_vm when it's already known (e.g. from a node in hand), so that
+  # building the command doesn't need to look the TPU up.
+  if tpu_vm is None:
+    tpu_vm = is_tpu_vm_version(kws.get('version')) or is_tpu_vm(tpu_name, project=kws.get('project'))
+  if tpu_vm and 'tpu-vm' not in cmd:
     cmd = cmd.replace('gcloud compute tpus', 'gcloud alpha compute tpus tpu-vm')
   return ' '.join([cmd] + [shellquote(x) for x in [tpu_name, *args]] + [build_opt(k, v) for k, v in kws.items() if v is not None])
 
@@ -101,6 +204,8 @@ def run(cmd, *args, **kws):
   return out
 
 def parse_tpu_project(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.project
   fqn = tpu if isinstance(tpu, str) else tpu['name']
   return fqn.split('/')[-5]
 
@@ -109,10 +214,14 @@ def parse_tpu_zone(tpu):
   return fqn.split('/')[-3]
 
 def parse_tpu_id(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.id
   fqn = tpu if isinstance(tpu, str) else tpu['name']
   return fqn.split('/')[-1]
 
 def parse_tpu_index(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.index
   fqn = tpu if isinstance(tpu, str) else tpu['name']
   idx = re.findall(r'([0-9]+)$', fqn)
   if len(idx) <= 0:
@@ -130,14 +239,11 @@ def parse_tpu_accelerator_type(tpu):
     return accelerator_type[0]
 
 def parse_tpu_zone(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.zone
   fqn = tpu if isinstance(tpu, str) else tpu['name']
   if isinstance(tpu, str):
-    #zone_abbreviation = re.findall(r'[-]([^-]+)[-](?:v[0-9]+[-][0-9]+)', fqn)
-    # I might clean this up someday, but probably not. Sorry that this looks so cryptic.
-    results = [[expand_zone_abbreviations(k), re.findall(r'\b{}\b'.format(k), fqn)] for k, v in get_zone_abbreviations(only_unambiguous_results=True).items() if len(v) <= 1]
-    for zone, matched in results:
-      if matched:
-        return zone
+    return get_zone_index().match(fqn)
   else:
     return fqn.split('/')[-3]
 
@@ -164,86 +270,264 @@ region_abbrevs = {
     'sw': 'southwest',
 }
 
-
-def get_zone_abbreviations(full_zone_names=None, only_unambiguous_results=False): # e.g. ['europe-west4-a']
+country_names = {v: k for k, v in country_abbrevs.items()}
+region_names = {v: k for k, v in region_abbrevs.items()}
+
+class ZoneIndex:
+  """Zone abbreviation tables for a list of zones, built once.
+
+  `abbreviations` maps every abbreviation (e.g. 'euw4a', 'euw', 'west4')
+  to the zones it expands to; `unambiguous` holds only the full ones
+  (e.g. 'euw4a'), and `by_zone` maps each zone back to its full
+  abbreviation. `pattern` finds a full abbreviation inside a TPU name."""
+
+  def __init__(self, zones):
+    self.zones = list(zones)
+    abbreviations = defaultdict(list)
+    unambiguous = defaultdict(list)
+    self.by_zone = {}
+    for full_zone_name in self.zones:
+      country, region, zone_id = full_zone_name.split('-')
+      region, region_id = region[:-1], region[-1:]
+      assert int(region_id) in list(range(10))
+      cshort = country_names.get(country)
+      rshort = region_names.get(region)
+      if cshort is None or rshort is None:
+        continue
+      # e.g. 'euw4a'
+      abbrev = cshort + rshort + region_id + zone_id
+      unambiguous[abbrev].append(full_zone_name)
+      self.by_zone.setdefault(full_zone_name, abbrev)
+      for k in [
+          abbrev,
+          # e.g. 'euw4'
+          cshort + rshort + region_id,
+          # e.g. 'euw'
+          cshort + rshort,
+          # e.g. 'eu'
+          cshort,
+          # e.g. '4'
+          region_id,
+          # e.g. '4a'
+          region_id + zone_id,
+          # e.g. 'w4'
+          rshort + region_id,
+          # e.g. 'w'
+          rshort,
+          # e.g. 'west4'
+          region + region_id,
+          # e.g. 'west'
+          region]:
+        abbreviations[k].append(full_zone_name)
+    self.abbreviations = dict(abbreviations)
+    self.unambiguous = dict(unambiguous)
+    names = sorted([k for k, v in self.unambiguous.items() if len(v) <= 1], key=len, reverse=True)
+    self.pattern = re.compile(r'\b(' + '|'.join(map(re.escape, names)) + r')\b') if names else None
+
+  def expand(self, zone):
+    results = []
+    for zone in zone.split(','):
+      for expansion in self.abbreviations.get(zone, [zone]):
+        if expansion not in results:
+          results.append(expansion)
+    return ','.join(results)
+
+  def abbreviate(self, zone):
+    return self.by_zone[zone]
+
+  def match(self, name):
+    if self.pattern is not None:
+      m = self.pattern.search(name)
+      if m:
+        return self.unambiguous[m.group(1)][0]
+
+  def choices(self):
+    choices = []
+    seen = set()
+    for abbrev, expansions in self.abbreviations.items():
+      for k in expansions + [abbrev]:
+        if k not in seen:
+          seen.add(k)
+          choices.append(k)
+    return choices
+
+@memoize()
+def build_zone_index(zones):
+  return ZoneIndex(zones)
+
+def get_zone_index(full_zone_names=None):
   if full_zone_names is None:
     full_zone_names = get_tpu_zones()
   if isinstance(full_zone_names, str):
     full_zone_names = full_zone_names.split(',')
-  results = defaultdict(lambda: [])
-  for full_zone_name in full_zone_names:
-    country, region, zone_id = full_zone_name.split('-')
-    region, region_id = region[:-1], region[-1:]
-    assert int(region_id) in list(range(10))
-    for cshort, cfull in country_abbrevs.items():
-      for rshort, rfull in region_abbrevs.items():
-        if cfull == country and rfull == region:
-          # e.g. 'euw4a'
-          results[cshort + rshort + region_id + zone_id].append(full_zone_name)
-          if not only_unambiguous_results:
-            # e.g. 'euw4'
-            results[cshort + rshort + region_id].append(full_zone_name)
-            # e.g. 'euw'
-            results[cshort + rshort].append(full_zone_name)
-            # e.g. 'eu'
-            results[cshort].append(full_zone_name)
-            # e.g. '4'
-            results[region_id].append(full_zone_name)
-            # e.g. '4a'
-            results[region_id + zone_id].append(full_zone_name)
-            # e.g. 'w4'
-            results[rshort + region_id].append(full_zone_name)
-            # e.g. 'w'
-            results[rshort].append(full_zone_name)
-            # e.g. 'west4'
-            results[rfull + region_id].append(full_zone_name)
-            # e.g. 'west'
-            results[rfull].append(full_zone_name)
-  return dict(results)
+  return build_zone_index(tuple(full_zone_names))
+
+def get_zone_abbreviations(full_zone_names=None, only_unambiguous_results=False): # e.g. ['europe-west4-a']
+  index = get_zone_index(full_zone_names)
+  return index.unambiguous if only_unambiguous_results else index.abbreviations
 
 def infer_zone_abbreviation(zone):
-  # I might clean this up someday, but probably not. Sorry that this looks so cryptic.
-  return list(get_zone_abbreviations(zone, only_unambiguous_results=True).keys())[0]
+  return get_zone_index(zone).abbreviate(zone)
 
 def expand_zone_abbreviations(zone):
   if zone is None:
     return zone
-  results = []
-  for zone in zone.split(','):
-    for expansion in get_zone_abbreviations().get(zone, [zone]):
-      if expansion not in results:
-        results.append(expansion)
-  return ','.join(results)
+  return get_zone_index().expand(zone)
 
 def get_tpu_zone_choices(project=None):
-  choices = []
-  for abbrev, expansions in get_zone_abbreviations().items():
-    for expansion in expansions:
-      if expansion not in choices:
-        choices.append(expansion)
-    if abbrev not in choices:
-      choices.append(abbrev)
-  return choices
+  return get_zone_index(get_tpu_zones(project=project)).choices()
 
 def get_next_available_tpu_index(index, project=None, zone=None):
-  tpus = get_tpus(project=project, zone=zone)
-  while True:
-    ok = True
-    for t in tpus:
-      if parse_tpu_index(t) == index:
-        ok = False
-        index += 1
+  return get_fleet(project=project, zone=zone).next_available_index(index)
+
+index_spec_pattern = re.compile(r'^(?:([0-9]+)x)?([0-9]*)[+]$|^([0-9]+)[.][.]([0-9]+)$')
+
+def is_index_spec(spec):
+  return isinstance(spec, str) and index_spec_pattern.match(spec) is not None
+
+def allocate_tpu_indices(spec, fleet):
+  # '0..31' is indices 0 through 31; '8x+' is the next 8 free indices
+  # from 0, and '8x20+' from 20; '20+' is just the next one.
+  m = index_spec_pattern.match(spec)
+  if m is None:
+    raise ValueError('Not an index spec: {!r}'.format(spec))
+  if m.group(3) is not None:
+    lo, hi = int(m.group(3)), int(m.group(4))
+    if hi < lo:
+      raise ValueError('Empty index range: {!r}'.format(spec))
+    return list(range(lo, hi + 1))
+  count = int(m.group(1)) if m.group(1) else 1
+  index = int(m.group(2)) if m.group(2) else 0
+  indices = []
+  for _ in range(count):
+    index = fleet.next_available_index(index)
+    indices.append(index)
+    index += 1
+  return indices
+
+import ipaddress
+import math
+
+def get_tpu_range_prefixlen(cores):
+  return 29 if cores == 8 else int(32 + 2 - math.log2(cores))
+
+def default_tpu_range(index, cores):
+  # by convention, TPU `index` gets 10.48.{index}.0/29 if it's an 8-core
+  # TPU, and 10.{index+2}.0.0 if it's a pod.
+  if cores == 8:
+    return "10.48.{i}.0/29".format(i=index)
+  return "10.{i}.0.0/{cidr}".format(i=index + 2, cidr=get_tpu_range_prefixlen(cores))
+
+class RangeIndex:
+  """The CIDR blocks in use on each network, kept as sorted, disjoint
+  [start, end) address intervals. Checking a block is a bisect, O(log n).
+  Finding a free one bisects to where the search starts and then walks
+  the gaps from there, O(log n + k) for the k used intervals it passes;
+  since touching blocks merge, a run of allocations is one interval.
+
+  Build it from a fleet (e.g. the snapshot) and then allocate or
+  reserve blocks from it; nothing here calls the API."""
+
+  def __init__(self, tpus=()):
+    self.starts = defaultdict(list)
+    self.ends = defaultdict(list)
+    for tpu in tpus:
+      if tpu.range:
+        try:
+          self.reserve(tpu.range, network=tpu.network or 'default')
+        except ValueError:
+          logger.info('Ignoring bad range %r of TPU %s', tpu.range, tpu.id)
+
+  @staticmethod
+  def interval(block):
+    net = ipaddress.ip_network(block, strict=False)
+    return int(net.network_address), int(net.broadcast_address) + 1
+
+  def overlapping(self, lo, hi, network='default'):
+    # the index of the first used interval overlapping [lo, hi), or None.
+    starts, ends = self.starts[network], self.ends[network]
+    i = bisect.bisect_right(ends, lo)
+    if i < len(starts) and starts[i] < hi:
+      return i
+
+  def is_free(self, block, network='default'):
+    return self.overlapping(*self.interval(block), network=network) is None
+
+  def reserve(self, block, network='default'):
+    lo, hi = self.interval(block)
+    starts, ends = self.starts[network], self.ends[network]
+    # merge with every interval this one overlaps or touches.
+    i = bisect.bisect_left(ends, lo)
+    j = bisect.bisect_right(starts, hi)
+    if i < j:
+      lo = min(lo, starts[i])
+      hi = max(hi, ends[j - 1])
+    starts[i:j] = [lo]
+    ends[i:j] = [hi]
+
+  def allocate(self, prefixlen, network='default', within='10.0.0.0/8', exclude=(), preferred=None):
+    """Reserve and return `preferred` if it's free, or else the lowest
+    free block of size /`prefixlen` in `within` that isn't in `exclude`."""
+    excluded = [self.interval(block) for block in exclude]
+    def clash(lo, hi):
+      # the end of what [lo, hi) runs into, or None if it's free.
+      i = self.overlapping(lo, hi, network=network)
+      if i is not None:
+        return self.ends[network][i]
+      for x, y in excluded:
+        if x < hi and lo < y:
+          return y
+    if preferred is not None:
+      try:
+        net = ipaddress.ip_network(preferred)
+      except ValueError:
+        net = None
+      if net is not None and net.subnet_of(ipaddress.ip_network(within)) and clash(*self.interval(net)) is None:
+        self.reserve(str(net), network=network)
+        return str(net)
+    size = 1 << (32 - prefixlen)
+    lo, end = self.interval(within)
+    starts, ends = self.starts[network], self.ends[network]
+    # walk the gaps between used intervals from the first one ending
+    # after `lo`, rather than searching again for each candidate block.
+    i = bisect.bisect_right(ends, lo)
+    while True:
+      lo = -(-lo // size) * size
+      if lo + size > end:
         break
-    if ok:
-      return index
+      while i < len(starts) and ends[i] <= lo:
+        i += 1
+      if i < len(starts) and starts[i] < lo + size:
+        lo = ends[i]
+        continue
+      skip = next((y for x, y in excluded if x < lo + size and lo < y), None)
+      if skip is not None:
+        lo = skip
+        i = bisect.bisect_right(ends, lo)
+        continue
+      block = '{}/{}'.format(ipaddress.ip_address(lo), prefixlen)
+      self.reserve(block, network=network)
+      return block
+    raise ValueError('No free /{} range left in {} on network {}'.format(prefixlen, within, network))
+
+  def allocate_tpu_range(self, index, cores, network='default'):
+    # 8-core TPUs live in 10.48.0.0/16, and pods anywhere else in 10/8.
+    preferred = default_tpu_range(index, cores) if index >= 0 else None
+    if cores == 8:
+      return self.allocate(29, network=network, within='10.48.0.0/16', preferred=preferred)
+    return self.allocate(get_tpu_range_prefixlen(cores), network=network, exclude=['10.48.0.0/16'], preferred=preferred)
 
 
 def parse_tpu_network(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.network
   net = tpu if isinstance(tpu, str) else tpu['networkConfig']['network']
   return net.split('/')[-1]
 
 
 def parse_tpu_subnetwork(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.subnetwork
   net = tpu if isinstance(tpu, str) else tpu['networkConfig'].get('subnetwork', None)
   if net is not None:
     return net.split('/')[-1]
@@ -292,7 +576,7 @@ def get_bearer_token(creds=None):
 #     creds.refresh(auth_req)
 #   return creds
 
-@ring.lru(expire=3600) # cache default project for an hour
+@memoize(expire=3600) # cache default project for an hour
 def get_default_project(project=None):
     """Determine default project ID explicitly or implicitly as fall-back.
 
@@ -316,6 +600,8 @@ def cache_clearer(x):
       return lambda: x.delete()
     if hasattr(x, 'cache_clear') and x.__class__.__module__.split('.')[0] == 'functools':
       return lambda: x.cache_clear()
+    if hasattr(x, 'cache_clear') and getattr(x, '__module__', None) == __name__:
+      return lambda: x.cache_clear()
 
 def uncache(x):
   if isinstance(x, list):
@@ -347,13 +633,21 @@ def set_active_configuration(configuration):
   return True
   
 
-@cachier(stale_after=datetime.timedelta(days=3))
+@memoize(expire=3600) # cache tpu zones for an hour
 def fetch_tpu_zones(project):
+  return get_cached_zone_fetcher()(project=project)
+
+@memoize()
+def get_cached_zone_fetcher():
+  from cachier import cachier
+  return cachier(stale_after=datetime.timedelta(days=3))(_fetch_tpu_zones)
+
+def _fetch_tpu_zones(project):
   print('Fetching TPU zones...', file=sys.stderr)
   zones = get_api().projects().locations().list(name='projects/'+project).execute().get('locations', [])
   return [zone['locationId'] for zone in zones]
 
-#@ring.lru(expire=3600) # cache tpu zones for an hour
+#@memoize(expire=3600) # cache tpu zones for an hour
 def get_tpu_zones(project=None):
   project = get_default_project(project=project)
   if project is None:
@@ -364,7 +658,11 @@ def get_tpu_zones(project=None):
 
 from concurrent import futures
 
-@ring.lru(expire=5) # cache tpu info for 5 seconds
+@memoize(expire=5) # cache tpu info for 5 seconds
+def fetch_fleet(zone=None, project=None):
+  return Fleet(fetch_tpus(zone=zone, project=project))
+
+@single_flight
 def fetch_tpus(zone=None, project=None):
   # if zone is None:
   #   zones = get_tpu_zones(project=project)
@@ -378,7 +676,16 @@ def fetch_tpus(zone=None, project=None):
   #   for nodes in executor.map(lambda zone: list_tpus(zone, project=project, session=session), zones):
   #     tpus.extend(nodes)
   # return tpus
-  return list_tpus(zone=zone, project=project)
+  tpus = list_tpus(zone=zone, project=project)
+  if zone is None:
+    # every full fetch also refreshes the on-disk snapshot, which keeps
+    # `pu list` and shell completion warm for free.
+    from . import snapshot
+    try:
+      snapshot.write_snapshot(get_default_project(project=project), tpus)
+    except OSError as e:
+      logger.info('Could not write fleet snapshot: %s', e)
+  return tpus
 
 # this is very slow. Special-case it for speed.
 # def list_tpus(zone, project=None):
@@ -387,14 +694,30 @@ def fetch_tpus(zone=None, project=None):
 #   tpus = get_api().projects().locations().nodes().list(parent=zone).execute().get('nodes', [])
 #   return list(sorted(tpus, key=parse_tpu_index))
 
-@ring.lru()
+def get_max_concurrency():
+  # how many API requests may be in flight at once; also sizes the
+  # shared keep-alive connection pool.
+  return int(os.environ.get('TPUNICORN_MAX_CONCURRENCY', '32'))
+
+@memoize()
 def get_cached_requests_session():
-  return requests.Session()
+  import requests
+  import requests.adapters
+  session = requests.Session()
+  n = get_max_concurrency()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=n, pool_maxsize=n)
+  session.mount('https://', adapter)
+  return session
+
+@memoize()
+def get_cached_executor():
+  return futures.ThreadPoolExecutor(max_workers=get_max_concurrency(), thread_name_prefix='tpunicorn')
 
 def get_requests_session(session=None):
   if session is None:
     session = get_cached_requests_session()
   elif session is False:
+    import requests
     session = requests
   return session
 
@@ -429,7 +752,6 @@ def build_endpoint_url(api='tpu', version='v2alpha1', **parts):
 
 from urllib.parse import urlparse
 
-import braceexpand
 
 def bracify(**kws):
   results = []
@@ -446,34 +768,128 @@ def request_urls(path, api='tpu', apiVersion='v2alpha1', **kws):
     replacements = {'location': 'zone'}
     path = '/'.join(['/'.join([part, '{' + replacements.get(part[:-1], part[:-1]) + '}']) for part in parts] + [resource])
   url = 'https://{api}.googleapis.com/{apiVersion}/' + path
+  import braceexpand
   return list(braceexpand.braceexpand(url.format(api=api, apiVersion=apiVersion, **bracify(**kws))))
 
-from concurrent import futures
-
-def request(path, api='tpu', apiVersion=None, headers=None, session=None, project=None, **kws):
+def run_sync(coro):
+  import asyncio
+  # asyncio.run() refuses to nest, so if we're already inside an event
+  # loop (e.g. a sanic handler in serve.py), run the coroutine on a
+  # fresh loop in another thread instead.
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coro)
+  with futures.ThreadPoolExecutor(max_workers=1) as executor:
+    return executor.submit(asyncio.run, coro).result()
+
+async def fetch_json_async(url, headers=None, session=None, semaphore=None, params=None):
+  import asyncio
+  session = get_requests_session(session=session)
+  def fetcher():
+    req = session.get(url, headers=headers, params=params)
+    req.raise_for_status()
+    return req.json()
+  loop = asyncio.get_running_loop()
+  if semaphore is None:
+    return await loop.run_in_executor(get_cached_executor(), fetcher)
+  async with semaphore:
+    return await loop.run_in_executor(get_cached_executor(), fetcher)
+
+async def request_async(path, api='tpu', apiVersion=None, headers=None, session=None, project=None, concurrency=None, **kws):
+  import asyncio
   if apiVersion is None:
     if api == 'tpu':
       apiVersion = 'v2alpha1'
     else:
       apiVersion = 'v1'
-  session = get_requests_session(session=session)
   project = get_default_project(project=project)
   headers = get_headers(headers=headers, project=project)
   urls = request_urls(path, api=api, apiVersion=apiVersion, project=project, **kws)
-  def fetcher(url):
-    req = session.get(url, headers=headers)
-    req.raise_for_status()
-    res = req.json()
-    return res
-    # key = urlparse(url).path.rsplit('/', 1)[-1]
-    # return res.get(key, [])
-  with futures.ThreadPoolExecutor() as executor:
-    result = []
-    for res in executor.map(fetcher, urls):
-      result.append(res)
-    if len(result) <= 1:
-      return result[0]
-    return result
+  semaphore = asyncio.Semaphore(concurrency or get_max_concurrency())
+  result = await asyncio.gather(*[fetch_json_async(url, headers=headers, session=session, semaphore=semaphore) for url in urls])
+  if len(result) <= 1:
+    return result[0]
+  return list(result)
+
+def request(path, api='tpu', apiVersion=None, headers=None, session=None, project=None, concurrency=None, **kws):
+  return run_sync(request_async(path, api=api, apiVersion=apiVersion, headers=headers, session=session, project=project, concurrency=concurrency, **kws))
+
+async def iter_pages_async(url, key, headers=None, session=None, semaphore=None, page_size=None):
+  params = {}
+  if page_size is not None:
+    params['pageSize'] = page_size
+  while True:
+    res = await fetch_json_async(url, headers=headers, session=session, semaphore=semaphore, params=dict(params))
+    yield res.get(key, [])
+    token = res.get('nextPageToken')
+    if not token:
+      return
+    params['pageToken'] = token
+
+import queue
+
+def iter_sync(agen, maxsize=1024):
+  import asyncio
+  # drive an async generator on a background event loop, handing items
+  # back to this thread as soon as they're produced. At most `maxsize`
+  # items wait in between: past that the producer waits for the consumer,
+  # and if the consumer stops early, the producer is cancelled.
+  results = queue.Queue(maxsize=maxsize)
+  stop = threading.Event()
+  running = {}
+  def put(item):
+    while not stop.is_set():
+      try:
+        results.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+  async def pump():
+    loop = asyncio.get_running_loop()
+    running['loop'], running['task'] = loop, asyncio.current_task()
+    try:
+      if stop.is_set():
+        return
+      async for item in agen:
+        try:
+          results.put_nowait((True, item))
+        except queue.Full:
+          await loop.run_in_executor(None, put, (True, item))
+        if stop.is_set():
+          break
+    except asyncio.CancelledError:
+      pass
+    except BaseException as e:
+      put((False, e))
+    finally:
+      await agen.aclose()
+      put((False, None))
+  def run():
+    try:
+      asyncio.run(pump())
+    except asyncio.CancelledError:
+      # the consumer went away while we were finishing up anyway.
+      pass
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  try:
+    while True:
+      ok, item = results.get()
+      if ok:
+        yield item
+      elif item is None:
+        return
+      else:
+        raise item
+  finally:
+    stop.set()
+    if 'task' in running:
+      try:
+        running['loop'].call_soon_threadsafe(running['task'].cancel)
+      except RuntimeError:
+        # the loop has already finished.
+        pass
 
 def api_list_locations_url(project=None):
   project = get_default_project(project=project)
@@ -496,55 +912,384 @@ def api_list_nodes(zone, project=None, session=None):
   session = get_requests_session(session=session)
   project = get_default_project(project=project)
   headers = get_headers(headers=None, project=project)
-  response = session.get(url, headers=headers).json()
-  return response.get('nodes', [])
+  params = {}
+  nodes = []
+  while True:
+    response = session.get(url, headers=headers, params=params).json()
+    nodes.extend(response.get('nodes', []))
+    if not response.get('nextPageToken'):
+      return nodes
+    params['pageToken'] = response['nextPageToken']
 
 def api_zones(project=None, session=None):
   return [x['locationId'] for x in api_list_locations(project=project, session=session)]
 
-import concurrent.futures
-import operator
-import functools
-
-def list_tpus(zone=None, project=None, session=None):
+def split_zones(zone):
+  if isinstance(zone, str):
+    zone = zone.split(',')
+  zone = list(zone)
+  if len(zone) == 1:
+    # braceexpand only expands braces containing a comma.
+    return zone[0]
+  return zone
+
+async def iter_tpus_async(zone=None, project=None, session=None, page_size=None, concurrency=None):
+  import asyncio
   if zone is None:
-    zone = api_zones(project=project, session=session)
-    tpus = functools.reduce(operator.concat,
-        [x.get('nodes', []) for x in 
-          request('projects.locations.nodes', zone=zone, project=project, session=session)])
-  else:
-    tpus = request('projects.locations.nodes', zone=zone, project=project, session=session).get('nodes', [])
-  # with concurrent.futures.ThreadPoolExecutor() as executor:
-  #   zones = [x['locationId'] for x in api_list_locations()]
-  #   tpus = functools.reduce(operator.concat, executor.map(api_list_nodes, zones))
+    # use the cached zone list rather than a fresh api_zones() round trip,
+    # so that every zone is fetched at once.
+    zone = get_tpu_zones(project=project)
+  project = get_default_project(project=project)
+  headers = get_headers(project=project)
+  urls = request_urls('projects.locations.nodes', project=project, zone=split_zones(zone))
+  semaphore = asyncio.Semaphore(concurrency or get_max_concurrency())
+  # at most a page per zone waits here; past that, fetching waits too.
+  pages = asyncio.Queue(maxsize=len(urls))
+  async def follow(url):
+    try:
+      async for nodes in iter_pages_async(url, 'nodes', headers=headers, session=session, semaphore=semaphore, page_size=page_size):
+        await pages.put(nodes)
+    except Exception as e:
+      await pages.put(e)
+    else:
+      await pages.put(None)
+  tasks = [asyncio.ensure_future(follow(url)) for url in urls]
+  remaining = len(tasks)
+  try:
+    while remaining > 0:
+      nodes = await pages.get()
+      if nodes is None:
+        remaining -= 1
+      elif isinstance(nodes, Exception):
+        raise nodes
+      else:
+        for node in nodes:
+          yield node
+  finally:
+    for task in tasks:
+      task.cancel()
+
+def iter_tpus(zone=None, project=None, session=None, page_size=None, concurrency=None):
+  """Yields TPU nodes from every page of every zone, in arrival order."""
+  return iter_sync(iter_tpus_async(zone=zone, project=project, session=session, page_size=page_size, concurrency=concurrency))
+
+async def list_tpus_async(zone=None, project=None, session=None, page_size=None, concurrency=None):
+  tpus = [tpu async for tpu in iter_tpus_async(zone=zone, project=project, session=session, page_size=page_size, concurrency=concurrency)]
   return list(sorted(tpus, key=parse_tpu_index))
 
-def get_tpus(zone=None, project=None):
-  tpus = fetch_tpus(zone=zone, project=project)
-  # if zone is None:
-  #   return tpus
-  # else:
-  #   return [tpu for tpu in tpus if '/{}/'.format(zone) in tpu['name']]
-  return tpus
+def list_tpus(zone=None, project=None, session=None, page_size=None, concurrency=None):
+  return run_sync(list_tpus_async(zone=zone, project=project, session=session, page_size=page_size, concurrency=concurrency))
+
+import bisect
+
+class Fleet:
+  """A snapshot of TPU nodes, indexed once so that lookups don't rescan it."""
+
+  def __init__(self, tpus):
+    self.tpus = [TpuRecord.wrap(tpu) for tpu in tpus]
+    self.by_id = defaultdict(list)
+    self.by_index = defaultdict(list)
+    self.by_zone = defaultdict(list)
+    self.by_state = defaultdict(list)
+    self.by_type = defaultdict(list)
+    for tpu in self.tpus:
+      self.by_id[tpu.id].append(tpu)
+      self.by_index[tpu.index].append(tpu)
+      self.by_zone[tpu.zone].append(tpu)
+      self.by_state[tpu.state].append(tpu)
+      self.by_type[tpu.type].append(tpu)
+    # sorted used indices, and for each one, the first free index at or
+    # after it, so that next_available_index is a single bisect.
+    self.indices = sorted(i for i in self.by_index if i >= 0)
+    self.next_free = [0] * len(self.indices)
+    for i in reversed(range(len(self.indices))):
+      if i + 1 < len(self.indices) and self.indices[i + 1] == self.indices[i] + 1:
+        self.next_free[i] = self.next_free[i + 1]
+      else:
+        self.next_free[i] = self.indices[i] + 1
+
+  def __iter__(self):
+    return iter(self.tpus)
+
+  def __len__(self):
+    return len(self.tpus)
+
+  def ids(self):
+    return list(self.by_id.keys())
+
+  def lookup(self, tpu):
+    if isinstance(tpu, (dict, TpuRecord)):
+      tpu = parse_tpu_id(tpu)
+    if isinstance(tpu, str) and re.match('^[0-9]+$', tpu):
+      tpu = int(tpu)
+    if isinstance(tpu, int):
+      return 'index', tpu, self.by_index.get(tpu, [])
+    else:
+      return 'id', tpu, self.by_id.get(tpu, [])
+
+  def get(self, tpu, silent=False):
+    which, tpu, tpus = self.lookup(tpu)
+    if len(tpus) > 1:
+      raise ValueError("Multiple TPUs matched {} {!r}. Try specifying --zone".format(which, tpu))
+    if len(tpus) <= 0:
+      if silent:
+        return None
+      raise ValueError("No TPUs matched {} {!r}".format(which, tpu))
+    return tpus[0]
+
+  def match(self, patterns):
+    # TPUs matching any of `patterns`: ids, indices, index ranges like
+    # '0..31', or globs over ids.
+    results = []
+    seen = set()
+    for pattern in patterns:
+      m = re.match(r'^([0-9]+)[.][.]([0-9]+)$', pattern) if isinstance(pattern, str) else None
+      if m:
+        lo = bisect.bisect_left(self.indices, int(m.group(1)))
+        hi = bisect.bisect_right(self.indices, int(m.group(2)))
+        tpus = [tpu for i in self.indices[lo:hi] for tpu in self.by_index[i]]
+      elif isinstance(pattern, str) and any(c in pattern for c in '*?['):
+        tpus = [tpu for tpu in self.tpus if fnmatch.fnmatchcase(tpu.id, pattern)]
+      else:
+        which, tpu, tpus = self.lookup(pattern)
+      for tpu in tpus:
+        if id(tpu) not in seen:
+          seen.add(id(tpu))
+          results.append(tpu)
+    return results
+
+  def select(self, zone=None, state=None, accelerator_type=None):
+    candidates = [self.tpus]
+    if zone is not None:
+      candidates.append([tpu for z in zone.split(',') for tpu in self.by_zone.get(z, [])])
+    if state is not None:
+      candidates.append(self.by_state.get(state, []))
+    if accelerator_type is not None:
+      candidates.append(self.by_type.get(accelerator_type, []))
+    smallest = min(candidates, key=len)
+    keep = [set(id(tpu) for tpu in x) for x in candidates if x is not smallest]
+    return [tpu for tpu in smallest if all(id(tpu) in ids for ids in keep)]
+
+  def next_available_index(self, index):
+    i = bisect.bisect_left(self.indices, index)
+    if i < len(self.indices) and self.indices[i] == index:
+      return self.next_free[i]
+    return index
+
+import fnmatch
+
+filter_fields = {
+  'id': lambda tpu: tpu.id,
+  'state': lambda tpu: tpu.state,
+  'status': lambda tpu: tpu.state,
+  'health': lambda tpu: tpu.health,
+  'type': lambda tpu: tpu.type,
+  'zone': lambda tpu: tpu.zone,
+  'version': lambda tpu: tpu.version,
+  'network': lambda tpu: tpu.network,
+  'project': lambda tpu: tpu.project,
+  'preemptible': lambda tpu: tpu.preemptible,
+  'index': lambda tpu: tpu.index,
+  'age': lambda tpu: since(tpu.created_at) if tpu.created_at is not None else None,
+}
 
-def get_tpu(tpu, zone=None, project=None, silent=False):
-  if isinstance(tpu, dict):
-    tpu = parse_tpu_id(tpu)
-  if isinstance(tpu, str) and re.match('^[0-9]+$', tpu):
-    tpu = int(tpu)
-  if isinstance(tpu, int):
-    which = 'index'
-    tpus = [x for x in get_tpus(zone=zone, project=project) if parse_tpu_index(x) == tpu]
+filter_units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(value):
+  # e.g. '90', '30m', '1d12h'
+  parts = re.findall(r'([0-9]+(?:[.][0-9]*)?)([smhd]?)', value)
+  if not parts or ''.join(n + u for n, u in parts) != value:
+    raise ValueError("Could not parse duration {!r}; try e.g. 30m, 2h or 1d12h".format(value))
+  return sum(float(n) * filter_units[u] for n, u in parts)
+
+class TpuFilter:
+  """A --filter expression: whitespace-separated terms, all of which must
+  match. Each term is FIELD OP VALUE, e.g.
+
+    state=PREEMPTED type=v3-* zone=euw4a age>2h index=0..31 id!=*-test
+
+  = and != take comma-separated globs (or a..b ranges for index); age
+  and index also take >, >=, < and <=. Zone terms are answered by
+  fetching only the matching zones.
+  """
+
+  def __init__(self, expr):
+    self.expr = expr
+    self.terms = []
+    # exact `field=a,b` values, answered from the Fleet's hash indexes.
+    self.literals = []
+    for term in expr.split():
+      m = re.match(r'^([a-z]+)(!=|>=|<=|=|>|<)(.*)$', term)
+      if m is None:
+        raise ValueError("Could not parse filter term {!r}; expected e.g. state=PREEMPTED".format(term))
+      field, op, value = m.groups()
+      if field not in filter_fields:
+        raise ValueError("Unknown filter field {!r}; expected one of {}".format(field, ', '.join(filter_fields)))
+      self.terms.append((field, op, self.compile_term(field, op, value)))
+
+  @classmethod
+  def wrap(cls, expr):
+    return expr if isinstance(expr, cls) else cls(expr)
+
+  def compile_term(self, field, op, value):
+    if field in ['age', 'index']:
+      number = parse_duration if field == 'age' else int
+      if op in ['=', '!=']:
+        tests = []
+        for x in value.split(','):
+          if '..' in x:
+            lo, hi = x.split('..', 1)
+            lo = number(lo) if lo else float('-inf')
+            hi = number(hi) if hi else float('inf')
+            tests.append(lambda v, lo=lo, hi=hi: lo <= v <= hi)
+          else:
+            tests.append(lambda v, x=number(x): v == x)
+        test = lambda v: any(t(v) for t in tests)
+      else:
+        x = number(value)
+        test = {
+          '>': lambda v: v > x,
+          '>=': lambda v: v >= x,
+          '<': lambda v: v < x,
+          '<=': lambda v: v <= x,
+        }[op]
+      if op == '!=':
+        test = lambda v, test=test: not test(v)
+      # a TPU with no createTime has no age, and matches neither way.
+      return lambda v: v is not None and test(v)
+    elif op not in ['=', '!=']:
+      raise ValueError("Filter field {!r} only supports = and !=".format(field))
+    elif field == 'preemptible':
+      x = value.lower() in ['yes', 'true', '1', 'y']
+      test = lambda v: bool(v) == x
+    else:
+      if field == 'zone':
+        value = expand_zone_abbreviations(value)
+      if field in ['state', 'status', 'health']:
+        value = value.upper()
+      patterns = value.split(',')
+      if op == '=' and not any(c in value for c in '*?['):
+        self.literals.append((field, patterns))
+      test = lambda v: v is not None and any(fnmatch.fnmatchcase(v, p) for p in patterns)
+    if op == '!=':
+      return lambda v: not test(v)
+    return test
+
+  def matches(self, tpu):
+    tpu = TpuRecord.wrap(tpu)
+    return all(test(filter_fields[field](tpu)) for field, op, test in self.terms)
+
+  def apply(self, tpus):
+    if isinstance(tpus, Fleet):
+      tpus = self.candidates(tpus)
+    return [tpu for tpu in tpus if self.matches(tpu)]
+
+  def candidates(self, fleet):
+    indexes = {
+      'id': fleet.by_id,
+      'state': fleet.by_state,
+      'status': fleet.by_state,
+      'type': fleet.by_type,
+      'zone': fleet.by_zone,
+    }
+    best = fleet.tpus
+    for field, values in self.literals:
+      if field in indexes:
+        tpus = [tpu for value in values for tpu in indexes[field].get(value, [])]
+        if len(tpus) < len(best):
+          best = tpus
+    return best
+
+  def push_down(self, zone=None, project=None):
+    """Returns the zones that could possibly match, or None for all of them."""
+    tests = [test for field, op, test in self.terms if field == 'zone']
+    if not tests:
+      return zone
+    if zone is None:
+      zones = get_tpu_zones(project=project)
+    else:
+      zones = zone.split(',') if isinstance(zone, str) else list(zone)
+    return [z for z in zones if all(test(z) for test in tests)]
+
+import contextvars
+
+fleet_context = contextvars.ContextVar('fleet_context', default=None)
+
+class FleetContext:
+  """The fleet as seen by one unit of work, e.g. one `pu` invocation.
+
+  While active, get_fleet (and so get_tpu, is_tpu_vm, ...) answers from
+  what it has already fetched, per (project, zone), instead of fetching
+  again, and format_widths lines up with just what's been fetched. Once
+  the full fleet of a project is loaded, per-zone lookups are selected
+  from it; otherwise only the zones asked for are fetched. Pass fresh=True to get_fleet, or call clear(), wherever current
+  state is needed, e.g. in wait loops."""
+
+  def __init__(self):
+    self.fleets = {}
+
+  def fleet(self, zone=None, project=None, cached=False, fresh=False):
+    project = get_default_project(project=project)
+    if fresh:
+      self.clear()
+    full = self.fleets.get((project, None))
+    if full is not None:
+      return full if zone is None else Fleet(full.select(zone=zone))
+    fleet = self.fleets.get((project, zone))
+    if fleet is None:
+      fleet = self.fleets[project, zone] = load_fleet(zone=zone, project=project, cached=cached, fresh=fresh)
+    return fleet
+
+  def loaded(self, project=None):
+    """The TPUs of `project` fetched so far, without fetching any."""
+    project = get_default_project(project=project)
+    full = self.fleets.get((project, None))
+    if full is not None:
+      return full.tpus
+    return [tpu for (p, zone), fleet in self.fleets.items() if p == project for tpu in fleet.tpus]
+
+  def clear(self):
+    self.fleets.clear()
+
+  def activate(self):
+    return fleet_context.set(self)
+
+  def deactivate(self, token):
+    fleet_context.reset(token)
+
+def load_fleet(zone=None, project=None, cached=False, fresh=False):
+  if cached:
+    # serve from the on-disk fleet snapshot shared between processes.
+    from . import snapshot
+    project = get_default_project(project=project)
+    return Fleet(snapshot.get_snapshot_nodes(project, zone=zone, fresh=fresh))
+  elif fresh:
+    return Fleet(fetch_tpus(zone=zone, project=project))
   else:
-    which = 'id'
-    tpus = [x for x in get_tpus(zone=zone, project=project) if parse_tpu_id(x) == tpu]
-  if len(tpus) > 1:
-    raise ValueError("Multiple TPUs matched {} {!r}. Try specifying --zone".format(which, tpu))
-  if len(tpus) <= 0:
-    if silent:
-      return None
-    raise ValueError("No TPUs matched {} {!r}".format(which, tpu))
-  return tpus[0]
+    return fetch_fleet(zone=zone, project=project)
+
+def get_fleet(zone=None, project=None, cached=False, filter=None, fresh=False):
+  if filter is not None:
+    filter = TpuFilter.wrap(filter)
+    zone = filter.push_down(zone=zone, project=project)
+    if zone is not None and len(zone) <= 0:
+      return Fleet([])
+    if zone is not None and not isinstance(zone, str):
+      zone = ','.join(zone)
+  context = fleet_context.get()
+  if context is not None:
+    fleet = context.fleet(zone=zone, project=project, cached=cached, fresh=fresh)
+  else:
+    fleet = load_fleet(zone=zone, project=project, cached=cached, fresh=fresh)
+  if filter is not None:
+    fleet = Fleet(filter.apply(fleet))
+  return fleet
+
+def get_tpus(zone=None, project=None, cached=False, filter=None, fresh=False):
+  return get_fleet(zone=zone, project=project, cached=cached, filter=filter, fresh=fresh).tpus
+
+def get_tpu(tpu, zone=None, project=None, silent=False, cached=False, fresh=False):
+  return get_fleet(zone=zone, project=project, cached=cached, fresh=fresh).get(tpu, silent=silent)
 
 from string import Formatter
 
@@ -565,49 +1310,78 @@ class NamespaceFormatter(Formatter):
 
 from collections import defaultdict
 
-@ring.lru(expire=1) # seconds
 def format_widths(project=None):
+  # line up with the TPUs this unit of work has already fetched (see
+  # FleetContext), so that printing one TPU doesn't fetch all of them.
+  context = fleet_context.get()
+  tpus = context.loaded(project=project) if context is not None else None
+  if tpus:
+    return compute_format_widths(tpus)
+  return fetch_format_widths(project=project)
+
+@memoize(expire=1) # seconds
+def fetch_format_widths(project=None):
+  return compute_format_widths(get_tpus(project=project))
+
+def compute_format_widths(tpus):
+  return compute_column_widths(format_rows(tpus))
+
+def compute_column_widths(rows):
   headers = format_headers()
-  tpus = get_tpus(project=project)
   r = defaultdict(int)
-  for tpu in tpus:
-    args = _format_args(tpu)
+  for args in rows:
     for k, v in args.items():
       s = '{}'.format(v)
       r[k+'_w'] = max(r[k+'_w'], len(s) + 1, len(headers[k]) + 1)
   return r
 
-def _normalize_tpu_isodate(iso):
-  r = re.findall('(.*[.][0-9]{6})[0-9]*Z', iso)
-  if len(r) > 0:
-    return r[0] + 'Z'
-  raise ValueError("Could not parse TPU date {!r}".format(iso))
-
-import moment
-import datetime
-import time
+def format_rows(tpus, fields=None, now=None):
+  if fields is None:
+    fields = list(format_fields.keys())
+  ages = None
+  if 'age' in fields:
+    # computed for the whole batch, against one `now`.
+    ages = nice_ages(tpus, now=now)
+  rows = []
+  for i, tpu in enumerate(tpus):
+    tpu = TpuRecord.wrap(tpu)
+    args = {}
+    for k in fields:
+      v = ages[i] if k == 'age' else format_fields[k](tpu)
+      args[k] = v if v is not None else ''
+    rows.append(args)
+  return rows
+
+import calendar
+
+def parse_tpu_isodate(iso):
+  # e.g. '2020-06-10T01:02:03.123456789Z' => seconds since the epoch.
+  # Sub-second precision is dropped; nothing we display needs it.
+  r = re.match(r'([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})', iso)
+  if r is None:
+    raise ValueError("Could not parse TPU date {!r}".format(iso))
+  return calendar.timegm(tuple(int(x) for x in r.groups()))
 
 def get_timestamp(timestamp=None, utc=True):
   if timestamp is None:
     timestamp = time.time()
-  # https://stackoverflow.com/a/52606421/9919772
-  #dt = datetime.datetime.fromtimestamp(timestamp).astimezone()
-  dt = moment.unix(timestamp, utc=utc)
-  dt = dt.timezone(current_tzname())
+  # the local zone name and offset in effect at `timestamp`, DST or not.
+  dt = datetime.datetime.fromtimestamp(timestamp).astimezone()
   return dt.strftime("%m-%d-%Y %I:%M:%S%p %Z")
 
 def current_timezone():
-  if time.daylight:
-    return datetime.timezone(datetime.timedelta(seconds=-time.altzone),time.tzname[1])
-  else:
-    return datetime.timezone(datetime.timedelta(seconds=-time.timezone),time.tzname[0])
+  return datetime.datetime.now().astimezone().tzinfo
 
 def current_tzname():
   return current_timezone().tzname(None)
 
-def since(iso):
-  dt = moment.utcnow() - moment.utc(_normalize_tpu_isodate(iso), "%Y-%m-%dT%H:%M:%S.%fZ")
-  return dt.total_seconds()
+def since(iso, now=None):
+  # `iso` is either a TPU createTime string or seconds since the epoch.
+  if now is None:
+    now = time.time()
+  if isinstance(iso, str):
+    iso = parse_tpu_isodate(iso)
+  return now - iso
 
 def minutes_since(iso):
   return since(iso) / 60
@@ -618,12 +1392,17 @@ def hours_since(iso):
 def days_since(iso):
   return since(iso) / 86400
 
-def nice_since(iso):
-  t = int(since(iso))
+def nice_since(iso, now=None):
+  return nice_duration(int(since(iso, now=now)))
+
+def nice_duration(t):
   s = t % 60
   m = (t // 60) % 60
   h = (t // 3600) % 24
   d = (t // 86400)
+  return nice_dhm(d, h, m)
+
+def nice_dhm(d, h, m):
   r = []
   out = False
   if d > 0 or out:
@@ -646,6 +1425,30 @@ def nice_since(iso):
   #   r += ['{:02d}s'.format(s)]
   return ''.join(r)
 
+def get_numpy_threshold():
+  # fleets at least this big compute their age column with numpy, if it's
+  # installed.
+  return int(os.environ.get('TPUNICORN_NUMPY_THRESHOLD', '10000'))
+
+def nice_ages(tpus, now=None):
+  """The AGE column for every TPU, measured against a single `now`."""
+  if now is None:
+    now = time.time()
+  now = int(now)
+  created = [TpuRecord.wrap(tpu).created_at for tpu in tpus]
+  if len(created) >= get_numpy_threshold() and None not in created:
+    try:
+      import numpy as np
+    except ImportError:
+      pass
+    else:
+      t = now - np.array(created, dtype=np.int64)
+      d, t = np.divmod(t, 86400)
+      h, t = np.divmod(t, 3600)
+      m = t // 60
+      return [nice_dhm(*x) for x in zip(d.tolist(), h.tolist(), m.tolist())]
+  return [nice_duration(now - c) if c is not None else None for c in created]
+
 def format_headers():
   return {
     'kind': 'header',
@@ -669,34 +1472,43 @@ def format_headers():
     'subnetwork': 'SUBNETWORK',
   }
 
-def _format_args(tpu):
-  return {
-    'kind': 'tpu',
-    'project': parse_tpu_project(tpu),
-    'zone': parse_tpu_zone(tpu),
-    'id': parse_tpu_id(tpu),
-    'fqn': tpu['name'],
-    'ip': parse_tpu_ip(tpu),
-    'port': parse_tpu_port(tpu),
-    'master': parse_tpu_master(tpu),
-    'range': parse_tpu_range(tpu),
-    'type': parse_tpu_type(tpu),
-    'created': tpu['createTime'],
-    'age': nice_since(tpu['createTime']),
-    'preemptible': 'yes' if parse_tpu_preemptible(tpu) else 'no',
-    'status': tpu['state'],
-    'health': tpu.get('health', 'UNKNOWN'),
-    'index': parse_tpu_index(tpu),
-    'version': parse_tpu_version(tpu),
-    'network': parse_tpu_network(tpu),
-    'subnetwork': parse_tpu_subnetwork(tpu),
-  }
+format_fields = {
+  'kind': lambda tpu: 'tpu',
+  'project': lambda tpu: tpu.project,
+  'zone': lambda tpu: tpu.zone,
+  'id': lambda tpu: tpu.id,
+  'fqn': lambda tpu: tpu.fqn,
+  'ip': lambda tpu: tpu.ip,
+  'port': lambda tpu: tpu.port,
+  'master': lambda tpu: tpu.master,
+  'range': lambda tpu: tpu.range,
+  'type': lambda tpu: tpu.type,
+  'created': lambda tpu: tpu.created,
+  'age': lambda tpu: nice_since(tpu.created_at) if tpu.created_at is not None else None,
+  'preemptible': lambda tpu: 'yes' if tpu.preemptible else 'no',
+  'status': lambda tpu: tpu.state,
+  'health': lambda tpu: tpu.health,
+  'index': lambda tpu: tpu.index,
+  'version': lambda tpu: tpu.version,
+  'network': lambda tpu: tpu.network,
+  'subnetwork': lambda tpu: tpu.subnetwork,
+}
+
+def _format_args(tpu, fields=None):
+  tpu = TpuRecord.wrap(tpu)
+  if fields is None:
+    fields = format_fields.keys()
+  return {k: format_fields[k](tpu) for k in fields}
 
 def parse_tpu_preemptible(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.preemptible
   return tpu.get('schedulingConfig', {'preemptible': False}).get('preemptible', False)
 
 def parse_tpu_ip(tpu, internal_only=False):
-  master = tpu['networkEndpoints'][0]
+  if isinstance(tpu, TpuRecord):
+    return tpu.internal_ip if internal_only else tpu.ip
+  master = (tpu.get('networkEndpoints') or [{}])[0]
   external_ip = master.get('accessConfig', {}).get('externalIp', None)
   internal_ip = master.get('ipAddress', None)
   if internal_only:
@@ -704,7 +1516,9 @@ def parse_tpu_ip(tpu, internal_only=False):
   return external_ip
 
 def parse_tpu_port(tpu):
-  master = tpu['networkEndpoints'][0]
+  if isinstance(tpu, TpuRecord):
+    return tpu.port
+  master = (tpu.get('networkEndpoints') or [{}])[0]
   return master.get('port', None)
 
 def parse_tpu_master(tpu, internal_only=True):
@@ -713,20 +1527,42 @@ def parse_tpu_master(tpu, internal_only=True):
     parse_tpu_port(tpu))
 
 def parse_tpu_range(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.range
   return tpu.get('cidrBlock', None)
 
 def parse_tpu_version(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.version
   return tpu['runtimeVersion']
 
 def parse_tpu_type(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.type
   return tpu['acceleratorType']
 
 def parse_tpu_description(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.description
   return tpu.get('description', None)
 
 def parse_tpu_data_disks(tpu):
+  if isinstance(tpu, TpuRecord):
+    return list(tpu.data_disks)
   return tpu.get('dataDisks', [])
 
+def parse_tpu_node_id(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.node_id
+  return tpu.get('id')
+
+def parse_tpu_endpoints(tpu):
+  # (internal IP, external IP or None) for each worker.
+  if isinstance(tpu, TpuRecord):
+    return tpu.endpoints
+  return tuple((endpoint.get('ipAddress'), endpoint.get('accessConfig', {}).get('externalIp', None))
+               for endpoint in tpu.get('networkEndpoints') or [])
+
 def parse_tpu_data_disk(tpu, disk_index=0):
   disks = parse_tpu_data_disks(tpu)
   if disk_index >= 0 and disk_index < len(disks):
@@ -736,52 +1572,238 @@ def parse_tpu_data_disk(tpu, disk_index=0):
       mode=disk['mode'].lower().replace('_', '-')
     )
 
+class TpuRecord:
+  """A TPU node, parsed once at ingestion.
+
+  The raw node is kept as compact JSON and only decoded when asked for
+  via `raw` (or dict-style access), which keeps big fleets small. The
+  decoded node is kept from then on, so only records that are actually
+  looked into pay for it; the parse_tpu_* helpers use the fields.
+  """
+
+  __slots__ = ('fqn', 'project', 'zone', 'id', 'index', 'type', 'state', 'health',
+               'version', 'created', 'created_at', 'preemptible', 'ip', 'internal_ip', 'port',
+               'range', 'network', 'subnetwork', 'description', 'node_id', 'endpoints',
+               'data_disks', 'json', 'node')
+
+  def __init__(self, tpu):
+    self.fqn = tpu['name']
+    self.project = parse_tpu_project(tpu)
+    self.zone = parse_tpu_zone(tpu)
+    self.id = parse_tpu_id(tpu)
+    self.index = parse_tpu_index(tpu)
+    self.type = parse_tpu_type(tpu)
+    self.state = tpu.get('state')
+    self.health = tpu.get('health', 'UNKNOWN')
+    self.version = parse_tpu_version(tpu)
+    self.created = tpu.get('createTime')
+    self.created_at = parse_tpu_isodate(self.created) if self.created else None
+    self.preemptible = bool(parse_tpu_preemptible(tpu))
+    self.ip = parse_tpu_ip(tpu)
+    self.internal_ip = parse_tpu_ip(tpu, internal_only=True)
+    self.port = parse_tpu_port(tpu)
+    self.range = parse_tpu_range(tpu)
+    self.network = parse_tpu_network(tpu)
+    self.subnetwork = parse_tpu_subnetwork(tpu)
+    self.description = parse_tpu_description(tpu)
+    self.node_id = parse_tpu_node_id(tpu)
+    self.endpoints = parse_tpu_endpoints(tpu)
+    self.data_disks = tuple(parse_tpu_data_disks(tpu))
+    self.json = json.dumps(tpu, separators=(',', ':'))
+    self.node = None
+
+  @classmethod
+  def wrap(cls, tpu):
+    return tpu if isinstance(tpu, cls) else cls(tpu)
+
+  @property
+  def master(self):
+    return '{}:{}'.format(self.internal_ip, self.port)
+
+  @property
+  def raw(self):
+    if self.node is None:
+      self.node = json.loads(self.json)
+    return self.node
+
+  def __getitem__(self, key):
+    if key == 'name':
+      return self.fqn
+    return self.raw[key]
+
+  def get(self, key, default=None):
+    if key == 'name':
+      return self.fqn
+    return self.raw.get(key, default)
+
+  def __contains__(self, key):
+    return key in self.raw
+
+  def __repr__(self):
+    return '<TpuRecord {}>'.format(self.fqn)
+
+def as_json(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.json
+  return json.dumps(tpu)
+
+def as_dict(tpu):
+  if isinstance(tpu, TpuRecord):
+    return tpu.raw
+  return tpu
+
+def is_tpu_vm_version(version):
+  return version is not None and version.startswith('v2')
+
 def is_tpu_vm(tpu, project=None):
-  tpu = get_tpu(tpu, silent=True, project=project)
-  return tpu is not None and parse_tpu_version(tpu).startswith('v2')
+  if isinstance(tpu, str):
+    tpu = get_tpu(tpu, silent=True, project=project)
+  return tpu is not None and is_tpu_vm_version(parse_tpu_version(tpu))
 
-def format_args(tpu, project=None):
+def resolve_tpu_vm(tpu, version=None):
+  # TPU VM or legacy node, from what's in hand; None if that's not enough.
+  if not isinstance(tpu, str):
+    return is_tpu_vm(tpu) or is_tpu_vm_version(version)
+  if is_tpu_vm_version(version):
+    return True
+
+def format_args(tpu, project=None, widths=None):
   r = _format_args(tpu)
-  r.update(format_widths(project=project))
+  r.update(format_widths(project=project) if widths is None else widths)
   return r
 
-def get_default_format_specs(thin=False):
-  specs = [
-    "{zone:{zone_w}}",
-    "{index:<{index_w}}",
-    "{type:{type_w}}",
-    "{age:{age_w}}",
-    "{id:{id_w}}",
-    "{status:{status_w}}",
-    "{health:{health_w}}",
-    "{version:{version_w}}",
-    "{network:{network_w}}",
-    "{master:{master_w}}",
-    "{range:{range_w}}",
-    "{preemptible!s:{preemptible_w}}",
-  ]
+default_format_columns = [
+  'zone',
+  'index',
+  'type',
+  'age',
+  'id',
+  'status',
+  'health',
+  'version',
+  'network',
+  'master',
+  'range',
+  'preemptible',
+]
+
+def get_format_column_spec(column, thin=False):
+  if column not in format_fields:
+    raise ValueError("Unknown column {!r}; expected one of {}".format(column, ', '.join(format_fields)))
+  align = '<' if column == 'index' else ''
+  conversion = '!s' if column == 'preemptible' else ''
   if thin:
-    return ['{' + re.findall('{([^:]+)[:]', x)[0] + '}' for x in specs]
-  else:
-    return specs
-
-def get_default_format_spec(thin=False):
-  return ' '.join(get_default_format_specs(thin=thin))
-
-def format(tpu, spec=None, formatter=NamespaceFormatter, project=None):
-  if tpu.get('kind', 'tpu') == 'tpu':
-    args = format_args(tpu, project=project)
+    return '{' + column + conversion + '}'
+  return '{' + column + conversion + ':' + align + '{' + column + '_w}}'
+
+def get_default_format_specs(thin=False, columns=None):
+  if columns is None:
+    columns = default_format_columns
+  return [get_format_column_spec(column, thin=thin) for column in columns]
+
+def get_default_format_spec(thin=False, columns=None):
+  return ' '.join(get_default_format_specs(thin=thin, columns=columns))
+
+def format(tpu, spec=None, formatter=NamespaceFormatter, project=None, widths=None):
+  if widths is None:
+    widths = format_widths(project=project)
+  if isinstance(tpu, TpuRecord) or tpu.get('kind', 'tpu') == 'tpu':
+    args = format_args(tpu, project=project, widths=widths)
   else:
     args = {}
     args.update(tpu)
-    args.update(format_widths(project=project))
+    args.update(widths)
   args = {k: v if v is not None else '' for k, v in args.items()}
   fmt = formatter(args)
   if spec is None:
-    spec = get_default_format_spec(thin=len(format_widths(project=project)) == 0)
+    spec = get_default_format_spec(thin=len(widths) == 0)
   return fmt.format(spec)
 
-def create_tpu_command(tpu=None, zone=None, version=None, accelerator_type=None, project=None, description=None, network=None, subnetwork=None, range=None, preemptible=None, async_=False, data_disk=None):
+class FormatSpec:
+  """A format spec parsed once, along with the fields it references."""
+
+  def __init__(self, spec):
+    self.spec = spec
+    self.parts = list(Formatter().parse(spec))
+    self.fields = []
+    for literal, field, format_spec, conversion in self.parts:
+      if field is not None:
+        self.add_field(field)
+      for _, nested, _, _ in Formatter().parse(format_spec or ''):
+        if nested is not None:
+          # a width field such as {zone_w} needs the zone column itself.
+          self.add_field(nested[:-2] if nested.endswith('_w') else nested)
+
+  def add_field(self, field):
+    name = re.split(r'[.\[]', field)[0]
+    if name not in format_fields:
+      raise ValueError("Unknown format field {!r}; expected one of {}".format(name, ', '.join(format_fields)))
+    if name not in self.fields:
+      self.fields.append(name)
+
+  def compile(self, widths):
+    # Resolve the nested width fields (e.g. "{zone:{zone_w}}" becomes
+    # "{zone:15}") up front, so that each row is a single str.format call.
+    parts = []
+    for literal, field, format_spec, conversion in self.parts:
+      parts.append(literal.replace('{', '{{').replace('}', '}}'))
+      if field is None:
+        continue
+      parts.append('{' + field)
+      if conversion:
+        parts.append('!' + conversion)
+      if format_spec:
+        parts.append(':' + format_spec.format_map(widths))
+      parts.append('}')
+    return ''.join(parts).format_map
+
+def compile_format_spec(spec, widths):
+  return FormatSpec(spec).compile(widths)
+
+def render_table(tpus, spec=None, thin=False, widths=None, header=True, columns=None):
+  """Yields (tpu, args, line) for each TPU, preceded by the header row
+  (with tpu=None) unless header=False.
+
+  Only the fields referenced by the spec are computed, once per row; the
+  column widths come from those same rows unless `widths` is given.
+  """
+  if spec is None:
+    spec = get_default_format_spec(thin=thin or len(tpus) == 0, columns=columns)
+  if not isinstance(spec, FormatSpec):
+    spec = FormatSpec(spec)
+  rows = format_rows(tpus, fields=spec.fields)
+  if widths is None:
+    widths = compute_column_widths(rows)
+  render = spec.compile(widths)
+  if header:
+    headers = format_headers()
+    yield None, headers, render(headers)
+  for tpu, args in zip(tpus, rows):
+    yield tpu, args, render(args)
+
+import csv
+import io
+
+def render_delimited(tpus, columns=None, delimiter=',', header=True):
+  """Yields one CSV (or TSV, etc) line per TPU, computing only `columns`."""
+  if columns is None:
+    columns = default_format_columns
+  for column in columns:
+    get_format_column_spec(column)
+  out = io.StringIO()
+  writer = csv.writer(out, delimiter=delimiter, lineterminator='')
+  def render(values):
+    out.seek(0)
+    out.truncate()
+    writer.writerow(values)
+    return out.getvalue()
+  if header:
+    headers = format_headers()
+    yield render([headers[column] for column in columns])
+  for args in format_rows(tpus, fields=columns):
+    yield render([args[column] for column in columns])
+
+def get_create_tpu_args(tpu=None, zone=None, version=None, accelerator_type=None, project=None, description=None, network=None, subnetwork=None, range=None, preemptible=None, data_disk=None):
   name = parse_tpu_id(tpu)
   if not isinstance(tpu, str):
     if zone is None:
@@ -819,19 +1841,35 @@ def create_tpu_command(tpu=None, zone=None, version=None, accelerator_type=None,
       else:
         disk_mode = 'read-write'
       data_disk += ',mode=' + disk_mode.lower().replace('_', '-')
+  return dict(name=name,
+              zone=zone,
+              project=project,
+              network=network,
+              subnetwork=subnetwork,
+              range=range,
+              version=version,
+              accelerator_type=accelerator_type,
+              preemptible=preemptible,
+              description=description,
+              data_disk=data_disk)
+
+def create_tpu_command(tpu=None, zone=None, version=None, accelerator_type=None, project=None, description=None, network=None, subnetwork=None, range=None, preemptible=None, async_=False, data_disk=None):
+  kws = get_create_tpu_args(tpu, zone=zone, version=version, accelerator_type=accelerator_type, project=project, description=description, network=network, subnetwork=subnetwork, range=range, preemptible=preemptible, data_disk=data_disk)
+  name = kws.pop('name')
   return build_commandline("gcloud compute tpus create",
                            name,
-                           zone=zone,
-                           project=project,
-                           network=network,
-                           subnetwork=subnetwork,
-                           range=range,
-                           version=version,
-                           accelerator_type=accelerator_type,
-                           preemptible=preemptible,
-                           description=description,
+                           tpu_vm=is_tpu_vm_version(kws['version']),
+                           zone=kws['zone'],
+                           project=kws['project'],
+                           network=kws['network'],
+                           subnetwork=kws['subnetwork'],
+                           range=kws['range'],
+                           version=kws['version'],
+                           accelerator_type=kws['accelerator_type'],
+                           preemptible=kws['preemptible'],
+                           description=kws['description'],
                            async_=async_,
-                           data_disk=data_disk,
+                           data_disk=kws['data_disk'],
                            )
 
 def delete_tpu_command(tpu, zone=None, project=None, async_=False):
@@ -841,6 +1879,7 @@ def delete_tpu_command(tpu, zone=None, project=None, async_=False):
     project = parse_tpu_project(tpu)
   return build_commandline("gcloud compute tpus delete",
                            parse_tpu_id(tpu),
+                           tpu_vm=resolve_tpu_vm(tpu),
                            zone=zone,
                            project=project,
                            quiet=True,
@@ -854,6 +1893,7 @@ def start_tpu_command(tpu, zone=None, project=None, async_=False):
     project = parse_tpu_project(tpu)
   return build_commandline("gcloud compute tpus start",
                            parse_tpu_id(tpu),
+                           tpu_vm=resolve_tpu_vm(tpu),
                            zone=zone,
                            project=project,
                            quiet=True,
@@ -867,6 +1907,7 @@ def stop_tpu_command(tpu, zone=None, project=None, async_=False):
     project = parse_tpu_project(tpu)
   return build_commandline("gcloud compute tpus stop",
                            parse_tpu_id(tpu),
+                           tpu_vm=resolve_tpu_vm(tpu),
                            zone=zone,
                            project=project,
                            quiet=True,
@@ -882,6 +1923,7 @@ def reimage_tpu_command(tpu, zone=None, project=None, version=None, async_=False
     version = parse_tpu_version(tpu)
   return build_commandline("gcloud compute tpus reimage",
                            parse_tpu_id(tpu),
+                           tpu_vm=resolve_tpu_vm(tpu, version=version),
                            zone=zone,
                            project=project,
                            version=version,
@@ -896,8 +1938,1026 @@ def ssh_tpu_command(tpu, zone=None, project=None, ssh_flag=None, worker=None):
     project = parse_tpu_project(tpu)
   return build_commandline("gcloud alpha compute tpus tpu-vm ssh",
                            parse_tpu_id(tpu),
+                           tpu_vm=True,
                            zone=zone,
                            project=project,
                            ssh_flag=ssh_flag,
                            worker=worker,
                            )
+
+def parse_tpu_worker_ips(tpu, internal_only=False):
+  # one per worker, from the TPU's networkEndpoints; workers without an
+  # external IP are reached on their internal one.
+  ips = []
+  for internal_ip, external_ip in parse_tpu_endpoints(tpu):
+    ips.append(internal_ip if internal_only or external_ip is None else external_ip)
+  return ips
+
+def get_ssh_control_dir():
+  from . import snapshot
+  return os.path.join(snapshot.get_cache_dir(), 'ssh')
+
+def get_ssh_identity_file():
+  # the key `gcloud compute ssh` sets up for TPU VMs.
+  path = os.path.expanduser('~/.ssh/google_compute_engine')
+  return path if os.path.exists(path) else None
+
+def get_ssh_known_hosts_file():
+  # shared with gcloud, which keys its entries by HostKeyAlias too.
+  return os.path.expanduser('~/.ssh/google_compute_known_hosts')
+
+def get_ssh_host_key_alias(tpu, worker):
+  # what `gcloud compute tpus tpu-vm ssh` records a worker's host key
+  # under, so that a recreated TPU reusing the IP isn't a key mismatch.
+  node_id = parse_tpu_node_id(tpu)
+  return None if not node_id else 'tpu.{}-{}'.format(node_id, worker)
+
+def ssh_worker_command(host, command, user=None, port=None, identity_file=None, options=(), control_dir=None, control_persist=600, host_key_alias=None, known_hosts_file=None):
+  """The ssh argv that runs `command` on `host`. Connections go through a
+  shared ControlMaster socket per host, kept open for `control_persist`
+  seconds, so repeated commands skip the handshake. Host keys are
+  trusted on first use and checked after that."""
+  if control_dir is None:
+    control_dir = get_ssh_control_dir()
+  if identity_file is None:
+    identity_file = get_ssh_identity_file()
+  if known_hosts_file is None:
+    known_hosts_file = get_ssh_known_hosts_file()
+  args = os.environ.get('TPUNICORN_SSH', 'ssh').split()
+  args += ['-o', 'BatchMode=yes',
+           '-o', 'StrictHostKeyChecking=accept-new',
+           '-o', 'UserKnownHostsFile=' + known_hosts_file,
+           '-o', 'LogLevel=ERROR',
+           '-o', 'ControlMaster=auto',
+           '-o', 'ControlPath=' + os.path.join(control_dir, '%C'),
+           '-o', 'ControlPersist={}'.format(control_persist)]
+  if host_key_alias is not None:
+    args += ['-o', 'HostKeyAlias=' + host_key_alias]
+  if port is not None:
+    args += ['-p', str(port)]
+  if identity_file is not None:
+    args += ['-i', identity_file]
+  if user is not None:
+    args += ['-l', user]
+  for option in options:
+    args += ['-o', option]
+  return args + ['--', host, command]
+
+def exec_on_workers(tpu, command, workers=None, max_parallel=32, on_output=None, internal_only=False, **kws):
+  """Run `command` on the given workers of a TPU VM (all of them by
+  default) at once over ssh. Each line of output is passed to
+  `on_output(worker, line)` as it arrives. Returns {worker: exit code};
+  255 means ssh itself failed."""
+  ips = parse_tpu_worker_ips(tpu, internal_only=internal_only)
+  if not ips:
+    raise ValueError('TPU {} has no network endpoints yet'.format(parse_tpu_id(tpu)))
+  if workers is None:
+    workers = list(range(len(ips)))
+  for worker in workers:
+    if not 0 <= worker < len(ips):
+      raise ValueError('TPU {} has no worker {}; it has {}'.format(parse_tpu_id(tpu), worker, len(ips)))
+  os.makedirs(kws.get('control_dir') or get_ssh_control_dir(), mode=0o700, exist_ok=True)
+  os.makedirs(os.path.dirname(kws.get('known_hosts_file') or get_ssh_known_hosts_file()), mode=0o700, exist_ok=True)
+  def run(worker):
+    proc = subprocess.Popen(ssh_worker_command(ips[worker], command, host_key_alias=get_ssh_host_key_alias(tpu, worker), **kws),
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, b''):
+      if on_output is not None:
+        on_output(worker, line.decode('utf8', errors='replace').rstrip('\n'))
+    proc.stdout.close()
+    return proc.wait()
+  with futures.ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(workers))), thread_name_prefix='exec') as executor:
+    jobs = {worker: executor.submit(run, worker) for worker in workers}
+  return {worker: job.result() for worker, job in jobs.items()}
+
+# Lifecycle operations over REST. These call the TPU API directly with the
+# same credentials and session as the list calls, instead of paying for a
+# gcloud process per call, and return an Operation handle right away.
+# TPU VMs go through v2alpha1; legacy TPU nodes through v1.
+
+def get_lifecycle_backend():
+  backend = os.environ.get('TPUNICORN_BACKEND', 'rest')
+  if backend not in ['rest', 'gcloud']:
+    raise ValueError("TPUNICORN_BACKEND should be 'rest' or 'gcloud', not {!r}".format(backend))
+  return backend
+
+def get_api_version(tpu_vm):
+  return 'v2alpha1' if tpu_vm else 'v1'
+
+def api_node_url(tpu, zone=None, project=None, tpu_vm=True, action=None):
+  if zone is None:
+    zone = parse_tpu_zone(tpu)
+  project = get_default_project(project=project)
+  url = 'https://tpu.googleapis.com/{version}/projects/{project}/locations/{zone}/nodes'.format(
+    version=get_api_version(tpu_vm), project=project, zone=zone)
+  if tpu is not None:
+    url += '/' + parse_tpu_id(tpu)
+  if action is not None:
+    url += ':' + action
+  return url
+
+def api_request(method, url, project=None, body=None, params=None, session=None):
+  session = get_requests_session(session=session)
+  headers = get_headers(project=project)
+  if body is not None:
+    del headers['content-length']
+  response = session.request(method, url, headers=headers, json=body, params=params)
+  if not response.ok:
+    try:
+      message = response.json()['error']['message']
+    except (ValueError, KeyError, TypeError):
+      message = response.text
+    import requests
+    raise requests.HTTPError('{} {} failed: {} {}'.format(method, url, response.status_code, message), response=response)
+  return response.json()
+
+class Operation:
+  """A handle on a long-running TPU API operation, e.g. from delete_tpu."""
+
+  def __init__(self, op, project=None, tpu_vm=True, session=None):
+    self.op = op
+    self.project = project
+    self.tpu_vm = tpu_vm
+    self.session = session
+
+  @property
+  def name(self):
+    return self.op['name']
+
+  @property
+  def done(self):
+    return self.op.get('done', False)
+
+  @property
+  def error(self):
+    return self.op.get('error')
+
+  @property
+  def result(self):
+    return self.op.get('response')
+
+  @property
+  def target(self):
+    return self.op.get('metadata', {}).get('target')
+
+  def url(self):
+    return 'https://tpu.googleapis.com/{}/{}'.format(get_api_version(self.tpu_vm), self.name)
+
+  def poll(self):
+    if not self.done:
+      self.op = api_request('GET', self.url(), project=self.project, session=self.session)
+    return self.done
+
+  def cancel(self):
+    if not self.done:
+      api_request('POST', self.url() + ':cancel', project=self.project, body={}, session=self.session)
+
+  def check(self):
+    if self.error is not None:
+      raise RuntimeError('Operation {} failed: {}'.format(self.name, self.error.get('message', self.error)))
+    return self.result
+
+  def wait(self, timeout=None, min_interval=None, max_interval=None):
+    tracker = Tracker(min_interval=min_interval, max_interval=max_interval)
+    future = tracker.watch_operation(self)
+    tracker.run(timeout=timeout)
+    return future.result()
+
+  def __repr__(self):
+    return '<Operation {} done={}>'.format(self.name, self.done)
+
+def get_poll_intervals():
+  return (float(os.environ.get('TPUNICORN_POLL_MIN', '2')),
+          float(os.environ.get('TPUNICORN_POLL_MAX', '30')))
+
+def backoff_intervals(min_interval=None, max_interval=None, factor=1.5):
+  lo, hi = get_poll_intervals()
+  interval = lo if min_interval is None else min_interval
+  hi = hi if max_interval is None else max_interval
+  while True:
+    yield min(interval, hi)
+    interval *= factor
+
+def is_tpu_healthy(tpu):
+  return tpu.state == 'READY' and tpu.health == 'HEALTHY'
+
+class Tracker:
+  """Waits on many TPUs and operations at once.
+
+  Each tick does one fleet fetch covering every watched TPU, and polls
+  each pending operation; a waiter's future resolves on the tick where
+  its condition (by default, READY and HEALTHY) holds. Ticks back off
+  exponentially between TPUNICORN_POLL_MIN and TPUNICORN_POLL_MAX
+  seconds, starting over whenever anything changes state."""
+
+  def __init__(self, project=None, min_interval=None, max_interval=None, factor=1.5):
+    self.project = project
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.factor = factor
+    self.waiters = []
+    self.operations = []
+
+  def watch(self, tpu, zone=None, until=is_tpu_healthy, on_change=None):
+    future = futures.Future()
+    self.waiters.append({
+      'id': parse_tpu_id(tpu),
+      'zone': parse_tpu_zone(tpu) if zone is None else zone,
+      'until': until,
+      'on_change': on_change,
+      'future': future,
+      'state': (),
+    })
+    return future
+
+  def watch_operation(self, op):
+    future = futures.Future()
+    self.operations.append((op, future))
+    return future
+
+  @property
+  def pending(self):
+    return len(self.waiters) + len(self.operations)
+
+  def tick(self):
+    """Poll everything pending once. Returns whether anything changed."""
+    changed = False
+    if self.waiters:
+      zones = set(waiter['zone'] for waiter in self.waiters)
+      zone = None if None in zones else ','.join(sorted(zones))
+      fleet = get_fleet(zone=zone, project=self.project, fresh=True)
+      for waiter in list(self.waiters):
+        tpu = fleet.get(waiter['id'], silent=True)
+        state = None if tpu is None else (tpu.state, tpu.health)
+        if state != waiter['state']:
+          waiter['state'] = state
+          changed = True
+          if waiter['on_change'] is not None:
+            waiter['on_change'](tpu)
+        if tpu is not None and waiter['until'](tpu):
+          self.waiters.remove(waiter)
+          waiter['future'].set_result(tpu)
+    for op, future in list(self.operations):
+      try:
+        if not op.poll():
+          continue
+        future.set_result(op.check())
+      except Exception as e:
+        future.set_exception(e)
+      self.operations.remove((op, future))
+      changed = True
+    return changed
+
+  def run(self, timeout=None, until=None):
+    # until: stop early once this returns true, e.g. when any one future is done.
+    start = time.time()
+    intervals = None
+    while self.pending:
+      if self.tick() or intervals is None:
+        intervals = backoff_intervals(self.min_interval, self.max_interval, self.factor)
+      if not self.pending or (until is not None and until()):
+        break
+      delay = next(intervals)
+      if timeout is not None and time.time() - start + delay > timeout:
+        raise TimeoutError('Still waiting on {} TPUs and {} operations after {} seconds'.format(
+          len(self.waiters), len(self.operations), timeout))
+      time.sleep(delay)
+
+def is_tpu_stopped(tpu):
+  return tpu.state == 'STOPPED'
+
+class Rollout:
+  """Runs a lifecycle operation (reimage, start, ...) across many TPUs,
+  rolling-update style.
+
+  At most `max_parallel` TPUs are in flight at once, and at most
+  `max_unavailable` of the TPUs that were healthy when the rollout began
+  are out of service because of it (in flight, or failed) at any time;
+  once failures use that up, the rest are skipped. A TPU is done when its
+  operation has finished and `until` holds for it (HEALTHY by default;
+  None to not wait). One Tracker does all the waiting, so a poll is one
+  fleet fetch however many TPUs are in flight.
+
+  `begin(tpu)` starts the operation on one TPU (it runs on a thread) and
+  returns its Operation, or None if it already saw it through. run()
+  returns one (tpu, seconds, error) per TPU, in order of completion;
+  error is None on success, or 'skipped'."""
+
+  def __init__(self, tpus, begin, until=is_tpu_healthy, max_parallel=4, max_unavailable=1, project=None, on_change=None, on_done=None):
+    self.tpus = list(tpus)
+    self.begin = begin
+    self.until = until
+    self.max_parallel = max(1, max_parallel)
+    self.max_unavailable = max(1, max_unavailable)
+    self.on_change = on_change
+    self.on_done = on_done
+    self.tracker = Tracker(project=project)
+    self.healthy = set(tpu.id for tpu in self.tpus if is_tpu_healthy(tpu))
+
+  def run(self):
+    queue = list(self.tpus)
+    flight = {}
+    results = []
+    failed = set()
+    started = {}
+    def finish(tpu, error):
+      flight.pop(tpu.id, None)
+      if error is not None:
+        failed.add(tpu.id)
+      result = (tpu, time.time() - started[tpu.id] if tpu.id in started else 0.0, error)
+      results.append(result)
+      if self.on_done is not None:
+        self.on_done(*result)
+    intervals = None
+    with futures.ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix='rollout') as executor:
+      while queue or flight:
+        changed = False
+        unavailable = len(self.healthy & (set(flight) | failed))
+        for tpu in list(queue):
+          if len(flight) >= self.max_parallel:
+            break
+          if tpu.id in self.healthy:
+            if unavailable >= self.max_unavailable:
+              continue
+            unavailable += 1
+          queue.remove(tpu)
+          started[tpu.id] = time.time()
+          flight[tpu.id] = (tpu, 'begin', executor.submit(self.begin, tpu))
+          changed = True
+        if not flight:
+          # failures used up the budget.
+          for tpu in queue:
+            finish(tpu, 'skipped')
+          break
+        for tpu, phase, future in list(flight.values()):
+          if not future.done():
+            continue
+          changed = True
+          if future.exception() is not None:
+            finish(tpu, str(future.exception()) or type(future.exception()).__name__)
+          elif phase == 'begin' and future.result() is not None:
+            flight[tpu.id] = (tpu, 'operation', self.tracker.watch_operation(future.result()))
+          elif phase != 'wait' and self.until is not None:
+            flight[tpu.id] = (tpu, 'wait', self.tracker.watch(tpu, zone=tpu.zone, until=self.until, on_change=self.on_change))
+          else:
+            finish(tpu, None)
+        if self.tracker.pending and self.tracker.tick():
+          changed = True
+        if changed or intervals is None:
+          intervals = backoff_intervals(self.tracker.min_interval, self.tracker.max_interval, self.tracker.factor)
+        if flight and not changed:
+          time.sleep(next(intervals))
+    return results
+
+class PreemptionHistory:
+  """How often preemptible TPUs get preempted, by zone and hour of age,
+  as observed by babysit and kept in the cache dir across runs.
+
+  hazard() is preemptions per hour of exposure, shrunk towards the
+  overall rate (which, with no data yet, is one per 24 hours)."""
+
+  max_age = 24
+  strength = 2.0 # hours of prior exposure
+
+  def __init__(self, path=None):
+    if path is None:
+      from . import snapshot
+      path = os.path.join(snapshot.get_cache_dir(), 'preemptions-{}.json'.format(snapshot.get_configuration()))
+    self.path = path
+    self.preemptions = defaultdict(float)
+    self.exposure = defaultdict(float)
+    try:
+      with open(path) as f:
+        data = json.load(f)
+      self.preemptions.update(data.get('preemptions', {}))
+      self.exposure.update(data.get('exposure', {}))
+    except (OSError, ValueError):
+      pass
+
+  def key(self, zone, age):
+    return '{}/{}'.format(zone, max(0, min(int(age // 3600), self.max_age)))
+
+  def observe(self, tpu, seconds, now=None):
+    if tpu.preemptible and tpu.created_at is not None:
+      self.exposure[self.key(tpu.zone, since(tpu.created_at, now))] += seconds / 3600.0
+
+  def preempted(self, tpu, now=None):
+    if tpu.created_at is not None:
+      self.preemptions[self.key(tpu.zone, since(tpu.created_at, now))] += 1
+
+  def rate(self):
+    return (sum(self.preemptions.values()) + 1.0) / (sum(self.exposure.values()) + self.max_age)
+
+  def hazard(self, zone, age):
+    key = self.key(zone, age)
+    return (self.preemptions.get(key, 0) + self.strength * self.rate()) / (self.exposure.get(key, 0) + self.strength)
+
+  def save(self):
+    from . import snapshot
+    try:
+      snapshot.write_atomic(self.path, json.dumps({'preemptions': self.preemptions, 'exposure': self.exposure}))
+    except OSError as e:
+      logger.info('Could not save preemption history: %s', e)
+
+class SparePool:
+  """Pre-created TPUs standing by to replace preempted ones.
+
+  Spares are ordinary TPUs named like any other, but with an index of at
+  least `base_index` (e.g. tpu-v3-8-euw4a-900), so they show up in `pu
+  list` and are found again on the next run. The pool keeps `size` of
+  them for each (accelerator type, zone) that has a watched TPU, and
+  never more than `max_total` altogether.
+
+  A spare that has been swapped in is "claimed": it's a working TPU from
+  then on, and is remembered as such in the cache dir across runs.
+  Spares that are legacy TPU nodes get a free range from a RangeIndex."""
+
+  def __init__(self, size=1, base_index=900, max_total=None, project=None, run=None, max_parallel=4, path=None):
+    if path is None:
+      from . import snapshot
+      path = os.path.join(snapshot.get_cache_dir(), 'spares-{}.json'.format(snapshot.get_configuration()))
+    self.path = path
+    self.size = size
+    self.base_index = base_index
+    self.max_total = max_total
+    self.project = project
+    self.run = run
+    self.executor = futures.ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='spares')
+    self.lock = threading.Lock()
+    self.claimed = set()
+    self.pending = {}
+    self.ranges = {}
+    self.swaps = []
+    self.misses = 0
+    self.refills = 0
+    self.warned = set()
+    try:
+      with open(path) as f:
+        self.claimed.update(json.load(f).get('claimed', []))
+    except (OSError, ValueError):
+      pass
+
+  def save(self):
+    from . import snapshot
+    try:
+      snapshot.write_atomic(self.path, json.dumps({'claimed': sorted(self.claimed)}))
+    except OSError as e:
+      logger.info('Could not save spare pool: %s', e)
+
+  def is_spare(self, tpu):
+    return tpu.index >= self.base_index and tpu.id not in self.claimed
+
+  def is_claimed(self, tpu):
+    return tpu.id in self.claimed
+
+  def claim(self, fleet, tpu):
+    # a healthy spare to stand in for `tpu`, or None.
+    with self.lock:
+      for spare in fleet.select(zone=tpu.zone, accelerator_type=tpu.type):
+        if self.is_spare(spare) and spare.id not in self.pending and is_tpu_healthy(spare):
+          self.claimed.add(spare.id)
+          self.save()
+          return spare
+      self.misses += 1
+
+  def swapped(self, seconds):
+    with self.lock:
+      self.swaps.append(seconds)
+
+  def forget(self, fleet, zone=None):
+    # claimed TPUs that are gone (from `zone`, if the fleet is just that),
+    # so that a new spare reusing the name counts as a spare.
+    zones = None if zone is None else zone.split(',')
+    gone = set(tpu_id for tpu_id in self.claimed
+               if not fleet.by_id.get(tpu_id) and (zones is None or parse_tpu_zone(tpu_id) in zones))
+    if gone:
+      self.claimed -= gone
+      self.save()
+
+  def plan(self, fleet, tpus, zone=None):
+    """What to do to bring the pool up to size for the working TPUs
+    `tpus`: a list of (name, template, range) spares to create, and a list
+    of preempted spares to delete. `fleet` is every TPU in `zone`."""
+    self.forget(fleet, zone=zone)
+    spares = [tpu for tpu in fleet.tpus if self.is_spare(tpu)]
+    deletes = [tpu for tpu in spares if tpu.state == 'PREEMPTED' and tpu.id not in self.pending]
+    live = [tpu for tpu in spares if tpu.state != 'PREEMPTED' and tpu.id not in self.pending]
+    slots = defaultdict(int)
+    for tpu in live:
+      slots[tpu.type, tpu.zone] += 1
+    for name, (accelerator_type, zone) in self.pending.items():
+      slots[accelerator_type, zone] += 1
+    total = len(live) + len(self.pending)
+    templates = {}
+    for tpu in tpus:
+      if not self.is_spare(tpu):
+        templates.setdefault((tpu.type, tpu.zone), tpu)
+    taken = set(parse_tpu_index(name) for name in self.pending)
+    ranges = RangeIndex(fleet.tpus)
+    for name, (block, network) in self.ranges.items():
+      ranges.reserve(block, network=network)
+    creates = []
+    for slot, template in sorted(templates.items()):
+      for _ in range(self.size - slots[slot]):
+        if self.max_total is not None and total >= self.max_total:
+          break
+        index = self.base_index
+        while True:
+          index = fleet.next_available_index(index)
+          if index not in taken:
+            break
+          index += 1
+        block = None
+        if not is_tpu_vm_version(template.version):
+          try:
+            block = ranges.allocate_tpu_range(index, int(template.type.rsplit('-', 1)[-1]), network=template.network or 'default')
+          except ValueError as e:
+            if slot not in self.warned:
+              self.warned.add(slot)
+              logger.warning('Not keeping spares for %s: %s', template.id, e)
+            break
+        taken.add(index)
+        total += 1
+        creates.append(('tpu-{}-{}-{}'.format(template.type, infer_zone_abbreviation(template.zone), index), template, block))
+    return creates, deletes
+
+  def create(self, name, template, range=None):
+    command = lifecycle_command('create', name,
+                                range=range,
+                                zone=template.zone,
+                                project=template.project,
+                                version=template.version,
+                                accelerator_type=template.type,
+                                network=template.network,
+                                subnetwork=template.subnetwork,
+                                preemptible=template.preemptible or None,
+                                description=template.description)
+    self.run('Creating spare TPU {}...'.format(name), command)
+    with self.lock:
+      self.refills += 1
+
+  def delete(self, tpu):
+    self.run('Deleting preempted spare TPU {}...'.format(tpu.id), lifecycle_command('delete', tpu, zone=tpu.zone, project=tpu.project))
+
+  def retire(self, tpu):
+    # delete a TPU that a spare has taken over from, in the background and
+    # without waiting for the operation.
+    command = lifecycle_command('delete', tpu, zone=tpu.zone, project=tpu.project, async_=True)
+    self.submit(tpu.id, self.run, 'Deleting preempted TPU {}...'.format(tpu.id), command)
+
+  def tend(self, fleet, tpus, zone=None):
+    # start bringing the pool up to size, in the background.
+    with self.lock:
+      creates, deletes = self.plan(fleet, tpus, zone=zone)
+      for name, template, block in creates:
+        self.pending[name] = (template.type, template.zone)
+        if block is not None:
+          self.ranges[name] = (block, template.network or 'default')
+      for tpu in deletes:
+        self.pending[tpu.id] = (tpu.type, tpu.zone)
+    for name, template, block in creates:
+      self.submit(name, self.create, name, template, block)
+    for tpu in deletes:
+      self.submit(tpu.id, self.delete, tpu)
+
+  def submit(self, name, f, *args):
+    def run():
+      try:
+        return f(*args)
+      except BaseException:
+        logger.exception('While tending spare TPU %s', name)
+        raise
+      finally:
+        with self.lock:
+          self.pending.pop(name, None)
+          self.ranges.pop(name, None)
+    return self.executor.submit(run)
+
+  def stats(self):
+    with self.lock:
+      swaps = list(self.swaps)
+      return {
+        'size': self.size,
+        'max_total': self.max_total,
+        'claimed': len(self.claimed),
+        'pending': len(self.pending),
+        'swaps': len(swaps),
+        'misses': self.misses,
+        'refills': self.refills,
+        'swap_latency': {
+          'last': swaps[-1] if swaps else None,
+          'mean': sum(swaps) / len(swaps) if swaps else None,
+          'max': max(swaps) if swaps else None,
+        },
+      }
+
+class Babysitter:
+  """Keeps many TPUs alive from one poll loop.
+
+  Every watched TPU (matching `targets`, ids/indices/globs, and/or
+  `filter`) has its own next-check time in a priority queue. Its check
+  interval starts from `interval` and scales with the TPU's preemption
+  hazard (see PreemptionHistory) for its zone and age, within
+  [min_interval, max_interval], plus jitter; a preemptible TPU is also
+  always checked as it reaches 24 hours old. When checks come due, one
+  fleet fetch covers the zones of every TPU due soon.
+
+  Fetches are paced by a token bucket that refills at one per `interval`
+  seconds, so on average there are never more fetches than checking
+  everything every `interval` seconds; quiet periods bank a few tokens
+  for high-hazard ones. A full fetch every `max_interval` seconds picks
+  up new TPUs.
+
+  Preempted TPUs are handed to `recreate(tpu)` on a pool of
+  `max_parallel` threads; once HEALTHY again, `on_healthy(tpu)` runs on
+  the same pool. A recreate that fails (e.g. for lack of capacity) is
+  tried again every `interval` seconds until the TPU exists again.
+
+  With a SparePool, a preempted TPU is instead replaced by a healthy
+  spare right away: `on_swap(tpu, spare)` runs, the preempted TPU is
+  deleted in the background, and from then on the spare is watched in
+  its place. The pool is topped up after every full
+  fetch. Only when there's no spare to be had is the TPU recreated."""
+
+  burst = 3
+
+  def __init__(self, targets=(), zone=None, project=None, filter=None, recreate=None, on_healthy=None, on_tick=None, max_parallel=4, interval=30.0, min_interval=None, max_interval=None, history=None, pool=None, on_swap=None):
+    self.targets = list(targets)
+    self.zone = zone
+    self.project = project
+    self.filter = filter
+    self.recreate = recreate
+    self.on_healthy = on_healthy
+    self.on_tick = on_tick
+    self.interval = interval
+    self.min_interval = interval / 3.0 if min_interval is None else min_interval
+    self.max_interval = interval * 4.0 if max_interval is None else max_interval
+    self.history = PreemptionHistory() if history is None else history
+    self.pool = pool
+    self.on_swap = on_swap
+    self.replaced = set()
+    self.executor = futures.ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='babysit')
+    self.jobs = {}
+    self.subjects = {}
+    self.failed = {}
+    self.recovering = {}
+    self.queue = []
+    self.due = {}
+    self.zones = {}
+    self.last_seen = {}
+    self.next_full = 0.0
+    self.tokens = self.burst
+    self.refilled = time.time()
+    self.saved = time.time()
+
+  def watched(self, fleet):
+    tpus = fleet.match(self.targets) if self.targets else fleet.tpus
+    if self.zone is not None:
+      tpus = [tpu for tpu in tpus if tpu.zone in self.zone.split(',')]
+    if self.pool is None:
+      return tpus
+    # the fleet wasn't filtered, so that the pool can see every spare.
+    if self.filter is not None:
+      tpus = TpuFilter.wrap(self.filter).apply(tpus)
+    tpus = [tpu for tpu in tpus if not self.pool.is_spare(tpu) and tpu.id not in self.replaced]
+    seen = set(tpu.id for tpu in tpus)
+    return tpus + [tpu for tpu in fleet.tpus if self.pool.is_claimed(tpu) and tpu.id not in seen]
+
+  def swap(self, tpu, spare, since):
+    if self.on_swap is not None:
+      self.on_swap(tpu, spare)
+    seconds = time.time() - since
+    self.pool.swapped(seconds)
+    logger.info('Swapped spare TPU %s in for %s in %.1fs', spare.id, tpu.id, seconds)
+    self.pool.retire(tpu)
+
+  def submit(self, f, tpu):
+    def run():
+      try:
+        return f(tpu)
+      except BaseException:
+        logger.exception('While babysitting TPU %s', tpu.id)
+        raise
+    return self.executor.submit(run)
+
+  def check_interval(self, tpu, now=None):
+    if tpu.id in self.recovering:
+      return self.min_interval
+    if not tpu.preemptible or tpu.created_at is None:
+      return self.max_interval
+    age = since(tpu.created_at, now)
+    hazard = self.history.hazard(tpu.zone, age)
+    interval = self.interval * self.history.rate() / hazard
+    # preemptible TPUs don't outlive 24 hours, so look in right then.
+    interval = min(interval, max(self.min_interval, self.history.max_age * 3600 - age))
+    interval = max(self.min_interval, min(self.max_interval, interval))
+    return interval * random.uniform(0.9, 1.1)
+
+  def schedule(self, tpu_id, when):
+    self.due[tpu_id] = when
+    heapq.heappush(self.queue, (when, tpu_id))
+
+  def next_due(self):
+    while self.queue and self.due.get(self.queue[0][1]) != self.queue[0][0]:
+      heapq.heappop(self.queue)
+    return min(self.queue[0][0], self.next_full) if self.queue else self.next_full
+
+  def due_zones(self, now):
+    # every zone with a TPU due within min_interval from now, or None for
+    # the full fleet.
+    if now >= self.next_full:
+      return None
+    zones = set(self.zones.get(tpu_id) for tpu_id, when in self.due.items() if when <= now + self.min_interval)
+    if None in zones:
+      return None
+    return ','.join(sorted(zones))
+
+  def take_token(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.refilled) / self.interval)
+    self.refilled = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0.0
+    return (1 - self.tokens) * self.interval
+
+  def start(self, f, tpu):
+    self.jobs[tpu.id] = self.submit(f, tpu)
+    self.subjects[tpu.id] = tpu
+
+  def tick(self, zone=None):
+    now = time.time()
+    full = zone is None
+    if full:
+      zone = self.zone
+    fleet = get_fleet(zone=zone, project=self.project, filter=self.filter if self.pool is None else None, fresh=True)
+    for tpu_id, job in list(self.jobs.items()):
+      if job.done():
+        del self.jobs[tpu_id]
+        tpu = self.subjects.pop(tpu_id)
+        if tpu_id in self.replaced:
+          continue
+        if job.exception() is None:
+          self.recovering[tpu_id] = True
+        else:
+          # try again later, whether or not the TPU is still there.
+          self.failed[tpu_id] = tpu
+          self.schedule(tpu_id, now + self.interval)
+    tpus = self.watched(fleet)
+    if self.on_tick is not None:
+      self.on_tick(tpus)
+    seen = set()
+    for tpu in tpus:
+      seen.add(tpu.id)
+      self.zones[tpu.id] = tpu.zone
+      if tpu.id in self.last_seen and tpu.state != 'PREEMPTED':
+        self.history.observe(tpu, now - self.last_seen[tpu.id], now=now)
+      self.last_seen[tpu.id] = now
+      if tpu.id in self.jobs:
+        continue
+      if tpu.id in self.failed and tpu.state != 'PREEMPTED':
+        # it was recreated after all.
+        del self.failed[tpu.id]
+        self.recovering[tpu.id] = True
+      if tpu.id in self.recovering and tpu.state != 'PREEMPTED':
+        if is_tpu_healthy(tpu):
+          del self.recovering[tpu.id]
+          if self.on_healthy is not None:
+            self.submit(self.on_healthy, tpu)
+      elif tpu.id in self.failed:
+        if self.due.get(tpu.id, 0) <= now:
+          del self.failed[tpu.id]
+          self.start(self.recreate, tpu)
+        else:
+          continue
+      elif tpu.state == 'PREEMPTED':
+        # (possibly again, while still recovering from the last time.)
+        self.recovering.pop(tpu.id, None)
+        self.history.preempted(tpu, now=now)
+        self.history.save()
+        spare = self.pool.claim(fleet, tpu) if self.pool is not None else None
+        if spare is not None:
+          self.replaced.add(tpu.id)
+          self.start(lambda tpu, spare=spare: self.swap(tpu, spare, now), tpu)
+          self.zones[spare.id] = spare.zone
+          self.schedule(spare.id, now + self.check_interval(spare, now=now))
+        else:
+          self.start(self.recreate, tpu)
+      self.schedule(tpu.id, now + self.check_interval(tpu, now=now))
+    # recreates that failed after deleting the TPU: try them again.
+    for tpu_id, tpu in list(self.failed.items()):
+      if tpu_id not in seen and self.due.get(tpu_id, 0) <= now:
+        if zone is None or tpu.zone in zone.split(','):
+          del self.failed[tpu_id]
+          self.start(self.recreate, tpu)
+    # forget TPUs that were deleted (other than by us) in the zones we saw.
+    for tpu_id in list(self.due):
+      if tpu_id not in seen and tpu_id not in self.jobs and tpu_id not in self.recovering and tpu_id not in self.failed:
+        if zone is None or self.zones.get(tpu_id) in zone.split(','):
+          del self.due[tpu_id]
+          self.last_seen.pop(tpu_id, None)
+    # a replaced TPU is ignored until it's gone.
+    ids = set(tpu.id for tpu in fleet.tpus)
+    for tpu_id in list(self.replaced):
+      if tpu_id not in ids and tpu_id not in self.jobs:
+        if zone is None or self.zones.get(tpu_id) in zone.split(','):
+          self.replaced.discard(tpu_id)
+    if self.pool is not None and full:
+      self.pool.tend(fleet, tpus, zone=zone)
+    # running recreates don't need the fleet; check on them every min_interval.
+    for tpu_id in self.jobs:
+      if self.due.get(tpu_id, 0) <= now:
+        self.schedule(tpu_id, now + self.min_interval)
+    if full:
+      self.next_full = now + self.max_interval
+    if now - self.saved >= 600:
+      self.history.save()
+      self.saved = now
+    return tpus
+
+  def run(self):
+    while True:
+      now = time.time()
+      delay = self.next_due() - now
+      if delay <= 0:
+        delay = self.take_token(now)
+      if delay > 0:
+        time.sleep(delay)
+        continue
+      self.tick(zone=self.due_zones(now))
+
+def api_node_operation(method, tpu, zone=None, project=None, tpu_vm=None, action=None, body=None, params=None, session=None):
+  if tpu_vm is None:
+    tpu_vm = is_tpu_vm(tpu, project=project)
+  if project is None and tpu is not None and not isinstance(tpu, str):
+    project = parse_tpu_project(tpu)
+  project = get_default_project(project=project)
+  url = api_node_url(tpu, zone=zone, project=project, tpu_vm=tpu_vm, action=action)
+  op = api_request(method, url, project=project, body=body, params=params, session=session)
+  return Operation(op, project=project, tpu_vm=tpu_vm, session=session)
+
+def create_tpu(tpu=None, zone=None, version=None, accelerator_type=None, project=None, description=None, network=None, subnetwork=None, range=None, preemptible=None, data_disk=None, session=None):
+  kws = get_create_tpu_args(tpu, zone=zone, version=version, accelerator_type=accelerator_type, project=project, description=description, network=network, subnetwork=subnetwork, range=range, preemptible=preemptible, data_disk=data_disk)
+  tpu_vm = is_tpu_vm_version(kws['version'])
+  body = {'acceleratorType': kws['accelerator_type']}
+  if kws['range']:
+    body['cidrBlock'] = kws['range']
+  if kws['description'] is not None:
+    body['description'] = kws['description']
+  if kws['preemptible']:
+    body['schedulingConfig'] = {'preemptible': True}
+  if tpu_vm:
+    body['runtimeVersion'] = kws['version']
+    body['networkConfig'] = {'network': kws['network'] or 'default', 'enableExternalIps': True}
+    if kws['subnetwork'] is not None:
+      body['networkConfig']['subnetwork'] = kws['subnetwork']
+    if kws['data_disk'] is not None:
+      disk = dict(x.split('=', 1) for x in kws['data_disk'].split(','))
+      body['dataDisks'] = [{'sourceDisk': disk['source'], 'mode': disk['mode'].upper().replace('-', '_')}]
+  else:
+    body['tensorflowVersion'] = kws['version']
+    if kws['network'] is not None:
+      body['network'] = kws['network']
+  return api_node_operation('POST', None, zone=kws['zone'], project=kws['project'], tpu_vm=tpu_vm,
+                            body=body, params={'nodeId': kws['name']}, session=session)
+
+def race_create_tpu(tpu, zones, project=None, version=None, session=None, timeout=None, **kws):
+  """Create `tpu` in every zone of `zones` at once, and keep the first
+  that comes up; the others are cancelled, waited out and deleted.
+  Returns (winning zone, leftovers), where leftovers are the zones (with
+  the error) it couldn't be deleted from. Raises RuntimeError if it
+  couldn't be created in any of them, or TimeoutError if none came up
+  in time, after cleaning up every create."""
+  if isinstance(zones, str):
+    zones = zones.split(',')
+  home = zones[0] if isinstance(tpu, str) else parse_tpu_zone(tpu)
+  spec = get_create_tpu_args(tpu, zone=home, project=project, version=version, **kws)
+  tpu_vm = is_tpu_vm_version(spec['version'])
+  network = spec['network'] or 'default'
+  ranges = None
+  if not tpu_vm and spec['accelerator_type'] and any(zone != home for zone in zones):
+    # a legacy TPU needs a cidrBlock of its own on the network, so each
+    # zone raced gets a different free block.
+    ranges = RangeIndex(get_fleet(project=project).tpus)
+    if spec['range']:
+      ranges.reserve(spec['range'], network=network)
+  tracker = Tracker(project=project)
+  races = []
+  errors = []
+  for zone in zones:
+    args = dict(kws)
+    if zone != home:
+      if tpu_vm:
+        # let each zone pick its own range for a TPU VM.
+        args['range'] = ''
+      elif ranges is not None:
+        args['range'] = ranges.allocate_tpu_range(-1, int(spec['accelerator_type'].rsplit('-', 1)[-1]), network=network)
+    try:
+      op = create_tpu(tpu, zone=zone, project=project, version=version, session=session, **args)
+    except Exception as e:
+      errors.append('{}: {}'.format(zone, e))
+      continue
+    races.append((zone, op, tracker.watch_operation(op)))
+  def won():
+    return [zone for zone, op, future in races if future.done() and future.exception() is None]
+  def abandon(winner=None):
+    # cancel the other creates and see each one through, then delete
+    # whatever it left behind and see that through too. Returns the zones
+    # the TPU may still be running in.
+    for zone, op, future in races:
+      if zone != winner and not future.done():
+        try:
+          op.cancel()
+        except Exception as e:
+          logger.info('Could not cancel %s: %s', op.name, e)
+    tracker.run()
+    deletes = []
+    leftovers = []
+    for zone, op, future in races:
+      if zone == winner:
+        continue
+      try:
+        deletes.append((zone, tracker.watch_operation(api_node_operation('DELETE', parse_tpu_id(tpu), zone=zone, project=project, tpu_vm=tpu_vm, session=session))))
+      except Exception as e:
+        if getattr(getattr(e, 'response', None), 'status_code', None) != 404:
+          leftovers.append('{}: {}'.format(zone, e))
+    tracker.run()
+    for zone, future in deletes:
+      if future.exception() is not None:
+        leftovers.append('{}: {}'.format(zone, future.exception()))
+    for leftover in leftovers:
+      logger.warning('Could not delete TPU %s in %s', parse_tpu_id(tpu), leftover)
+    return leftovers
+  def remains(leftovers):
+    if not leftovers:
+      return ''
+    return '\nTPU {} may still exist in:\n  {}'.format(parse_tpu_id(tpu), '\n  '.join(leftovers))
+  try:
+    tracker.run(timeout=timeout, until=lambda: len(won()) > 0)
+  except TimeoutError as e:
+    raise TimeoutError(str(e) + remains(abandon())) from e
+  winners = won()
+  for zone, op, future in races:
+    if future.done() and future.exception() is not None:
+      errors.append('{}: {}'.format(zone, future.exception()))
+  if not winners:
+    leftovers = abandon()
+    raise RuntimeError('Could not create TPU {} in any of {}:\n  {}'.format(parse_tpu_id(tpu), ', '.join(zones), '\n  '.join(errors)) + remains(leftovers))
+  return winners[0], abandon(winners[0])
+
+def delete_tpu(tpu, zone=None, project=None, session=None):
+  return api_node_operation('DELETE', tpu, zone=zone, project=project, tpu_vm=resolve_tpu_vm(tpu), session=session)
+
+def start_tpu(tpu, zone=None, project=None, session=None):
+  return api_node_operation('POST', tpu, zone=zone, project=project, tpu_vm=resolve_tpu_vm(tpu), action='start', body={}, session=session)
+
+def stop_tpu(tpu, zone=None, project=None, session=None):
+  return api_node_operation('POST', tpu, zone=zone, project=project, tpu_vm=resolve_tpu_vm(tpu), action='stop', body={}, session=session)
+
+def reimage_tpu(tpu, zone=None, project=None, version=None, session=None):
+  if version is None:
+    version = parse_tpu_version(tpu)
+  tpu_vm = resolve_tpu_vm(tpu, version=version)
+  if tpu_vm or (tpu_vm is None and is_tpu_vm(tpu, project=project)):
+    raise ValueError("TPU VMs can't be reimaged through the API; recreate the TPU instead")
+  return api_node_operation('POST', tpu, zone=zone, project=project, tpu_vm=False, action='reimage', body={'tensorflowVersion': version}, session=session)
+
+class LifecycleCall:
+  """A lifecycle operation ready to run. str() is the equivalent gcloud
+  command line; calling it makes the REST call and, unless async_, waits
+  for the operation to finish, like gcloud does."""
+
+  def __init__(self, command, operation, *args, async_=False, **kws):
+    self.command = command
+    self.operation = operation
+    self.args = args
+    self.async_ = async_
+    self.kws = kws
+
+  def __call__(self):
+    op = self.operation(*self.args, **self.kws)
+    if not self.async_:
+      op.wait()
+    return op
+
+  def __str__(self):
+    return self.command
+
+lifecycle_operations = {
+  'create': (create_tpu_command, create_tpu),
+  'delete': (delete_tpu_command, delete_tpu),
+  'start': (start_tpu_command, start_tpu),
+  'stop': (stop_tpu_command, stop_tpu),
+  'reimage': (reimage_tpu_command, reimage_tpu),
+}
+
+def lifecycle_command(verb, tpu, async_=False, backend=None, **kws):
+  """The gcloud command line for `verb` ('create', 'delete', ...), or with
+  the rest backend (the default), a LifecycleCall that does it over REST."""
+  command, operation = lifecycle_operations[verb]
+  line = command(tpu, async_=async_, **kws)
+  if (backend or get_lifecycle_backend()) == 'gcloud':
+    return line
+  if verb == 'reimage' and resolve_tpu_vm(tpu, version=kws.get('version')):
+    # the API can't reimage TPU VMs, so leave that to gcloud.
+    return line
+  return LifecycleCall(line, operation, tpu, async_=async_, **kws)